@@ -0,0 +1,86 @@
+from EfficientSurfaceCodeSim.mc_sampling_job import *
+
+
+def benchmark_decoders(d: int,
+                       p_e: float,
+                       p_p: float,
+                       shots: int,
+                       decoders: Tuple[str, ...] = ('new_circ', 'union_find'),
+                       curve: str = 'S',
+                       biased_erasure: bool = True,
+                       seed: Optional[int] = None,
+                       print_result: bool = True,
+                       rounds: Optional[int] = None) -> Dict[str, Dict[str, float]]:
+    '''
+    Decode the same samples with every decoder in decoders (names of builder.get_decoder)
+        and compare the logical error rate and the decoding throughput.
+    The one-off setup of a decoder (static graph, site table...) is timed separately from the per shot cost.
+    rounds: defaults to d, set it much larger than d to compare the decoders on long memory experiments (e.g. 'sliding_window').
+    '''
+    if rounds is None:
+        builder = MCSampleDecodeJob(job_id='benchmark', circuit_id=f'{d}_{p_e}_{p_p}', d=d, p_e=p_e, p_p=p_p,
+                                    shots=shots, biased_erasure=biased_erasure).get_builder()
+    else:
+        builder = get_circuit_template(distance=d, rounds=rounds,
+                                       mechanism_names=get_2q_mechanism_names(p_e=p_e, biased=biased_erasure),
+                                       measurement_error=0).get_builder(p_p=p_p, p_e=p_e)
+    meas_samples = builder.erasure_circuit.compile_sampler(seed=seed).sample(shots=shots)
+    det_samples, actual_obs = builder.erasure_circuit.compile_m2d_converter().convert(measurements=meas_samples,
+                                                                                      separate_observables=True)
+    results = {}
+    for name in decoders:
+        decode = builder.get_decoder(name)
+        t0 = time.time()
+        decode(det_samples[0], curve, meas_samples[0])  # warm up, builds whatever the decoder caches
+        t1 = time.time()
+        num_errors = 0
+        for i in range(shots):
+            num_errors += actual_obs[i][0] != decode(det_samples[i], curve, meas_samples[i])
+        t2 = time.time()
+        results[name] = {
+            'num_errors': int(num_errors),
+            'logical_error_rate': num_errors / shots,
+            'setup_time': t1 - t0,
+            'time_per_shot': (t2 - t1) / shots,
+            'shots_per_second': shots / max(t2 - t1, 1e-12),
+            'time_per_round': (t2 - t1) / shots / builder.rounds,
+        }
+        if name == 'sliding_window':
+            results[name]['window_latency'] = builder.get_sliding_window_decoder(curve).get_latency_stats()
+        if name == 'cluster':
+            results[name]['cluster_stats'] = builder.get_cluster_decoder(curve).get_cluster_stats()
+        if print_result:
+            print(f"{name:>12}: {num_errors}/{shots} errors, {1e3 * (t2 - t1) / shots:.3f} ms per shot, setup {t1 - t0:.2f}s")
+    return results
+
+
+def benchmark_cluster_decoding(d: int,
+                               p_e_values: List[float],
+                               shots: int,
+                               p_p_ratio: float = 0.1,
+                               curve: str = 'S',
+                               seed: Optional[int] = None,
+                               print_result: bool = True) -> Dict[float, Dict[str, float]]:
+    '''
+    Throughput of the cluster pre-decoder against the global matching it falls back to ('XandZ', the same reweighted static graph),
+        at every p_e of p_e_values with p_p = p_p_ratio p_e. The gain should grow as p goes down and d goes up,
+        the fallback fractions tell how often the global matching was needed anyway.
+    '''
+    results = {}
+    for p_e in p_e_values:
+        runs = benchmark_decoders(d, p_e, p_p_ratio * p_e, shots, decoders=['XandZ', 'cluster'], curve=curve,
+                                  seed=seed, print_result=False)
+        results[p_e] = {
+            'speedup': runs['XandZ']['time_per_shot'] / runs['cluster']['time_per_shot'],
+            'global_time_per_shot': runs['XandZ']['time_per_shot'],
+            'cluster_time_per_shot': runs['cluster']['time_per_shot'],
+            'global_num_errors': runs['XandZ']['num_errors'],
+            'cluster_num_errors': runs['cluster']['num_errors'],
+            **runs['cluster']['cluster_stats'],
+        }
+        if print_result:
+            r = results[p_e]
+            print(f"p_e = {p_e:g}: {r['speedup']:.2f}x ({1e3 * r['cluster_time_per_shot']:.3f} vs {1e3 * r['global_time_per_shot']:.3f} ms per shot), "
+                  f"{r['fallback_fraction']:.1%} of shots and {r['cluster_fallback_fraction']:.1%} of clusters fell back to the global matching, "
+                  f"{r['mean_clusters_per_shot']:.2f} clusters per shot")
+    return results
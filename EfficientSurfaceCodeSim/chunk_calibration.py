@@ -0,0 +1,132 @@
+from EfficientSurfaceCodeSim.mc_sampling_job import *
+
+
+def get_mean_erasures_per_shot(builder: easure_circ_builder) -> float:
+    '''
+    Expected number of heralded erasures per shot: the herald probabilities of every (data, virtual ancilla) pair of the erasure circuit.
+    '''
+    first_ancilla = 2 * (builder.distance + 1) ** 2
+    mean = 0
+    for instruction in builder.erasure_circuit.flattened():
+        if instruction.name != 'PAULI_CHANNEL_2':
+            continue
+        targets = [t.qubit_value for t in instruction.targets_copy()]
+        if targets[1] < first_ancilla:
+            continue
+        args = instruction.gate_args_copy()
+        mean += sum(args[i] for i in HERALDED_PAULI_CHANNEL_2_ARG_INDICES.values()) * (len(targets) // 2)
+    return mean
+
+
+@dataclass
+class ChunkCostModel:
+    """
+    Per-decoder model of the seconds per shot of an MC decode job:
+        log(seconds per shot) = a + b log(d) + c log(1 + mean erasures per shot)
+    fitted by least squares to timed probes and to the wall times of finished jobs, then used to size chunks to a target wall time.
+    Replaces the hand-tuned distance_to_chunk_size tables, which go stale when the decoder, noise or hardware changes.
+    """
+    target_seconds: float = 3600
+    min_shots: int = 100
+    max_shots: int = 10**7
+    max_observations: int = 200  # per decoder, the oldest ones go first so the model follows the hardware
+    prior_slopes: Tuple[float, float] = (3.0, 1.0)  # b, c before any data: d^3 detectors x rounds, cost linear in the erasures
+    prior_weight: float = 0.1
+
+    def __post_init__(self):
+        self.observations: Dict[str, List[Tuple[int, float, float]]] = {}  # decoder -> [(d, mean erasures, seconds per shot)]
+        self.coefficients: Dict[str, List[float]] = {}
+
+    def add_observation(self, decoder: str, d: int, mean_erasures: float, seconds_per_shot: float):
+        observations = self.observations.setdefault(decoder, [])
+        observations.append((int(d), float(mean_erasures), float(seconds_per_shot)))
+        del observations[:-self.max_observations]
+        self.fit(decoder)
+
+    def fit(self, decoder: str):
+        observations = np.array(self.observations[decoder])
+        features = np.stack([np.ones(len(observations)), np.log(observations[:, 0]), np.log1p(observations[:, 1])], axis=1)
+        targets = np.log(observations[:, 2])
+        # A few observations (often a single d, and the erasure count grows with d anyway) can't pin down both slopes,
+        #   so they are pulled towards prior_slopes and the data only moves them where it says something.
+        features = np.concatenate([features, np.sqrt(self.prior_weight) * np.array([[0, 1, 0], [0, 0, 1]])])
+        targets = np.concatenate([targets, np.sqrt(self.prior_weight) * np.array(self.prior_slopes)])
+        self.coefficients[decoder] = [float(c) for c in np.linalg.lstsq(features, targets, rcond=None)[0]]
+
+    def get_seconds_per_shot(self, decoder: str, d: int, mean_erasures: float) -> float:
+        a, b, c = self.coefficients[decoder]
+        return float(np.exp(a + b * np.log(d) + c * np.log1p(mean_erasures)))
+
+    def get_chunk_size(self, decoder: str, d: int, mean_erasures: float, target_seconds: Optional[float] = None) -> int:
+        shots = (target_seconds or self.target_seconds) / self.get_seconds_per_shot(decoder, d, mean_erasures)
+        return int(np.clip(shots, self.min_shots, self.max_shots))
+
+    def get_job_features(self, job: MCSampleDecodeJob) -> Tuple[str, int, float]:
+        builder = job.get_builder()
+        return builder.resolve_decoder_name(job.decoder), job.d, get_mean_erasures_per_shot(builder)
+
+    def probe(self, job: MCSampleDecodeJob, probe_shots: int = 200, artifacts: Optional[CompiledArtifacts] = None) -> float:
+        '''
+        Time a short run of job (the one-off compilation is done first and not timed) and add it as an observation.
+        Returns the measured seconds per shot.
+        '''
+        artifacts = artifacts or compile_artifacts(job.get_builder())
+        probe_job = copy.copy(job)
+        probe_job.shots, probe_job.checkpoint_path = probe_shots, None
+        result = probe_job.sample_and_print_result(artifacts=artifacts)
+        decoder, d, mean_erasures = self.get_job_features(job)
+        self.add_observation(decoder, d, mean_erasures, result['wall_time'] / probe_shots)
+        return result['wall_time'] / probe_shots
+
+    def add_job_result(self, job: MCSampleDecodeJob, result: Dict):
+        # Refine the model with a finished job, result is what its sample_and_print_result returned
+        decoder, d, mean_erasures = self.get_job_features(job)
+        self.add_observation(decoder, d, mean_erasures, result['wall_time'] / result['shots'])
+
+    def get_job_chunk_size(self, job: MCSampleDecodeJob, target_seconds: Optional[float] = None) -> int:
+        decoder, d, mean_erasures = self.get_job_features(job)
+        if decoder not in self.coefficients:
+            self.probe(job)
+        return self.get_chunk_size(decoder, d, mean_erasures, target_seconds)
+
+    def save(self, path: str):
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'target_seconds': self.target_seconds, 'min_shots': self.min_shots, 'max_shots': self.max_shots,
+                       'max_observations': self.max_observations, 'prior_slopes': list(self.prior_slopes),
+                       'prior_weight': self.prior_weight, 'observations': self.observations}, f)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path: str) -> 'ChunkCostModel':
+        with open(path) as f:
+            content = json.load(f)
+        model = cls(target_seconds=content['target_seconds'], min_shots=content['min_shots'],
+                    max_shots=content['max_shots'], max_observations=content['max_observations'],
+                    prior_slopes=tuple(content['prior_slopes']), prior_weight=content['prior_weight'])
+        for decoder, observations in content['observations'].items():
+            model.observations[decoder] = [tuple(o) for o in observations]
+            model.fit(decoder)
+        return model
+
+
+def calibrate_chunk_sizes(jobs: List[MCSampleDecodeJob],
+                          probe_shots: int = 200,
+                          target_seconds: float = 3600,
+                          model_path: Optional[str] = None) -> Dict[str, int]:
+    '''
+    Probe every (d, error model) configuration of jobs once and return the chunk size of each circuit_id.
+    If model_path exists the stored model is refined instead of starting over, and the result is saved back there.
+    '''
+    if model_path is not None and os.path.exists(model_path):
+        model = ChunkCostModel.load(model_path)
+        model.target_seconds = target_seconds
+    else:
+        model = ChunkCostModel(target_seconds=target_seconds)
+    probed = set()
+    for job in jobs:
+        if job.circuit_id not in probed:
+            model.probe(job, probe_shots)
+            probed.add(job.circuit_id)
+    if model_path is not None:
+        model.save(model_path)
+    return {job.circuit_id: model.get_job_chunk_size(job) for job in jobs}
@@ -0,0 +1,219 @@
+import stim
+from typing import List, Dict, Tuple, Optional
+
+
+# Gates that are their own inverse, two of them on the same targets with nothing in between is the identity.
+SELF_INVERSE_1Q_GATES = {'H', 'X', 'Y', 'Z'}
+SELF_INVERSE_2Q_GATES = {'CX', 'CY', 'CZ', 'SWAP'}
+SYMMETRIC_2Q_GATES = {'CZ', 'SWAP'}
+
+# Measurements and resets of different qubits commute, so a run of them can be regrouped by gate.
+MEASURE_OR_RESET_GATES = {'M', 'MX', 'MY', 'MR', 'MRX', 'MRY', 'R', 'RX', 'RY'}
+
+# Instructions that don't act on the qubits of their targets.
+ANNOTATIONS = {'DETECTOR', 'OBSERVABLE_INCLUDE', 'QUBIT_COORDS', 'SHIFT_COORDS', 'TICK'}
+
+
+def _plain_qubits(targets: List[stim.GateTarget]) -> bool:
+    return all(t.is_qubit_target and not t.is_inverted_result_target for t in targets)
+
+
+def _touched_qubits(instruction) -> List[int]:
+    if isinstance(instruction, stim.CircuitRepeatBlock):
+        return sorted({t.qubit_value for inner in instruction.body_copy().flattened()
+                       for t in inner.targets_copy() if t.qubit_value is not None})
+    return [t.qubit_value for t in instruction.targets_copy() if t.qubit_value is not None]
+
+
+def cancel_self_inverse_gates(circuit: stim.Circuit) -> stim.Circuit:
+    '''
+    Drop pairs of identical self-inverse gates (H H, CZ a b CZ a b, ...) when no other instruction acts on their qubits in between.
+    Any noise channel, measurement or reset on one of the qubits keeps the pair, annotations and TICKs don't.
+    '''
+    # Every instruction is kept as [name, targets, args], a cancelled gate has its targets replaced by None.
+    instructions = []
+    pending: Dict[int, Tuple[str, int, int]] = {}  # qubit -> (gate name, instruction index, target position) of the last gate on it
+
+    def block(qubits):
+        for q in qubits:
+            pending.pop(q, None)
+
+    for instruction in circuit:
+        if isinstance(instruction, stim.CircuitRepeatBlock):
+            block(_touched_qubits(instruction))
+            instructions.append(instruction)
+            continue
+        name = instruction.name
+        targets = instruction.targets_copy()
+        if name in ANNOTATIONS:
+            instructions.append([name, targets, instruction.gate_args_copy()])
+            continue
+        if not _plain_qubits(targets) or name not in SELF_INVERSE_1Q_GATES | SELF_INVERSE_2Q_GATES:
+            block(_touched_qubits(instruction))
+            instructions.append([name, targets, instruction.gate_args_copy()])
+            continue
+
+        index = len(instructions)
+        kept = []
+        targets_of = lambda i: kept if i == index else instructions[i][1]
+        if name in SELF_INVERSE_1Q_GATES:
+            for t in targets:
+                q = t.value
+                previous = pending.pop(q, None)
+                if previous is not None and previous[0] == name:
+                    targets_of(previous[1])[previous[2]] = None
+                else:
+                    pending[q] = (name, index, len(kept))
+                    kept.append(t)
+        else:
+            for a, b in zip(targets[0::2], targets[1::2]):
+                pa, pb = pending.pop(a.value, None), pending.pop(b.value, None)
+                if pa is not None and pb is not None and pa[0] == name and pa[1] == pb[1] and min(pa[2], pb[2]) % 2 == 0 \
+                        and abs(pa[2] - pb[2]) == 1 and (pa[2] < pb[2] or name in SYMMETRIC_2Q_GATES):
+                    previous = targets_of(pa[1])
+                    previous[pa[2]] = previous[pb[2]] = None
+                    continue
+                pending[a.value] = (name, index, len(kept))
+                pending[b.value] = (name, index, len(kept) + 1)
+                kept.extend([a, b])
+        instructions.append([name, kept, instruction.gate_args_copy()])
+
+    result = stim.Circuit()
+    for instruction in instructions:
+        if isinstance(instruction, stim.CircuitRepeatBlock):
+            result.append(instruction)
+            continue
+        name, targets, args = instruction
+        targets = [t for t in targets if t is not None]
+        if targets or name in ANNOTATIONS:
+            result.append(name, targets, args)
+    return result
+
+
+def merge_measurements_and_resets(circuit: stim.Circuit) -> stim.Circuit:
+    '''
+    Regroup every run of consecutive measurements/resets on distinct qubits (e.g. M 1, MX 3, M 5, MX 8 ...)
+        into one broadcast instruction per (gate, args), in the order the gates first show up in the run.
+    Measurements change places in the record, so the rec[-k] targets of later DETECTORs and OBSERVABLE_INCLUDEs are remapped.
+    '''
+    result = stim.Circuit()
+    new_position: Dict[int, int] = {}  # absolute measurement index in circuit -> in result, only for measurements that moved
+    num_measurements = 0
+    run: List[stim.CircuitInstruction] = []
+    run_qubits = set()
+
+    def flush():
+        nonlocal num_measurements
+        groups: Dict[Tuple, List[stim.GateTarget]] = {}
+        measurement_order = {}
+        for instruction in run:
+            groups.setdefault((instruction.name, tuple(instruction.gate_args_copy())), []).extend(instruction.targets_copy())
+        # where each measurement of the run ends up
+        position = num_measurements
+        for (name, args), targets in groups.items():
+            if stim.gate_data(name).produces_measurements:
+                for t in targets:
+                    measurement_order[t.qubit_value] = position
+                    position += 1
+        position = num_measurements
+        for instruction in run:
+            if stim.gate_data(instruction.name).produces_measurements:
+                for t in instruction.targets_copy():
+                    if measurement_order[t.qubit_value] != position:
+                        new_position[position] = measurement_order[t.qubit_value]
+                    position += 1
+        num_measurements = position
+        for (name, args), targets in groups.items():
+            result.append(name, targets, list(args))
+        run.clear()
+        run_qubits.clear()
+
+    def remap(target: stim.GateTarget) -> stim.GateTarget:
+        if not target.is_measurement_record_target:
+            return target
+        old = num_measurements + target.value
+        return stim.target_rec(new_position.get(old, old) - num_measurements)
+
+    for instruction in circuit:
+        if not isinstance(instruction, stim.CircuitRepeatBlock) and instruction.name in MEASURE_OR_RESET_GATES:
+            qubits = [t.qubit_value for t in instruction.targets_copy()]
+            if len(set(qubits)) == len(qubits):
+                if not run_qubits.isdisjoint(qubits):
+                    flush()
+                run.append(instruction)
+                run_qubits.update(qubits)
+                continue
+        flush()
+        if isinstance(instruction, stim.CircuitRepeatBlock):
+            # blocks are copied as they are, their lookbacks only reach measurements that didn't move
+            result.append(instruction)
+            num_measurements += instruction.body_copy().num_measurements * instruction.repeat_count
+        else:
+            result.append(instruction.name, [remap(t) for t in instruction.targets_copy()], instruction.gate_args_copy())
+            if stim.gate_data(instruction.name).produces_measurements:
+                single = stim.Circuit()
+                single.append(instruction)
+                num_measurements += single.num_measurements
+    flush()
+    return result
+
+
+def collapse_ticks(circuit: stim.Circuit) -> stim.Circuit:
+    '''
+    Remove TICKs that directly follow another TICK, e.g. the ones left around a layer whose gates all cancelled.
+    '''
+    result = stim.Circuit()
+    previous_is_tick = False
+    for instruction in circuit:
+        is_tick = not isinstance(instruction, stim.CircuitRepeatBlock) and instruction.name == 'TICK'
+        if not (is_tick and previous_is_tick):
+            result.append(instruction)
+        previous_is_tick = is_tick
+    return result
+
+
+def compact_qubit_indices(circuit: stim.Circuit) -> Tuple[stim.Circuit, Dict[int, int]]:
+    '''
+    Relabel the used qubits 0, 1, 2... keeping their order, so stim doesn't carry the unused indices around.
+    Returns the new circuit and the old -> new qubit mapping.
+    The builders assume the virtual erasure ancillas start at 2*(d+1)**2, map that index through the returned dict if you compact their circuits.
+    '''
+    used = sorted({q for instruction in circuit.flattened() for q in _touched_qubits(instruction)})
+    mapping = {q: i for i, q in enumerate(used)}
+
+    def relabel(block: stim.Circuit) -> stim.Circuit:
+        result = stim.Circuit()
+        for instruction in block:
+            if isinstance(instruction, stim.CircuitRepeatBlock):
+                result.append(stim.CircuitRepeatBlock(instruction.repeat_count, relabel(instruction.body_copy())))
+                continue
+            targets = []
+            for t in instruction.targets_copy():
+                if t.is_qubit_target:
+                    targets.append(stim.target_inv(mapping[t.value]) if t.is_inverted_result_target else mapping[t.value])
+                elif t.is_x_target or t.is_y_target or t.is_z_target:
+                    pauli = stim.target_x if t.is_x_target else stim.target_y if t.is_y_target else stim.target_z
+                    targets.append(pauli(mapping[t.value], invert=t.is_inverted_result_target))
+                else:
+                    targets.append(t)
+            result.append(instruction.name, targets, instruction.gate_args_copy())
+        return result
+
+    return relabel(circuit), mapping
+
+
+def optimize_circuit(circuit: stim.Circuit,
+                     cancel_gates: bool = True,
+                     merge_measurements: bool = True,
+                     merge_ticks: bool = True) -> stim.Circuit:
+    '''
+    Peephole pass over a generated circuit, the detectors, observables and noise are unchanged.
+    Qubit compaction changes indices other code relies on, so it's not part of this pass, see compact_qubit_indices().
+    '''
+    if cancel_gates:
+        circuit = cancel_self_inverse_gates(circuit)
+    if merge_measurements:
+        circuit = merge_measurements_and_resets(circuit)
+    if merge_ticks:
+        circuit = collapse_ticks(circuit)
+    return circuit
@@ -0,0 +1,145 @@
+from EfficientSurfaceCodeSim.circuit_builder import *
+from fractions import Fraction
+import functools
+
+
+# Mechanism name -> (factory, the noise parameter its instruction arguments are proportional to)
+MECHANISM_FACTORIES = {
+    '2q depo': (get_2q_depolarization_mechanism, 'p_p'),
+    '2q z shift': (get_2q_differential_shift_mechanism, 'p_z_shift'),
+    '2q erasure': (get_2q_biased_erasure_mechanism, 'p_e'),
+    '2q erasure unbiased': (get_2q_erasure_mechanism, 'p_e'),
+}
+
+# Any value in (0, 1) works, the instruction arguments in 'erasure' and 'normal' mode are all linear in the parameter.
+REFERENCE_PARAMETER_VALUE = 0.1
+
+
+def get_2q_mechanism_names(p_e, p_z_shift=0, biased=True) -> Tuple[str, ...]:
+    '''
+    The mechanism set that get_2q_error_model() would build for these parameters.
+    '''
+    names = ['2q depo']
+    if p_z_shift > 0:
+        names.append('2q z shift')
+    if p_e > 0:
+        names.append('2q erasure' if biased else '2q erasure unbiased')
+    return tuple(names)
+
+
+def get_2q_error_model_from_mechanism_names(mechanism_names, p_p, p_e, p_z_shift=0) -> GateErrorModel:
+    parameters = {'p_p': p_p, 'p_e': p_e, 'p_z_shift': p_z_shift}
+    return GateErrorModel([MECHANISM_FACTORIES[name][0](parameters[MECHANISM_FACTORIES[name][1]])
+                           for name in mechanism_names])
+
+
+@dataclass
+class NoiseSlot:
+    """
+    A noise instruction of the template whose arguments are coefficients * (one noise parameter).
+    """
+    instruction_name: str
+    targets_text: str
+    parameter: Optional[str]         # None means the arguments are constants
+    coefficients: List[Fraction]
+    constant_args: List[float]
+
+    def to_text(self, parameters: Dict[str, float]) -> str:
+        if self.parameter is None:
+            args = self.constant_args
+        else:
+            p = parameters[self.parameter]
+            # p * numerator / denominator reproduces the factories' own arithmetic (p_e/2, p_e*3/4, ...) bit for bit
+            args = [p * c.numerator / c.denominator for c in self.coefficients]
+        return f"{self.instruction_name}({', '.join(repr(float(a)) for a in args)}) {self.targets_text}\n"
+
+
+@dataclass
+class CircuitTemplate:
+    """
+    The structure of an erasure (or normal) circuit recorded once per (d, rounds, code flags, mechanism set).
+    Only the arguments of the after-CZ noise instructions change across a p_p/p_e/p_z_shift sweep,
+    so emit() rewrites those and lets stim parse the text, instead of rebuilding through easure_circ_builder.
+    """
+    distance: int
+    rounds: int
+    mechanism_names: Tuple[str, ...] = ('2q depo', '2q erasure')
+    mode: str = 'erasure'
+    builder_kwargs: Dict[str, Any] = field(default_factory=dict)  # code flags forwarded to easure_circ_builder, e.g. XZZX, native_cz, interaction_order
+
+    def __post_init__(self):
+        assert self.mode in ['erasure', 'normal'], "posterior and deterministic circuits depend on the shot, they can't be templated"
+        assert not self.builder_kwargs.get('fuse_noise', False), "fused channel arguments are not linear in the noise parameters"
+        reference = {parameter: REFERENCE_PARAMETER_VALUE for parameter in ['p_p', 'p_e', 'p_z_shift']}
+        builder = easure_circ_builder(rounds=self.rounds,
+                                      distance=self.distance,
+                                      after_cz_error_model=get_2q_error_model_from_mechanism_names(self.mechanism_names, **reference),
+                                      **self.builder_kwargs)
+        builder.generate_helper()
+
+        self.parts: List[Union[str, NoiseSlot]] = []
+        def record_noise(circuit, error_model, qubits):
+            # Cut the static stream here, otherwise stim would fuse the gates on both sides of the noise.
+            self.parts.append(str(circuit) + '\n')
+            circuit.clear()
+            for mechanism in error_model.list_of_mechanisms:
+                for instruction_name, targets, arg in mechanism.get_instruction(qubits=qubits, mode=self.mode):
+                    targets_text = ' '.join(str(int(q)) for q in np.asarray(targets).flatten())
+                    arg = [float(a) for a in np.atleast_1d(arg)]
+                    if mechanism.name in MECHANISM_FACTORIES:
+                        parameter = MECHANISM_FACTORIES[mechanism.name][1]
+                        coefficients = [Fraction(a / REFERENCE_PARAMETER_VALUE).limit_denominator(10**6) for a in arg]
+                        self.parts.append(NoiseSlot(instruction_name, targets_text, parameter, coefficients, arg))
+                    else:
+                        self.parts.append(NoiseSlot(instruction_name, targets_text, None, [], arg))
+
+        if self.mode == 'erasure':
+            builder.gen_erasure_conversion_circuit(noise_hook=record_noise)
+            self.parts.append(str(builder.erasure_circuit) + '\n')
+            self.next_ancilla_qubit_index = builder.next_ancilla_qubit_index_in_list[0]
+        else:
+            builder.gen_normal_circuit(noise_hook=record_noise)
+            self.parts.append(str(builder.normal_circuit) + '\n')
+        self.helper = builder.helper
+
+    def emit(self, p_p, p_e, p_z_shift=0) -> stim.Circuit:
+        parameters = {'p_p': p_p, 'p_e': p_e, 'p_z_shift': p_z_shift}
+        circuit = stim.Circuit(''.join(part if isinstance(part, str) else part.to_text(parameters) for part in self.parts))
+        if self.builder_kwargs.get('optimize_circuits', False):
+            circuit = optimize_circuit(circuit)
+        return circuit
+
+    def get_builder(self, p_p, p_e, p_z_shift=0) -> easure_circ_builder:
+        '''
+        A builder for these noise parameters whose helper and circuit come from the template.
+        It has fresh error models, so decode_by_generate_new_circ uses the right posterior probabilities.
+        '''
+        builder = easure_circ_builder(rounds=self.rounds,
+                                      distance=self.distance,
+                                      after_cz_error_model=get_2q_error_model_from_mechanism_names(self.mechanism_names, p_p, p_e, p_z_shift),
+                                      **self.builder_kwargs)
+        builder.helper = self.helper
+        if self.mode == 'erasure':
+            builder.next_ancilla_qubit_index_in_list = [self.next_ancilla_qubit_index]
+            builder.after_cz_error_model.set_next_ancilla_qubit_index_in_list(builder.next_ancilla_qubit_index_in_list)
+            builder.erasure_circuit = self.emit(p_p, p_e, p_z_shift)
+        else:
+            builder.normal_circuit = self.emit(p_p, p_e, p_z_shift)
+        return builder
+
+
+@functools.lru_cache(maxsize=32)
+def _get_circuit_template(distance, rounds, mechanism_names, mode, builder_kwargs_items):
+    return CircuitTemplate(distance=distance, rounds=rounds, mechanism_names=mechanism_names,
+                           mode=mode, builder_kwargs=dict(builder_kwargs_items))
+
+
+def get_circuit_template(distance: int,
+                         rounds: int,
+                         mechanism_names: Tuple[str, ...],
+                         mode: str = 'erasure',
+                         **builder_kwargs) -> CircuitTemplate:
+    '''
+    Templates are cached per process, so consecutive sweep points at the same distance share one structural build.
+    '''
+    return _get_circuit_template(distance, rounds, tuple(mechanism_names), mode, tuple(sorted(builder_kwargs.items())))
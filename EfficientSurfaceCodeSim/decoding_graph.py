@@ -0,0 +1,1017 @@
+import math
+import time
+import heapq
+import numpy as np
+import stim
+import pymatching
+from scipy.sparse import csc_matrix, csr_matrix
+from dataclasses import dataclass, field
+from typing import List, Dict, Tuple, Optional
+
+
+NOISE_CHANNELS = {'X_ERROR', 'Y_ERROR', 'Z_ERROR', 'DEPOLARIZE1', 'DEPOLARIZE2',
+                  'PAULI_CHANNEL_1', 'PAULI_CHANNEL_2', 'CORRELATED_ERROR', 'ELSE_CORRELATED_ERROR'}
+
+# PAULI_CHANNEL_2 arguments are ordered IX IY IZ XI XX XY XZ YI YX YY YZ ZI ZX ZY ZZ,
+#   the erasure generators put the data qubit first and the virtual erasure ancilla second,
+#   so the heralded components are the ones with an X on the ancilla.
+HERALDED_PAULI_CHANNEL_2_ARG_INDICES = {'I': 0, 'X': 4, 'Y': 8, 'Z': 12}
+
+
+def probability_to_weight(p, curve):
+    '''
+    The same 'S'/'L' curves used by DEM_to_Matching, vectorized.
+    '''
+    p = np.clip(p, 1e-10, 1 - 1e-10)
+    if curve == 'S':
+        return np.log((1 - p) / p)
+    elif curve == 'L':
+        return -np.log(p)
+    else:
+        raise Exception("unsupported curve")
+
+
+@dataclass
+class StaticMatchingGraph:
+    """
+    Array form of the graph that DEM_to_Matching builds when erasure_handling is None.
+    Node num_detectors is the boundary node, the same convention as DEM_to_Matching.
+    Keeping the graph as arrays lets decoders re-weight edges with numpy instead of rebuilding a networkx graph.
+    """
+    num_detectors: int
+    edges: np.ndarray                 # (num_edges, 2) int, the second node is num_detectors for boundary edges
+    error_probabilities: np.ndarray   # (num_edges,) float
+    observable_flips: np.ndarray      # (num_edges,) bool, whether the edge flips observable 0
+
+    def __post_init__(self):
+        self.num_edges = len(self.edges)
+        self.boundary = self.num_detectors
+        self.edge_lookup: Dict[Tuple[int, int], int] = {(int(u), int(v)): i for i, (u, v) in enumerate(self.edges)}
+        # Detector-by-edge incidence matrix, boundary edges only have one non-zero.
+        not_boundary = self.edges[:, 1] != self.boundary
+        rows = np.concatenate([self.edges[:, 0], self.edges[not_boundary, 1]])
+        cols = np.concatenate([np.arange(self.num_edges), np.arange(self.num_edges)[not_boundary]])
+        self.check_matrix = csc_matrix((np.ones(len(rows), dtype=np.uint8), (rows, cols)),
+                                       shape=(self.num_detectors, self.num_edges))
+        self.observable_matrix = csc_matrix(self.observable_flips.reshape(1, -1).astype(np.uint8))
+
+    def get_edge_index(self, dets) -> int:
+        '''
+        dets is a list of at most 2 detectors, returns -1 if the symptom is not an edge of this graph.
+        '''
+        if len(dets) == 1:
+            key = (int(dets[0]), self.boundary)
+        elif len(dets) == 2:
+            key = (int(min(dets)), int(max(dets)))
+        else:
+            return -1
+        return self.edge_lookup.get(key, -1)
+
+    def get_weights(self, curve, error_probabilities=None) -> np.ndarray:
+        if error_probabilities is None:
+            error_probabilities = self.error_probabilities
+        return probability_to_weight(error_probabilities, curve)
+
+    def get_reweighted_matching(self, curve, erased_edges) -> pymatching.Matching:
+        '''
+        Matching with the erased edges set to probability 1/2, every other edge keeps its static weight.
+        '''
+        error_probabilities = self.error_probabilities.copy()
+        error_probabilities[erased_edges] = 0.5
+        return self.to_matching(weights=self.get_weights(curve, error_probabilities))
+
+    def set_matching_weights(self, matching: pymatching.Matching, edges, weights):
+        # Overwrite the weights of some edges of a Matching built by to_matching, in place
+        for e, weight in zip(edges, weights):
+            u, v = self.edges[e]
+            fault_ids = {0} if self.observable_flips[e] else set()
+            if v == self.boundary:
+                matching.add_boundary_edge(int(u), fault_ids=fault_ids, weight=float(weight), merge_strategy='replace')
+            else:
+                matching.add_edge(int(u), int(v), fault_ids=fault_ids, weight=float(weight), merge_strategy='replace')
+
+    def to_matching(self, curve='L', weights=None) -> pymatching.Matching:
+        if weights is None:
+            weights = self.get_weights(curve)
+        return pymatching.Matching.from_check_matrix(self.check_matrix,
+                                                     weights=weights,
+                                                     faults_matrix=self.observable_matrix,
+                                                     use_virtual_boundary_node=True)
+
+
+@dataclass
+class ReweightableMatching:
+    """
+    One Matching of a StaticMatchingGraph whose erased edges are switched in place (merge_strategy='replace'),
+        the same graph as static_graph.get_reweighted_matching(curve, erased_edges) without building a new one.
+    pymatching still rebuilds its search graph at the next decode after a change, about half the cost of from_check_matrix,
+        so callers should decode all the shots of one erased edge set together.
+    """
+    static_graph: StaticMatchingGraph
+    curve: str = 'S'
+
+    def __post_init__(self):
+        self.static_weights = self.static_graph.get_weights(self.curve)
+        self.erased_weight = float(probability_to_weight(np.array([0.5]), self.curve)[0])
+        self.matching = self.static_graph.to_matching(weights=self.static_weights)
+        self.erased_edges = np.zeros(0, dtype=int)
+
+    def get_matching(self, erased_edges) -> pymatching.Matching:
+        erased_edges = np.unique(np.asarray(erased_edges, dtype=int))
+        restored = np.setdiff1d(self.erased_edges, erased_edges, assume_unique=True)
+        added = np.setdiff1d(erased_edges, self.erased_edges, assume_unique=True)
+        self.static_graph.set_matching_weights(self.matching, restored, self.static_weights[restored])
+        self.static_graph.set_matching_weights(self.matching, added, np.full(len(added), self.erased_weight))
+        self.erased_edges = erased_edges
+        return self.matching
+
+
+def DEM_to_static_graph(model: stim.DetectorErrorModel) -> StaticMatchingGraph:
+    """
+    Same merging rule as DEM_to_Matching with erasure_handling=None:
+    parallel edges are combined by XOR-ing their probabilities and the first observable frame is kept.
+    """
+    num_detectors = model.num_detectors
+    edge_to_index: Dict[Tuple[int, int], int] = {}
+    edges = []
+    probabilities = []
+    observables = []
+
+    def handle_error(p, dets, frames):
+        if p == 0 or len(dets) == 0:
+            return
+        if len(dets) == 1:
+            dets.append(num_detectors)
+        if len(dets) > 2:
+            print(f'len dets > 2: {dets}')
+            return
+        key = (min(dets), max(dets))
+        if key in edge_to_index:
+            i = edge_to_index[key]
+            old_p = probabilities[i]
+            probabilities[i] = p * (1 - old_p) + old_p * (1 - p)
+        else:
+            edge_to_index[key] = len(edges)
+            edges.append(key)
+            probabilities.append(p)
+            observables.append(0 in frames)
+
+    for instruction in model.flattened():
+        if instruction.type != "error":
+            continue
+        p = instruction.args_copy()[0]
+        dets, frames = [], []
+        for t in instruction.targets_copy():
+            if t.is_relative_detector_id():
+                dets.append(t.val)
+            elif t.is_logical_observable_id():
+                frames.append(t.val)
+            elif t.is_separator():
+                handle_error(p, dets, frames)
+                dets, frames = [], []
+        handle_error(p, dets, frames)
+
+    probabilities = np.clip(np.array(probabilities, dtype=float), 1e-10, 1 - 1e-10)
+    return StaticMatchingGraph(num_detectors=num_detectors,
+                               edges=np.array(edges, dtype=int).reshape(-1, 2),
+                               error_probabilities=probabilities,
+                               observable_flips=np.array(observables, dtype=bool))
+
+
+def simulate_fault_signatures(circuit: stim.Circuit,
+                              faults_after_instruction: Dict[int, List[Tuple[int, str, List[int]]]],
+                              num_faults: int,
+                              with_measurement_flips: bool = False,
+                              bit_packed: bool = False):
+    '''
+    Propagate many single faults through the noiseless version of circuit in one stim.FlipSimulator batch.
+        circuit: a flattened circuit (no REPEAT blocks)
+        faults_after_instruction: instruction index -> list of (fault_index, pauli string like 'XZ', qubits)
+            the fault is injected right after that instruction.
+    Returns the detector flips (num_faults, num_detectors) and observable flips (num_faults, num_observables) of every fault,
+        followed by the measurement flips (num_faults, num_measurements) if with_measurement_flips.
+    bit_packed: pack the second axis little endian, like stim's bit packed samples.
+    '''
+    sim = stim.FlipSimulator(batch_size=max(num_faults, 1),
+                             disable_stabilizer_randomization=True,
+                             num_qubits=circuit.num_qubits)
+    segment = stim.Circuit()
+    for index, instruction in enumerate(circuit):
+        segment.append(instruction)
+        if index not in faults_after_instruction:
+            continue
+        sim.do(segment.without_noise())
+        segment = stim.Circuit()
+        x_mask = np.zeros((circuit.num_qubits, sim.batch_size), dtype=bool)
+        z_mask = np.zeros((circuit.num_qubits, sim.batch_size), dtype=bool)
+        for fault_index, paulis, qubits in faults_after_instruction[index]:
+            for pauli, qubit in zip(paulis, qubits):
+                if pauli in 'XY':
+                    x_mask[qubit, fault_index] = True
+                if pauli in 'ZY':
+                    z_mask[qubit, fault_index] = True
+        sim.broadcast_pauli_errors(pauli='X', mask=x_mask)
+        sim.broadcast_pauli_errors(pauli='Z', mask=z_mask)
+    sim.do(segment.without_noise())
+    _, _, measurement_flips, detector_flips, observable_flips = sim.to_numpy(
+        bit_packed=bit_packed, transpose=True, output_measure_flips=with_measurement_flips,
+        output_detector_flips=True, output_observable_flips=True)
+    if with_measurement_flips:
+        return detector_flips[:num_faults], observable_flips[:num_faults], measurement_flips[:num_faults]
+    return detector_flips[:num_faults], observable_flips[:num_faults]
+
+
+@dataclass
+class ErasureSiteTable:
+    """
+    One row per virtual erasure ancilla ("site") of an erasure circuit:
+    which data qubit it heralds, when, where its flag sits in a measurement sample,
+    and which edges of the static matching graph an X or Z error on that data qubit would flip.
+    """
+    measurement_indices: np.ndarray            # (num_sites,) index of the flag in a measurement sample of the erasure circuit
+    data_qubits: np.ndarray                    # (num_sites,)
+    ticks: np.ndarray                          # (num_sites,) number of TICKs before the site
+    herald_probabilities: np.ndarray           # (num_sites,)
+    conditional_pauli_probabilities: np.ndarray  # (num_sites, 3) probabilities of X, Y, Z given the site is heralded
+    x_detectors: np.ndarray                    # (num_sites, num_detectors) bool, detectors flipped by an X error at the site
+    z_detectors: np.ndarray                    # (num_sites, num_detectors) bool
+    x_observable_flips: np.ndarray             # (num_sites,) bool
+    z_observable_flips: np.ndarray             # (num_sites,) bool
+    x_edges: Optional[np.ndarray] = None       # (num_sites,) static graph edge index, -1 if no edge
+    z_edges: Optional[np.ndarray] = None
+
+    def __post_init__(self):
+        self.num_sites = len(self.measurement_indices)
+
+    def attach_static_graph(self, static_graph: StaticMatchingGraph):
+        self.x_edges = np.array([static_graph.get_edge_index(np.flatnonzero(row)) for row in self.x_detectors], dtype=int)
+        self.z_edges = np.array([static_graph.get_edge_index(np.flatnonzero(row)) for row in self.z_detectors], dtype=int)
+
+    def get_flags(self, single_measurement_sample) -> np.ndarray:
+        return np.asarray(single_measurement_sample)[self.measurement_indices]
+
+    def get_erased_edges(self, flags, paulis: str = 'XZ') -> np.ndarray:
+        '''
+        Edges of the static graph that an erasure at any flagged site can flip, according to the conditional Pauli probabilities.
+        paulis: 'XZ' for both edge types, 'Z' (or 'X') to only look at one of them like the old 'Z' reweighting strategy.
+        '''
+        return self.get_erased_edges_of_sites(np.flatnonzero(np.asarray(flags, dtype=bool)), paulis)
+
+    def get_site_edge_matrix(self, paulis: str = 'XZ') -> csr_matrix:
+        '''
+        (num_sites, num_edges) the edges get_erased_edges selects for every site on its own,
+            so that flags @ matrix gives the erased edges of many shots at once.
+        '''
+        sites = np.arange(self.num_sites)
+        p_x = self.conditional_pauli_probabilities[:, 0] + self.conditional_pauli_probabilities[:, 1]
+        p_z = self.conditional_pauli_probabilities[:, 2] + self.conditional_pauli_probabilities[:, 1]
+        rows, cols = [], []
+        if 'X' in paulis:
+            keep = (p_x > 0) & (self.x_edges >= 0)
+            rows.append(sites[keep]), cols.append(self.x_edges[keep])
+        if 'Z' in paulis:
+            keep = (p_z > 0) & (self.z_edges >= 0)
+            rows.append(sites[keep]), cols.append(self.z_edges[keep])
+        rows, cols = np.concatenate(rows), np.concatenate(cols)
+        num_edges = max(int(np.max(self.x_edges, initial=-1)), int(np.max(self.z_edges, initial=-1))) + 1
+        matrix = csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)), shape=(self.num_sites, num_edges))
+        matrix.sum_duplicates()
+        return matrix
+
+    def get_erased_edges_of_sites(self, sites, paulis: str = 'XZ') -> np.ndarray:
+        # get_erased_edges from the indices of the flagged sites, for sparse shots
+        sites = np.asarray(sites, dtype=int)
+        p_x = self.conditional_pauli_probabilities[sites, 0] + self.conditional_pauli_probabilities[sites, 1]
+        p_z = self.conditional_pauli_probabilities[sites, 2] + self.conditional_pauli_probabilities[sites, 1]
+        erased = []
+        if 'X' in paulis:
+            erased.append(self.x_edges[sites[p_x > 0]])
+        if 'Z' in paulis:
+            erased.append(self.z_edges[sites[p_z > 0]])
+        erased = np.concatenate(erased)
+        return np.unique(erased[erased >= 0])
+
+
+def get_erasure_site_table(erasure_circuit: stim.Circuit,
+                           first_ancilla_qubit_index: int,
+                           static_graph: Optional[StaticMatchingGraph] = None) -> ErasureSiteTable:
+    '''
+    Scan the erasure circuit once for PAULI_CHANNEL_2 instructions acting on (data, virtual ancilla) pairs
+        and propagate an X and a Z error at every site in a single FlipSimulator batch.
+    '''
+    circuit = erasure_circuit.flattened()
+    ancilla_to_site = {}
+    data_qubits, ticks, herald_probabilities, conditional = [], [], [], []
+    faults_after_instruction = {}
+    tick = 0
+    num_measurements = 0
+    measurement_indices = {}
+    for index, instruction in enumerate(circuit):
+        name = instruction.name
+        if name == 'TICK':
+            tick += 1
+        elif stim.gate_data(name).produces_measurements:
+            for t in instruction.targets_copy():
+                if t.qubit_value in ancilla_to_site:
+                    measurement_indices[ancilla_to_site[t.qubit_value]] = num_measurements
+                num_measurements += 1
+        elif name == 'PAULI_CHANNEL_2':
+            targets = [t.qubit_value for t in instruction.targets_copy()]
+            if targets[1] < first_ancilla_qubit_index:
+                continue
+            args = instruction.gate_args_copy()
+            p_herald = sum(args[i] for i in HERALDED_PAULI_CHANNEL_2_ARG_INDICES.values())
+            p_given_herald = [args[HERALDED_PAULI_CHANNEL_2_ARG_INDICES[P]] / p_herald if p_herald > 0 else 0
+                              for P in 'XYZ']
+            faults = []
+            for data, ancilla in zip(targets[0::2], targets[1::2]):
+                site = len(data_qubits)
+                ancilla_to_site[ancilla] = site
+                data_qubits.append(data)
+                ticks.append(tick)
+                herald_probabilities.append(p_herald)
+                conditional.append(p_given_herald)
+                faults.append((2 * site, 'X', [data]))
+                faults.append((2 * site + 1, 'Z', [data]))
+            faults_after_instruction[index] = faults
+
+    num_sites = len(data_qubits)
+    assert len(measurement_indices) == num_sites, "every virtual erasure ancilla should be measured once"
+    detector_flips, observable_flips = simulate_fault_signatures(circuit, faults_after_instruction, 2 * num_sites)
+    observable_flips = observable_flips[:, 0] if observable_flips.shape[1] > 0 else np.zeros(2 * num_sites, dtype=bool)
+
+    table = ErasureSiteTable(
+        measurement_indices=np.array([measurement_indices[s] for s in range(num_sites)], dtype=int),
+        data_qubits=np.array(data_qubits, dtype=int),
+        ticks=np.array(ticks, dtype=int),
+        herald_probabilities=np.array(herald_probabilities, dtype=float),
+        conditional_pauli_probabilities=np.array(conditional, dtype=float).reshape(-1, 3),
+        x_detectors=detector_flips[0::2],
+        z_detectors=detector_flips[1::2],
+        x_observable_flips=observable_flips[0::2],
+        z_observable_flips=observable_flips[1::2],
+    )
+    if static_graph is not None:
+        table.attach_static_graph(static_graph)
+    return table
+
+
+# Outcome k of a channel on a qubit pair (0 = II, then the 15 args of PAULI_CHANNEL_2 in stim's order IX, IY, IZ, XI, ...)
+#   is Pauli k // 4 on the first qubit and k % 4 on the second one, with 0 = I, 1 = X, 2 = Y, 3 = Z.
+# For an erasure channel the second qubit is the virtual ancilla, measured in the Z basis, so an X or Y on it raises the flag.
+_OUTCOME_IS_FLAGGED = np.isin(np.arange(16) % 4, [1, 2])
+
+# The non-heralded channels ErasureFirstSampler can draw itself (explicit_pauli_channels), as outcome probabilities
+_PAULI_CHANNEL_OUTCOMES = {
+    'DEPOLARIZE1': lambda args: [0, 0, 0, 0] + [args[0] / 3, 0, 0, 0] * 3,
+    'DEPOLARIZE2': lambda args: [0] + [args[0] / 15] * 15,
+    'PAULI_CHANNEL_1': lambda args: [0, 0, 0, 0, args[0], 0, 0, 0, args[1], 0, 0, 0, args[2], 0, 0, 0],
+    'PAULI_CHANNEL_2': lambda args: [0] + list(args),
+    'X_ERROR': lambda args: [0, 0, 0, 0, args[0]] + [0] * 11,
+    'Y_ERROR': lambda args: [0] * 8 + [args[0]] + [0] * 7,
+    'Z_ERROR': lambda args: [0] * 12 + [args[0], 0, 0, 0],
+}
+
+
+@dataclass
+class NoiseChannelBlock:
+    # One noise instruction of the erasure circuit that ErasureFirstSampler draws itself, a "location" per qubit or qubit pair
+    instruction_index: int
+    locations: np.ndarray  # fault 4 * location + k is X, Z on the first qubit, X, Z on the second one
+    flag_columns: Optional[np.ndarray]  # column of every location in the flags of stage 1, None for non-heralded channels
+    probabilities: np.ndarray  # (16,) outcome probabilities, outcome 0 filled in
+    flag_probability: float
+    cdf_given_flag: np.ndarray  # (2, 16) cumulative distributions of the non-trivial outcomes, unflagged and flagged
+    unflagged_error_probability: float  # probability of a non-trivial outcome without a flag
+
+
+def gen_noise_channel_block(instruction_index, locations, flag_columns, outcome_probabilities) -> NoiseChannelBlock:
+    probabilities = np.array(outcome_probabilities, dtype=float)
+    probabilities[0] = 1 - probabilities[1:].sum()
+    flag_probability = float(probabilities[_OUTCOME_IS_FLAGGED].sum()) if flag_columns is not None else 0
+    flagged_outcomes = _OUTCOME_IS_FLAGGED if flag_columns is not None else np.zeros(16, dtype=bool)
+    # Without a flag the outcome is mostly II, so only the non-trivial outcomes get a distribution:
+    #   row 0 is the unflagged outcomes given that one happened, row 1 the flagged ones (never II).
+    unflagged = np.where(flagged_outcomes, 0, probabilities)
+    unflagged[0] = 0
+    flagged = np.where(flagged_outcomes, probabilities, 0)
+    cdf_given_flag = np.zeros((2, 16))
+    for row, conditional in enumerate([unflagged, flagged]):
+        if conditional.sum() > 0:
+            cdf_given_flag[row] = np.cumsum(conditional / conditional.sum())
+        cdf_given_flag[row, -1] = 1  # rounding
+    unflagged_error_probability = unflagged.sum() / (1 - flag_probability) if flag_probability < 1 else 0
+    return NoiseChannelBlock(instruction_index=instruction_index, locations=np.asarray(locations), flag_columns=flag_columns,
+                             probabilities=probabilities, flag_probability=flag_probability, cdf_given_flag=cdf_given_flag,
+                             unflagged_error_probability=float(unflagged_error_probability))
+
+
+def scan_noise_channels(circuit: stim.Circuit,
+                        first_ancilla_qubit_index: int,
+                        explicit_pauli_channels: bool = False):
+    '''
+    Find the erasure channels (PAULI_CHANNEL_2 on (data, virtual ancilla) pairs) of a flattened erasure circuit,
+        and with explicit_pauli_channels also the non-heralded Pauli channels.
+    Returns the blocks in circuit order, the faults to propagate (see simulate_fault_signatures) and the circuit without those channels.
+    '''
+    blocks: List[NoiseChannelBlock] = []
+    faults_after_instruction = {}
+    rest = stim.Circuit()
+    num_locations, num_flags = 0, 0
+    for index, instruction in enumerate(circuit):
+        targets = [t.qubit_value for t in instruction.targets_copy()]
+        is_erasure = instruction.name == 'PAULI_CHANNEL_2' and targets[1] >= first_ancilla_qubit_index
+        if not is_erasure and not (explicit_pauli_channels and instruction.name in _PAULI_CHANNEL_OUTCOMES):
+            rest.append(instruction)
+            continue
+        num_qubits = 2 if instruction.name.endswith('2') else 1
+        groups = [targets[i:i + num_qubits] for i in range(0, len(targets), num_qubits)]
+        locations = np.arange(num_locations, num_locations + len(groups))
+        flag_columns = np.arange(num_flags, num_flags + len(groups)) if is_erasure else None
+        blocks.append(gen_noise_channel_block(index, locations, flag_columns,
+                                              _PAULI_CHANNEL_OUTCOMES[instruction.name](instruction.gate_args_copy())))
+        faults_after_instruction[index] = [(4 * location + 2 * position + k, pauli, [qubit])
+                                           for location, qubits in zip(locations, groups)
+                                           for position, qubit in enumerate(qubits)
+                                           for k, pauli in enumerate('XZ')]
+        num_locations += len(groups)
+        num_flags += len(groups) if is_erasure else 0
+    return blocks, faults_after_instruction, rest
+
+
+def peel(static_graph: StaticMatchingGraph,
+         erased_edges: np.ndarray,
+         fired_detectors: np.ndarray) -> List[int]:
+    '''
+    Peeling decoder for pure erasure noise, linear in the number of erased edges:
+    grow a spanning forest of the erased edges (rooted at the boundary node whenever a tree reaches it),
+    then peel leaves towards the roots, keeping an edge whenever the leaf it removes is flipped.
+    Returns the static graph edge indices of the correction.
+    '''
+    boundary = static_graph.boundary
+    adjacency: Dict[int, List[Tuple[int, int]]] = {}
+    for e in erased_edges:
+        u, v = static_graph.edges[e]
+        adjacency.setdefault(int(u), []).append((int(v), int(e)))
+        adjacency.setdefault(int(v), []).append((int(u), int(e)))
+
+    flipped = set(int(v) for v in fired_detectors)
+    correction = []
+    visited = set()
+    roots = ([boundary] if boundary in adjacency else []) + list(adjacency)
+    for root in roots:
+        if root in visited:
+            continue
+        # Breadth first search gives the spanning tree, the reversed visiting order peels leaves first
+        visited.add(root)
+        order = [root]
+        parent_edge = {root: (None, None)}
+        head = 0
+        while head < len(order):
+            u = order[head]
+            head += 1
+            for v, e in adjacency[u]:
+                if v not in visited:
+                    visited.add(v)
+                    parent_edge[v] = (u, e)
+                    order.append(v)
+        for v in reversed(order[1:]):
+            if v in flipped:
+                u, e = parent_edge[v]
+                correction.append(e)
+                flipped.discard(v)
+                if u in flipped:
+                    flipped.discard(u)
+                else:
+                    flipped.add(u)
+        flipped.discard(boundary)
+    return correction
+
+
+@dataclass
+class UnionFindDecoder:
+    """
+    Weighted Union-Find decoder on a StaticMatchingGraph.
+    Every odd cluster (odd number of fired detectors and not touching the boundary) grows all of its edges at the same speed,
+    an edge joins the clusters at its ends once it has grown by its 'S'/'L' weight, and erased edges start fully grown.
+    The growth jumps straight to the next edge completion, so real valued weights need no quantization.
+    When no odd cluster is left, the grown edges are peeled to get the correction.
+    """
+    static_graph: StaticMatchingGraph
+    curve: str = 'S'
+
+    def __post_init__(self):
+        g = self.static_graph
+        self.weights = np.maximum(g.get_weights(self.curve), 0).tolist()
+        # Incident edges of every node, plain python lists are the fastest to index in the growth loop
+        endpoints = np.concatenate([g.edges[:, 0], g.edges[:, 1]])
+        edge_ids = np.concatenate([np.arange(g.num_edges), np.arange(g.num_edges)])
+        order = np.argsort(endpoints, kind='stable')
+        offsets = np.searchsorted(endpoints[order], np.arange(g.num_detectors + 2))
+        incident = edge_ids[order]
+        self.incident_edges = [incident[offsets[v]:offsets[v + 1]].tolist() for v in range(g.num_detectors + 1)]
+        self.edge_list = [tuple(e) for e in g.edges.tolist()]
+
+    def get_correction(self, fired_detectors, erased_edges=()) -> List[int]:
+        boundary = self.static_graph.boundary
+        # The disjoint sets only hold the nodes touched so far, so the cost scales with the syndrome and not the graph
+        parent: Dict[int, int] = {}
+        vertices: Dict[int, List[int]] = {}
+        odd: Dict[int, bool] = {}
+
+        def find(v):
+            root = v
+            while parent.get(root, root) != root:
+                root = parent[root]
+            while v != root:
+                parent[v], v = root, parent[v]
+            return root
+
+        def union(u, v):
+            ru, rv = find(u), find(v)
+            if ru == rv:
+                return
+            if len(vertices.get(ru, ())) < len(vertices.get(rv, ())):
+                ru, rv = rv, ru
+            parent[rv] = ru
+            vertices.setdefault(ru, [ru]).extend(vertices.pop(rv, [rv]))
+            odd[ru] = odd.pop(ru, False) ^ odd.pop(rv, False)
+
+        fired_detectors = [int(v) for v in fired_detectors]
+        for v in fired_detectors:
+            vertices[v] = [v]
+            odd[v] = True
+        grown = set()
+        for e in erased_edges:
+            e = int(e)
+            grown.add(e)
+            union(*self.edge_list[e])
+
+        support: Dict[int, float] = {}
+        while True:
+            boundary_root = find(boundary)
+            active = [r for r, is_odd in odd.items() if is_odd and r != boundary_root]
+            if not active:
+                break
+            rate: Dict[int, int] = {}
+            for r in active:
+                for v in vertices[r]:
+                    for e in self.incident_edges[v]:
+                        if e in grown:
+                            continue
+                        u, w = self.edge_list[e]
+                        if find(u) == find(w):
+                            continue
+                        rate[e] = rate.get(e, 0) + 1
+            if not rate:
+                break
+            step = min((self.weights[e] - support.get(e, 0)) / k for e, k in rate.items())
+            completed = []
+            for e, k in rate.items():
+                support[e] = support.get(e, 0) + step * k
+                if support[e] >= self.weights[e] - 1e-12:
+                    completed.append(e)
+            for e in completed:
+                grown.add(e)
+                union(*self.edge_list[e])
+        return peel(self.static_graph, np.fromiter(grown, dtype=int, count=len(grown)), fired_detectors)
+
+    def decode(self, single_detector_sample, erased_edges=()) -> bool:
+        return self.decode_fired(np.flatnonzero(single_detector_sample), erased_edges)
+
+    def decode_fired(self, fired_detectors, erased_edges=()) -> bool:
+        correction = self.get_correction(fired_detectors, erased_edges)
+        return bool(np.bitwise_xor.reduce(self.static_graph.observable_flips[correction].astype(np.uint8), initial=0))
+
+
+@dataclass
+class SlidingWindowDecoder:
+    """
+    Overlapping-window matching for memory experiments with many more rounds than the distance.
+    A window holds the detectors of commit_rounds + buffer_rounds consecutive rounds and is matched with its erased edges at probability 1/2.
+    The correction edges that start in the first commit_rounds rounds are committed, their detector flips are carried
+        into the syndrome of the later rounds, and the next window starts where the committed part ended.
+    Edges leaving the top of a window become boundary edges of the window, edges into the committed past are left out.
+    The windows are cut from the StaticMatchingGraph and ErasureSiteTable of a short memory circuit with the same round structure
+        (see builder.get_sliding_window_decoder), never from the decoded circuit: a bulk window is the same graph in every round,
+        only shifted by detectors_per_round detectors and flags_per_round flag columns, so it's matched with one Matching.
+        The windows next to the first and last rounds get their own. Memory is then constant in num_rounds, ~ a few windows.
+    Windows are counted in detector rounds (the time coordinate), the circuit is assumed round-major in detectors and flags.
+    """
+    static_graph: StaticMatchingGraph  # of the short circuit
+    detector_rounds: np.ndarray  # round (time coordinate) of every detector of the short circuit
+    site_table: ErasureSiteTable  # of the short circuit
+    site_flag_columns: np.ndarray  # flag column (see builder.get_erasure_flag_indices) of every site of site_table
+    num_rounds: int  # detector rounds of the decoded circuit
+    num_detectors: int  # of the decoded circuit
+    num_flags: int  # of the decoded circuit
+    commit_rounds: int
+    buffer_rounds: int
+    curve: str = 'S'
+
+    def __post_init__(self):
+        self.detector_rounds = np.asarray(self.detector_rounds, dtype=int)
+        assert np.all(np.diff(self.detector_rounds) >= 0), "detectors must be ordered by round"
+        assert self.commit_rounds >= 1
+        assert self.buffer_rounds >= 1 or self.commit_rounds >= self.num_rounds, "an edge could be committed across the top of a window"
+        self.short_rounds = int(self.detector_rounds.max()) + 1
+        self.round_starts = np.concatenate([[0], np.cumsum(np.bincount(self.detector_rounds, minlength=self.short_rounds))])
+        self.short_num_detectors = int(self.round_starts[-1])
+        self.short_num_flags = len(self.site_flag_columns)
+        self.extra_rounds = self.num_rounds - self.short_rounds
+        self.margin = 2  # the first and last rounds of a memory circuit differ from the bulk, windows this close to them aren't shifted
+        self.bulk_start = self.margin + 1
+        if self.extra_rounds > 0:
+            assert self.short_rounds >= self.commit_rounds + self.buffer_rounds + 2 * self.bulk_start, "the short circuit is too short"
+            self.detectors_per_round = (self.num_detectors - self.short_num_detectors) // self.extra_rounds
+            self.flags_per_round = (self.num_flags - self.short_num_flags) // self.extra_rounds
+            per_round = np.diff(self.round_starts)[self.bulk_start:self.short_rounds - self.bulk_start]
+            assert np.all(per_round == self.detectors_per_round) \
+                and self.short_num_detectors + self.extra_rounds * self.detectors_per_round == self.num_detectors \
+                and self.short_num_flags + self.extra_rounds * self.flags_per_round == self.num_flags, \
+                "the decoded circuit isn't the short circuit with more bulk rounds"
+        g = self.static_graph
+        boundary_edge = g.edges[:, 1] == g.boundary
+        self.rounds_u = self.detector_rounds[g.edges[:, 0]]
+        self.rounds_v = np.where(boundary_edge, self.rounds_u, self.detector_rounds[np.minimum(g.edges[:, 1], g.num_detectors - 1)])
+        self.weights = g.get_weights(self.curve)
+        self.erased_weight = max(float(probability_to_weight(0.5, self.curve)), 0)
+        # Erased edges of every site (X and Z, like decode_by_reweighting(paulis='XZ')), by flag column of the short circuit
+        site_edges = self.site_table.get_site_edge_matrix('XZ').tocsr()
+        self.column_edges: Dict[int, np.ndarray] = {}
+        for site, column in enumerate(self.site_flag_columns):
+            edges = site_edges.indices[site_edges.indptr[site]:site_edges.indptr[site + 1]]
+            if len(edges):
+                self.column_edges[int(column)] = edges
+        self.templates: Dict[Tuple[int, int, int], Dict] = {}
+        self.latency = {'windows': 0, 'rounds': 0, 'time': 0.0, 'max_latency_per_round': 0.0}
+
+    def iter_windows(self):
+        '''
+        (template key, detector offset, flag column offset, committed rounds) of every window of the decoded circuit, in order.
+        The template key is the (start, end, commit_end) rounds of the same window in the short circuit.
+        '''
+        start = 0
+        while True:
+            end = min(start + self.commit_rounds + self.buffer_rounds, self.num_rounds)
+            commit_end = end if end == self.num_rounds else start + self.commit_rounds
+            if self.extra_rounds <= 0 or end <= self.short_rounds - self.bulk_start:
+                shift, detector_offset, flag_offset = 0, 0, 0  # the same rounds as the short circuit
+            elif start >= self.num_rounds - self.short_rounds + self.bulk_start:
+                # Next to the last round, aligned with the end of the short circuit
+                shift, detector_offset, flag_offset = self.extra_rounds, self.num_detectors - self.short_num_detectors, \
+                    self.num_flags - self.short_num_flags
+            else:
+                shift = start - self.bulk_start
+                detector_offset, flag_offset = shift * self.detectors_per_round, shift * self.flags_per_round
+            yield (start - shift, end - shift, commit_end - shift), detector_offset, flag_offset, commit_end - start
+            if end == self.num_rounds:
+                break
+            start = commit_end
+
+    def get_template(self, key) -> Dict:
+        # The matching of the short circuit window key = (start, end, commit_end), built once
+        if key in self.templates:
+            return self.templates[key]
+        g = self.static_graph
+        start, end, commit_end = key
+        detector_start, detector_end = int(self.round_starts[start]), int(self.round_starts[end])
+        num_local = detector_end - detector_start
+        local = -np.ones(g.num_detectors + 1, dtype=int)
+        local[detector_start:detector_end] = np.arange(num_local)
+        local[g.boundary] = num_local
+        in_window = (self.rounds_u >= start) & (self.rounds_v >= start) & (np.minimum(self.rounds_u, self.rounds_v) < end)
+        edge_ids = np.flatnonzero(in_window)
+        local_edges = local[g.edges[edge_ids]]
+        local_edges[local_edges < 0] = num_local  # the far end is above the window
+        matching = pymatching.Matching()
+        static_weights = {}
+        for (u, v), w in zip(local_edges.tolist(), np.maximum(self.weights[edge_ids], 0).tolist()):
+            if v == num_local:
+                matching.add_boundary_edge(u, weight=w, merge_strategy='smallest-weight')
+            else:
+                matching.add_edge(u, v, weight=w, merge_strategy='smallest-weight')
+            static_weights[(u, v)] = min(w, static_weights.get((u, v), w))
+        # Correction edges come back from pymatching as detector pairs, only the committed ones need to be looked up
+        lookup = {}
+        for e, (u, v) in zip(edge_ids.tolist(), local_edges.tolist()):
+            if min(self.rounds_u[e], self.rounds_v[e]) < commit_end:
+                lookup[(min(u, v), max(u, v))] = (bool(g.observable_flips[e]), u, v)
+        local_pair = {int(e): (int(u), int(v)) for e, (u, v) in zip(edge_ids, local_edges)}
+        column_pairs = {column: [local_pair[e] for e in edges if e in local_pair] for column, edges in self.column_edges.items()}
+        column_pairs = {column: pairs for column, pairs in column_pairs.items() if pairs}
+        columns = np.array(sorted(column_pairs), dtype=int)
+        self.templates[key] = {'detector_start': detector_start, 'num_local': num_local, 'matching': matching,
+                               'commit_detectors': int(self.round_starts[commit_end]) - detector_start,
+                               'static_weights': static_weights, 'lookup': lookup, 'column_pairs': column_pairs,
+                               'first_column': int(columns.min(initial=0)), 'end_column': int(columns.max(initial=-1)) + 1}
+        return self.templates[key]
+
+    def _set_weights(self, matching, num_local, pairs, weights):
+        for (u, v), w in zip(pairs, weights):
+            if v == num_local:
+                matching.add_boundary_edge(u, weight=w, merge_strategy='replace')
+            else:
+                matching.add_edge(u, v, weight=w, merge_strategy='replace')
+
+    def decode_fired(self, fired_detectors, raised_flags=()) -> bool:
+        '''
+        fired_detectors: sorted indices of the fired detectors of the decoded circuit
+        raised_flags: sorted flag columns of its raised erasure flags
+        Returns the parity of the committed corrections on observable 0.
+        '''
+        fired_detectors = np.asarray(fired_detectors, dtype=int)
+        raised_flags = np.asarray(raised_flags, dtype=int)
+        carried = set()  # detector flips of committed edges, in the rounds of later windows
+        predicted_observable = False
+        for key, detector_offset, flag_offset, committed_rounds in self.iter_windows():
+            t0 = time.perf_counter()
+            template = self.get_template(key)
+            num_local = template['num_local']
+            lo = template['detector_start'] + detector_offset
+            hi = lo + num_local
+            window_syndrome = np.zeros(num_local, dtype=np.uint8)
+            a, b = np.searchsorted(fired_detectors, [lo, hi])
+            window_syndrome[fired_detectors[a:b] - lo] ^= 1
+            for detector in [detector for detector in carried if detector < hi]:
+                window_syndrome[detector - lo] ^= 1
+                carried.discard(detector)
+            if window_syndrome.any():
+                matching = template['matching']
+                a, b = np.searchsorted(raised_flags, [template['first_column'] + flag_offset, template['end_column'] + flag_offset])
+                erased = list({pair for column in (raised_flags[a:b] - flag_offset).tolist()
+                               for pair in template['column_pairs'].get(column, ())})
+                # Reweight the erased edges of this window in place, and put the static weights back after matching
+                self._set_weights(matching, num_local, erased, [self.erased_weight] * len(erased))
+                edges = matching.decode_to_edges_array(window_syndrome).tolist()
+                self._set_weights(matching, num_local, erased, [template['static_weights'][pair] for pair in erased])
+                for u, v in edges:
+                    u, v = (num_local if u < 0 else u), (num_local if v < 0 else v)
+                    committed = template['lookup'].get((min(u, v), max(u, v)))
+                    if committed is None:
+                        continue
+                    flips_observable, u, v = committed
+                    predicted_observable ^= flips_observable
+                    # Flips in the committed rounds are used up, the others go to the next windows
+                    carried ^= {lo + w for w in (u, v) if template['commit_detectors'] <= w < num_local}
+            elapsed = time.perf_counter() - t0
+            self.latency['windows'] += 1
+            self.latency['rounds'] += committed_rounds
+            self.latency['time'] += elapsed
+            self.latency['max_latency_per_round'] = max(self.latency['max_latency_per_round'], elapsed / committed_rounds)
+        return bool(predicted_observable)
+
+    def decode(self, single_detector_sample, raised_flags=()) -> bool:
+        return self.decode_fired(np.flatnonzero(single_detector_sample), raised_flags)
+
+    def get_memory_stats(self) -> Dict[str, int]:
+        # What the decoder keeps, independent of num_rounds
+        return {'templates': len(self.templates),
+                'template_edges': sum(len(template['static_weights']) for template in self.templates.values()),
+                'short_graph_edges': self.static_graph.num_edges,
+                'short_rounds': self.short_rounds}
+
+    def get_latency_stats(self) -> Dict[str, float]:
+        # Decoding time per committed round, the figure that has to stay below the round time for real time decoding
+        return {'windows': self.latency['windows'],
+                'mean_latency_per_round': self.latency['time'] / max(self.latency['rounds'], 1),
+                'max_latency_per_round': self.latency['max_latency_per_round']}
+
+
+@dataclass
+class ClusterDecoder:
+    """
+    Pre-decoder that splits a shot into independent clusters and matches each of them on its own small subgraph of a StaticMatchingGraph.
+    Every fired detector grows a ball of radius (in 'S'/'L' weight, erased edges at probability 1/2 like the reweighting decoders),
+        detectors whose balls touch are in the same cluster, and the region of a cluster is the union of its balls.
+        Two detectors closer than 2 radius have their shortest path inside the region, and the balls of different clusters don't touch,
+        so a cluster is matched on its region alone.
+    A cluster that can't be matched in its region (odd and no boundary edge in reach) or whose region is over budget interacts with
+        the rest of the lattice: only the fired detectors of those clusters go to the global matching, the same one
+        decode_by_reweighting(paulis='XZ') uses, the other clusters keep their local corrections.
+    radius: defaults to radius_in_edges times the median edge weight.
+    """
+    static_graph: StaticMatchingGraph
+    curve: str = 'S'
+    radius: Optional[float] = None
+    radius_in_edges: float = 1.5
+    max_region_fraction: float = 0.25  # a cluster whose region has more than this fraction of the detectors goes to the global matching
+    max_exact_cluster_size: int = 6  # clusters this small skip pymatching, see match_small_cluster
+
+    def __post_init__(self):
+        g = self.static_graph
+        weights = np.maximum(g.get_weights(self.curve), 0)
+        self.erased_weight = max(float(probability_to_weight(0.5, self.curve)), 0)
+        if self.radius is None:
+            self.radius = self.radius_in_edges * float(np.median(weights))
+        self.max_region_size = max(int(self.max_region_fraction * g.num_detectors), 1)
+        # (neighbor, edge) and boundary edges of every detector as plain python lists like UnionFindDecoder, the balls are a few edges wide
+        self.weights = weights.tolist()
+        self.neighbors: List[List[Tuple[int, int]]] = [[] for _ in range(g.num_detectors)]
+        self.boundary_edges_of: List[List[int]] = [[] for _ in range(g.num_detectors)]
+        for e, (u, v) in enumerate(g.edges.tolist()):
+            if v == g.boundary:
+                self.boundary_edges_of[u].append(e)
+            else:
+                self.neighbors[u].append((v, e))
+                self.neighbors[v].append((u, e))
+        self.edge_list = [tuple(e) for e in g.edges.tolist()]
+        self.observable_flips = g.observable_flips.tolist()
+        self.global_matchings: Dict[str, pymatching.Matching] = {}
+        self.stats = {'shots': 0, 'local_shots': 0, 'fallbacks': 0, 'clusters': 0, 'fallback_clusters': 0, 'max_cluster_size': 0}
+
+    def get_shot_weights(self, erased_edges=()) -> List[float]:
+        weights = self.weights.copy()
+        for e in erased_edges:
+            weights[e] = self.erased_weight
+        return weights
+
+    def shortest_paths(self, sources, weights, region=None, limit=math.inf) -> Tuple[Dict[int, float], Dict[int, int], Dict[int, int]]:
+        '''
+        Dijkstra from all the sources at once, only through the nodes of region if given and up to limit:
+            the distance to the nearest source, that source and the edge the shortest path arrives by (-1 at a source), by node.
+        '''
+        neighbors, push, pop = self.neighbors, heapq.heappush, heapq.heappop
+        distance, nearest, previous = {}, {}, {}
+        tentative = {s: 0.0 for s in sources}
+        heap = [(0.0, s, s, -1) for s in sources]
+        heapq.heapify(heap)
+        while heap:
+            d, v, s, e = pop(heap)
+            if v in distance:
+                continue
+            distance[v], nearest[v], previous[v] = d, s, e
+            for u, e in neighbors[v]:
+                if u in distance or (region is not None and u not in region):
+                    continue
+                du = d + weights[e]
+                if du <= limit and du < tentative.get(u, math.inf):
+                    tentative[u] = du
+                    push(heap, (du, u, s, e))
+        return distance, nearest, previous
+
+    def get_clusters(self, fired_detectors, weights) -> Dict[int, Dict[str, list]]:
+        '''
+        The 'members' (fired detectors) and 'region' (nodes of its balls) of every cluster, by its root fired detector,
+            and the 'ball' (distance, previous edge) of the nodes of all the balls.
+        '''
+        distance, nearest, previous = self.shortest_paths(fired_detectors, weights, limit=self.radius)
+        parent = {f: f for f in fired_detectors}
+
+        def find(x):
+            while parent[x] != x:
+                parent[x] = parent[parent[x]]
+                x = parent[x]
+            return x
+
+        # A fired detector behind an erased (zero weight) edge can be in the Voronoi cell of another one, they're in the same ball
+        for f in fired_detectors:
+            parent[find(f)] = find(nearest[f])
+        # Balls of two fired detectors touch along an edge between their Voronoi cells
+        touching = {(nearest[u], nearest[v]) for v, dv in distance.items() for u, e in self.neighbors[v]
+                    if u in distance and nearest[u] != nearest[v] and dv + weights[e] + distance[u] <= 2 * self.radius}
+        for a, b in touching:
+            parent[find(a)] = find(b)
+        clusters = {}
+        for f in fired_detectors:
+            clusters.setdefault(find(f), {'members': [], 'region': [], 'ball': (distance, previous)})['members'].append(f)
+        for v, s in nearest.items():
+            clusters[find(s)]['region'].append(v)
+        return clusters
+
+    def match_small_cluster(self, members, region, weights, ball=None) -> Optional[List[int]]:
+        '''
+        Exact matching of a cluster of at most max_exact_cluster_size fired detectors without building a matching graph:
+            the cheapest pairing (or match to the boundary) over the distances inside its region, found by trying them all,
+            then the shortest paths are walked back. Only pairs closer than 2 radius are sure to have their shortest path in the region.
+        ball: the (distance, previous edge) of get_clusters, the region of a single member is its ball so they're its shortest paths.
+        Returns the static graph edge indices of the correction, None if it can't be matched in its region.
+        '''
+        if len(members) == 1 and ball is not None:
+            paths = [({v: ball[0][v] for v in region}, None, ball[1])]
+        else:
+            region = set(region)
+            paths = [self.shortest_paths([f], weights, region, limit=2 * self.radius) for f in members]
+        # Cheapest way to the boundary from every member, through a boundary edge of its region
+        exits = []
+        for distance, _, _ in paths:
+            options = [(distance[v] + weights[e], e) for v in distance for e in self.boundary_edges_of[v]]
+            exits.append(min(options, default=(math.inf, -1)))
+        memo = {}
+
+        def best(remaining):
+            # (cost, [(i, j or -1)]) of the cheapest way to match the tuple of members remaining
+            if not remaining:
+                return 0.0, []
+            if remaining not in memo:
+                i, rest = remaining[0], remaining[1:]
+                cost, pairs = best(rest)
+                options = [(exits[i][0] + cost, [(i, -1)] + pairs)]
+                for k, j in enumerate(rest):
+                    cost, pairs = best(rest[:k] + rest[k+1:])
+                    options.append((paths[i][0].get(members[j], math.inf) + cost, [(i, j)] + pairs))
+                memo[remaining] = min(options, key=lambda option: option[0])
+            return memo[remaining]
+
+        cost, pairs = best(tuple(range(len(members))))
+        if not math.isfinite(cost):
+            return None
+
+        def walk(i, node):
+            # The edges of the shortest path from member i to node
+            edges = []
+            previous = paths[i][2]
+            while previous[node] >= 0:
+                e = previous[node]
+                edges.append(e)
+                a, b = self.edge_list[e]
+                node = b if a == node else a
+            return edges
+
+        correction = []
+        for i, j in pairs:
+            if j >= 0:
+                correction.extend(walk(i, members[j]))
+            else:
+                e = exits[i][1]
+                correction.extend(walk(i, self.edge_list[e][0]) + [e])
+        return correction
+
+    def decode_cluster(self, members, region, weights) -> Optional[List[int]]:
+        # The correction of a bigger cluster from a small matching of its region, None if it's odd without a boundary edge
+        g = self.static_graph
+        local = {v: i for i, v in enumerate(region)}
+        edges = sorted({e for v in region for u, e in self.neighbors[v] if u in local}
+                       | {e for v in region for e in self.boundary_edges_of[v]})
+        endpoints = g.edges[edges]
+        is_boundary = endpoints[:, 1] == g.boundary
+        if len(members) % 2 and not is_boundary.any():
+            return None
+        rows = [local[u] for u in endpoints[:, 0].tolist()] + [local[v] for v in endpoints[~is_boundary, 1].tolist()]
+        cols = np.concatenate([np.arange(len(edges)), np.flatnonzero(~is_boundary)])
+        check_matrix = csc_matrix((np.ones(len(rows), dtype=np.uint8), (rows, cols)), shape=(len(region), len(edges)))
+        matching = pymatching.Matching.from_check_matrix(check_matrix, weights=[weights[e] for e in edges], use_virtual_boundary_node=True)
+        syndrome = np.zeros(len(region), dtype=np.uint8)
+        syndrome[[local[f] for f in members]] = 1
+        return np.asarray(edges)[np.flatnonzero(matching.decode(syndrome))].tolist()
+
+    def get_global_matching(self, erased_edges) -> pymatching.Matching:
+        if len(erased_edges) == 0:
+            if self.curve not in self.global_matchings:
+                self.global_matchings[self.curve] = self.static_graph.to_matching(curve=self.curve)
+            return self.global_matchings[self.curve]
+        return self.static_graph.get_reweighted_matching(self.curve, erased_edges)
+
+    def decode(self, single_detector_sample, erased_edges=()) -> bool:
+        return self.decode_fired(np.flatnonzero(single_detector_sample), erased_edges)
+
+    def decode_fired(self, fired_detectors, erased_edges=(), packed_detectors: Optional[np.ndarray] = None) -> bool:
+        '''
+        decode() from the indices of the fired detectors.
+        packed_detectors: the same shot bit-packed (stim's little-endian layout), handed to the global matching as is
+            when no cluster could be matched locally.
+        '''
+        self.stats['shots'] += 1
+        if len(fired_detectors) == 0:
+            self.stats['local_shots'] += 1
+            return False
+        fired_detectors = [int(f) for f in fired_detectors]
+        erased_edges = np.asarray(erased_edges, dtype=int)
+        weights = self.get_shot_weights(erased_edges.tolist())
+        clusters = self.get_clusters(fired_detectors, weights)
+        self.stats['clusters'] += len(clusters)
+        self.stats['max_cluster_size'] = max([self.stats['max_cluster_size']] + [len(c['members']) for c in clusters.values()])
+        predicted_observable = False
+        leftover = []
+        for cluster in clusters.values():
+            # Every cluster has its own budget, and only the clusters that can't be matched locally go to the global matching
+            correction = None
+            if len(cluster['region']) <= self.max_region_size:
+                if len(cluster['members']) <= self.max_exact_cluster_size:
+                    correction = self.match_small_cluster(cluster['members'], cluster['region'], weights, cluster['ball'])
+                else:
+                    correction = self.decode_cluster(cluster['members'], cluster['region'], weights)
+            if correction is None:
+                leftover.extend(cluster['members'])
+                self.stats['fallback_clusters'] += 1
+                continue
+            for e in correction:
+                predicted_observable ^= self.observable_flips[e]
+        if not leftover:
+            self.stats['local_shots'] += 1
+            return bool(predicted_observable)
+        self.stats['fallbacks'] += 1
+        matching = self.get_global_matching(erased_edges)
+        if packed_detectors is None or len(leftover) < len(fired_detectors):
+            syndrome = np.zeros(self.static_graph.num_detectors, dtype=bool)
+            syndrome[leftover] = True
+            packed_detectors = np.packbits(syndrome, bitorder='little')
+        return bool(predicted_observable ^ matching.decode_batch(packed_detectors[None], bit_packed_shots=True)[0, 0])
+
+    def get_cluster_stats(self) -> Dict[str, float]:
+        shots = max(self.stats['shots'], 1)
+        return {'local_fraction': self.stats['local_shots'] / shots,
+                'fallback_fraction': self.stats['fallbacks'] / shots,
+                'cluster_fallback_fraction': self.stats['fallback_clusters'] / max(self.stats['clusters'], 1),
+                'mean_clusters_per_shot': self.stats['clusters'] / shots,
+                'max_cluster_size': self.stats['max_cluster_size']}
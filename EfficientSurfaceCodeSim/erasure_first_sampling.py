@@ -0,0 +1,199 @@
+from EfficientSurfaceCodeSim.mc_sampling_job import *
+
+
+@dataclass
+class ErasureFirstSampler:
+    """
+    Two-stage sampler of an erasure conversion circuit:
+        1. the erasure flags of all shots are drawn as a (shots, sites) Bernoulli matrix from the herald probabilities,
+        2. the Pauli outcome of every erasure channel is drawn conditioned on its flag, and added to a sample of
+            the circuit without the erasure channels through the precomputed measurement/detector/observable flips of every site.
+    Every site is an independent channel and Pauli frames add up, so P(flag) P(Pauli | flag) is exactly the channel and
+        the joint distribution of flags, measurements, detectors and observables is the one of sampling erasure_circuit directly.
+    The flags are known before anything is decoded, so shots can be grouped by flag pattern and share one posterior graph.
+    explicit_pauli_channels: draw the depolarizing / Pauli channels the same way instead of leaving them to stim,
+        slower but every fault of a shot is then known (see sample_with_counts).
+    """
+    erasure_circuit: stim.Circuit
+    first_ancilla_qubit_index: int
+    reference_sample: Optional[np.ndarray] = None
+    explicit_pauli_channels: bool = False
+
+    def __post_init__(self):
+        circuit = self.erasure_circuit.flattened()
+        self.blocks, faults_after_instruction, self.pauli_circuit = scan_noise_channels(
+            circuit, self.first_ancilla_qubit_index, self.explicit_pauli_channels)
+        self.num_locations = sum(len(block.locations) for block in self.blocks)
+        self.num_sites = sum(len(block.locations) for block in self.blocks if block.flag_columns is not None)
+        self.flag_probabilities = np.zeros(self.num_sites)
+        for block in self.blocks:
+            if block.flag_columns is not None:
+                self.flag_probabilities[block.flag_columns] = block.flag_probability
+        # Whether the counts of sample_with_counts cover every fault, i.e. stim has no noise left to sample
+        self.all_faults_counted = not any(stim.gate_data(instruction.name).is_noisy_gate and any(instruction.gate_args_copy())
+                                          for instruction in self.pauli_circuit)
+        self.detector_flips, self.observable_flips, self.measurement_flips = simulate_fault_signatures(
+            circuit, faults_after_instruction, 4 * self.num_locations, with_measurement_flips=True, bit_packed=True)
+        if self.reference_sample is None:
+            self.reference_sample = self.erasure_circuit.reference_sample()
+        self.converter = self.pauli_circuit.compile_m2d_converter()
+
+    def sample_flags(self, shots: int, rng: np.random.Generator) -> np.ndarray:
+        # Stage 1, (shots, num_sites) bool
+        return rng.random((shots, self.num_sites)) < self.flag_probabilities
+
+    def _sample_outcomes(self, block: NoiseChannelBlock, flags: Optional[np.ndarray], num_shots: int, rng: np.random.Generator):
+        # The (shot, location, outcome, flagged) of every non-trivial outcome of block, drawn given its flags (shots, locations of block)
+        if flags is None:
+            flags = np.zeros((num_shots, len(block.locations)), dtype=bool)
+        shots, columns = np.nonzero(flags)
+        outcomes = np.searchsorted(block.cdf_given_flag[1], rng.random(len(shots)), side='right')
+        flagged = np.ones(len(shots), dtype=bool)
+        if block.unflagged_error_probability > 0:
+            hit = ~flags & (rng.random(flags.shape) < block.unflagged_error_probability)
+            unflagged_shots, unflagged_columns = np.nonzero(hit)
+            shots = np.concatenate([shots, unflagged_shots])
+            columns = np.concatenate([columns, unflagged_columns])
+            outcomes = np.concatenate([outcomes, np.searchsorted(block.cdf_given_flag[0], rng.random(len(unflagged_shots)), side='right')])
+            flagged = np.concatenate([flagged, np.zeros(len(unflagged_shots), dtype=bool)])
+        return shots, block.locations[columns], outcomes, flagged
+
+    def sample_given_flags(self, flags: np.ndarray, rng: np.random.Generator):
+        '''
+        Stage 2: the rest of the shots, one per row of flags.
+        Returns the measurement samples, the detector samples and the actual observables, like MCSampleDecodeJob.sample_shots.
+        '''
+        num_shots = len(flags)
+        sampler = self.pauli_circuit.compile_sampler(seed=int(rng.integers(2**63)), reference_sample=self.reference_sample)
+        meas_samples = sampler.sample(shots=num_shots, bit_packed=True)
+        det_samples, actual_obs_chunk = self.converter.convert(measurements=meas_samples, separate_observables=True, bit_packed=True)
+
+        events = [self._sample_outcomes(block, None if block.flag_columns is None else flags[:, block.flag_columns], num_shots, rng)
+                  for block in self.blocks]
+        self.last_events = events  # read by sample_with_counts
+        shots = np.concatenate([e[0] for e in events])
+        locations = np.concatenate([e[1] for e in events])
+        outcomes = np.concatenate([e[2] for e in events])
+        fault_shots, faults = [], []
+        for k, (paulis, components) in enumerate([(outcomes // 4, (1, 2)), (outcomes // 4, (2, 3)),
+                                                  (outcomes % 4, (1, 2)), (outcomes % 4, (2, 3))]):
+            hit = np.isin(paulis, components)
+            fault_shots.append(shots[hit])
+            faults.append(4 * locations[hit] + k)
+        # XOR the flips of every shot's faults together, sorted by shot so that reduceat does it one shot at a time
+        order = np.argsort(np.concatenate(fault_shots), kind='stable')
+        fault_shots, faults = np.concatenate(fault_shots)[order], np.concatenate(faults)[order]
+        starts = np.flatnonzero(np.r_[True, fault_shots[1:] != fault_shots[:-1]]) if len(faults) else np.zeros(0, dtype=int)
+        for samples, flips in [(meas_samples, self.measurement_flips), (det_samples, self.detector_flips),
+                               (actual_obs_chunk, self.observable_flips)]:
+            if len(starts) and flips.shape[1]:
+                samples[fault_shots[starts]] ^= np.bitwise_xor.reduceat(flips[faults], starts, axis=0)
+
+        meas_samples = np.unpackbits(meas_samples, axis=1, count=self.pauli_circuit.num_measurements, bitorder='little').astype(bool)
+        det_samples = np.unpackbits(det_samples, axis=1, count=self.pauli_circuit.num_detectors, bitorder='little').astype(bool)
+        actual_obs_chunk = np.unpackbits(actual_obs_chunk, axis=1, count=self.pauli_circuit.num_observables, bitorder='little').astype(bool)
+        return meas_samples, det_samples, actual_obs_chunk
+
+    def sample(self, shots: int, seed: Optional[int] = None):
+        rng = np.random.default_rng(seed)
+        return self.sample_given_flags(self.sample_flags(shots, rng), rng)
+
+    def sample_with_counts(self, shots: int, seed: Optional[int] = None):
+        '''
+        Like sample(), followed by the number of flagged and unflagged non-trivial outcomes of every block in every shot,
+            two (shots, num_blocks) arrays.
+        '''
+        samples = self.sample(shots, seed)
+        flagged_counts = np.zeros((shots, len(self.blocks)), dtype=np.int32)
+        unflagged_counts = np.zeros((shots, len(self.blocks)), dtype=np.int32)
+        for b, (event_shots, _, _, flagged) in enumerate(self.last_events):
+            flagged_counts[:, b] = np.bincount(event_shots[flagged], minlength=shots)
+            unflagged_counts[:, b] = np.bincount(event_shots[~flagged], minlength=shots)
+        self.last_events = None
+        return (*samples, flagged_counts, unflagged_counts)
+
+
+def get_erasure_first_sampler(builder: easure_circ_builder,
+                              reference_sample: Optional[np.ndarray] = None,
+                              explicit_pauli_channels: bool = False) -> ErasureFirstSampler:
+    # Kept on the builder, so warm artifacts (see worker_pool.py) only scan the circuit once
+    samplers = builder.__dict__.setdefault('erasure_first_samplers', {})
+    if explicit_pauli_channels not in samplers:
+        assert not builder.has_correlated_erasure(), "correlated erasures are CORRELATED_ERROR chains, they can't be sampled flags first"
+        samplers[explicit_pauli_channels] = ErasureFirstSampler(erasure_circuit=builder.erasure_circuit,
+                                                                first_ancilla_qubit_index=2 * (builder.distance + 1) ** 2,
+                                                                reference_sample=reference_sample,
+                                                                explicit_pauli_channels=explicit_pauli_channels)
+    return samplers[explicit_pauli_channels]
+
+
+def decode_by_flag_pattern(builder: easure_circ_builder, det_samples, curve, meas_samples, decoder: str = 'auto'):
+    '''
+    Group the shots by erasure flag pattern and decode every group with one graph:
+        'new_circ' builds the posterior matching once per pattern and batch decodes the group,
+        the batch decoders group by themselves, the other decoders share the per pattern products (see decode_by_strategies).
+    Returns the predicted observable of every shot and the grouping statistics.
+    '''
+    decoder_name = builder.resolve_decoder_name(decoder)
+    det_samples = np.asarray(det_samples, dtype=bool)
+    flags = np.asarray(meas_samples)[:, builder.get_erasure_flag_indices()]
+    patterns, first, inverse, counts = np.unique(np.packbits(flags, axis=1), axis=0,
+                                                 return_index=True, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+    stats = {'shots': len(det_samples), 'patterns': len(patterns), 'largest_group': int(counts.max(initial=0))}
+
+    decode_batch = builder.get_batch_decoder(decoder_name)
+    if decode_batch is not None:
+        return np.asarray(decode_batch(det_samples, curve, meas_samples), dtype=bool), stats
+    decode = builder.get_decoder(decoder_name)
+    predictions = np.zeros(len(det_samples), dtype=bool)
+    for k in range(len(patterns)):
+        shots = np.flatnonzero(inverse == k)
+        shots = shots[det_samples[shots].any(axis=1)]  # no detection event, nothing to correct
+        if len(shots) == 0:
+            continue
+        if decoder_name == 'new_circ':
+            matching = builder.gen_posterior_matching(meas_samples[first[k]], curve)
+            if matching.num_fault_ids > 0:
+                predictions[shots] = matching.decode_batch(det_samples[shots])[:, 0]
+            continue
+        shared = {}
+        for i in shots:
+            predictions[i] = decode(det_samples[i], curve, meas_samples[i], shared)
+    return predictions, stats
+
+
+@dataclass
+class MCErasureFirstSampleDecodeJob(MCSampleDecodeJob):
+    """
+    MCSampleDecodeJob sampled with ErasureFirstSampler, and decoded one flag pattern at a time (see decode_by_flag_pattern).
+    The result gets a 'groups' entry with the number of distinct patterns.
+    explicit_pauli_channels: the sampler draws the Pauli channels too, so the shot records count every fault and can be reweighted in p_p.
+    """
+    explicit_pauli_channels: bool = False
+
+    def sample_shots(self, builder, shots, seed = None, reference_sample = None, converter = None):
+        sampler = get_erasure_first_sampler(builder, reference_sample, self.explicit_pauli_channels)
+        meas_samples, det_samples, actual_obs_chunk, *self.block_counts = sampler.sample_with_counts(shots, seed)
+        return meas_samples, det_samples, actual_obs_chunk
+
+    def predict(self, builder, meas_samples, det_samples,
+                prediction_caches: Optional[Dict[str, PredictionCache]] = None, print_progress = False):
+        decoder_name = builder.resolve_decoder_name(self.decoder)
+        predictions, stats = decode_by_flag_pattern(builder, det_samples, 'S', meas_samples, decoder_name)
+        previous = getattr(self, 'group_stats', None) or {'shots': 0, 'patterns': 0, 'largest_group': 0}
+        self.group_stats = {'shots': previous['shots'] + stats['shots'], 'patterns': previous['patterns'] + stats['patterns'],
+                            'largest_group': max(previous['largest_group'], stats['largest_group'])}
+        return decoder_name, predictions, None
+
+    def get_shot_records(self, builder, meas_samples, failed, decoder_name) -> ShotRecords:
+        flagged_counts, unflagged_counts = self.block_counts
+        return gen_shot_records(builder, failed, flagged_counts, unflagged_counts, self.explicit_pauli_channels,
+                                decoder_name, self.p_e, self.p_p, self.biased_erasure)
+
+    def sample_and_print_result(self,print_progress = False, artifacts: Optional[CompiledArtifacts] = None):
+        assert not self.sparse, "the erasure first sampler draws dense shots, group them by flag pattern instead"
+        self.group_stats = {}
+        result = super().sample_and_print_result(print_progress=print_progress, artifacts=artifacts)
+        result['groups'] = self.group_stats
+        return result
@@ -1,4 +1,5 @@
 from EfficientSurfaceCodeSim.instruction_generators import *
+from itertools import product
 
 
 
@@ -131,6 +132,92 @@ class GateErrorModel:
 
 
 
+# Paulis as (x, z) bits, so that composing two Paulis (up to a phase) is a XOR of their indices
+PAULI_TO_XZ_INDEX = {'I': 0, 'X': 2, 'Y': 3, 'Z': 1}
+XZ_INDEX_TO_PAULI = {v: k for k, v in PAULI_TO_XZ_INDEX.items()}
+
+
+def mechanism_to_pauli_distribution(mechanism: ErrorMechanism) -> np.ndarray:
+    '''
+    The distribution of the Pauli a non-heralded mechanism applies, indexed by the concatenated (x, z) bits of its qubits.
+    '''
+    distribution = np.zeros(4 ** mechanism.num_qubits)
+    for mqe in mechanism.normal_generator.list_of_MQE:
+        index = 0
+        for sqe in mqe.list_of_SQE:
+            index = index * 4 + PAULI_TO_XZ_INDEX[sqe.type]
+        distribution[index] += mqe.p
+    return distribution
+
+
+def compose_pauli_distributions(first: np.ndarray, second: np.ndarray) -> np.ndarray:
+    # Exact composition of two independent Pauli channels, a XOR-convolution over the Pauli indices
+    indices = np.arange(len(first))
+    composed = np.zeros(len(first))
+    for index, p in enumerate(second):
+        if p > 0:
+            composed[indices ^ index] += first * p
+    return composed
+
+
+def get_fused_mechanism(mechanisms: List[ErrorMechanism]) -> ErrorMechanism:
+    '''
+    One mechanism, emitted as a single PAULI_CHANNEL_1 or PAULI_CHANNEL_2, that samples the same Pauli as all the independent
+        non-heralded mechanisms together.
+    '''
+    num_qubits = mechanisms[0].num_qubits
+    assert num_qubits in [1, 2] and all(mechanism.num_qubits == num_qubits for mechanism in mechanisms)
+    assert not any(mechanism.is_erasure for mechanism in mechanisms), "heralded mechanisms can't be fused"
+    distribution = mechanism_to_pauli_distribution(mechanisms[0])
+    for mechanism in mechanisms[1:]:
+        distribution = compose_pauli_distributions(distribution, mechanism_to_pauli_distribution(mechanism))
+
+    list_of_MQE = []
+    # stim orders the PAULI_CHANNEL arguments as IX IY IZ XI ... i.e. by I=0 X=1 Y=2 Z=3 on each qubit
+    stim_order = [''.join(paulis) for paulis in product('IXYZ', repeat=num_qubits)][1:]
+    args = []
+    for paulis in ['I' * num_qubits] + stim_order:
+        index = 0
+        for P in paulis:
+            index = index * 4 + PAULI_TO_XZ_INDEX[P]
+        p = float(distribution[index])
+        if paulis != 'I' * num_qubits:
+            args.append(p)
+        if p > 0 or paulis == 'I' * num_qubits:
+            list_of_MQE.append(MQE(p, [SQE(P, False) for P in paulis]))
+    p_nontrivial = sum(args)
+    instruction_name = 'PAULI_CHANNEL_1' if num_qubits == 1 else 'PAULI_CHANNEL_2'
+    normal_generator = NormalInsGenerator(
+            list_of_MQE = list_of_MQE,
+            instruction_name = instruction_name,
+            instruction_arg = args)
+    deterministic_generator = DeterministicInsGenerator(
+            list_of_MQE = list_of_MQE,
+            num_dice = 1,
+            instruction_name = instruction_name,
+            instruction_arg = [p / p_nontrivial if p_nontrivial > 0 else 0 for p in args],
+        )
+    return ErrorMechanism(
+        normal_generator = normal_generator,
+        deterministic_generator = deterministic_generator,
+        name = 'fused(' + ', '.join(mechanism.name for mechanism in mechanisms) + ')'
+        )
+
+
+def fuse_error_model(error_model: GateErrorModel) -> GateErrorModel:
+    '''
+    Compile pass: the same GateErrorModel with all of its non-heralded mechanisms merged into one channel per gate layer.
+        The sampled distribution doesn't change, the circuit, its DEM and the posterior circuits get fewer instructions.
+    '''
+    if error_model.trivial:
+        return error_model
+    fusable = [mechanism for mechanism in error_model.list_of_mechanisms
+               if not mechanism.is_erasure and mechanism.num_qubits <= 2 and mechanism.normal_generator.vectorizable]
+    if len(fusable) < 2:
+        return error_model
+    others = [mechanism for mechanism in error_model.list_of_mechanisms if mechanism not in fusable]
+    return GateErrorModel([get_fused_mechanism(fusable)] + others)
+
 
 def get_1q_depolarization_mechanism(p_p):
     list_of_MQE=  [   
@@ -405,15 +492,64 @@ def get_2q_erasure_mechanism(p_e):
         name = '2q erasure unbiased'
         )
 
+def get_2q_correlated_erasure_mechanism(p_e):
+    '''
+    A failed gate erases both qubits at once, as in PHYSICAL REVIEW X 13, 041013 (2023), and leaves each of them with a Z error half of the time.
+    The herald is correlated across the two qubits, so the erasure conversion circuit needs CORRELATED_ERROR chains.
+    '''
+    list_of_MQE=  [   
+                MQE(1- p_e,[SQE("I",False),SQE("I",False)]), # no detection cases
+
+                MQE(p_e/4,[SQE("I",True),SQE("I",True)]), # Two qubit detection cases
+                MQE(p_e/4,[SQE("I",True),SQE("Z",True)]),
+                MQE(p_e/4,[SQE("Z",True),SQE("I",True)]),
+                MQE(p_e/4,[SQE("Z",True),SQE("Z",True)]),
+            ]
+    normal_generator = NormalInsGenerator(
+        list_of_MQE = list_of_MQE,
+        instruction_name ='PAULI_CHANNEL_2',
+        instruction_arg = [
+                # ix iy iz
+                0, 0, p_e / 4,
+                # xi xx xy xz
+                0, 0, 0, 0,
+                # yi yx yy yz
+                0, 0, 0, 0,
+                # zi zx zy zz
+                p_e / 4, 0, 0, p_e / 4
+            ])
+    erasure_generator = ErasureInsGenerator(
+        list_of_MQE = list_of_MQE,
+        )
+    posterior_generator = PosteriorInsGenerator(
+            list_of_MQE = list_of_MQE
+            )
+    deterministic_generator = DeterministicInsGenerator(
+            list_of_MQE = list_of_MQE,
+            num_dice = 1,
+            instruction_name = 'PAULI_CHANNEL_2',
+            instruction_arg = [0, 0, 1/4, 0, 0, 0, 0, 0, 0, 0, 0, 1/4, 0, 0, 1/4],
+        )
+    return ErrorMechanism(
+        normal_generator = normal_generator,
+        erasure_generator=erasure_generator,
+        posterior_generator = posterior_generator,
+        deterministic_generator = deterministic_generator,
+        name = '2q correlated erasure'
+        )
+
 def get_2q_error_model(p_p,
                        p_e,
                        p_z_shift = 0,
-                       biased=True):
+                       biased=True,
+                       correlated=False):
     mechanism_list = [get_2q_depolarization_mechanism(p_p)]
     if p_z_shift>0:
         mechanism_list.append(get_2q_differential_shift_mechanism(p_z_shift))
     if p_e>0:
-        if biased:
+        if correlated:
+            mechanism_list.append(get_2q_correlated_erasure_mechanism(p_e))
+        elif biased:
             mechanism_list.append(get_2q_biased_erasure_mechanism(p_e))
         else:
             mechanism_list.append(get_2q_erasure_mechanism(p_e))
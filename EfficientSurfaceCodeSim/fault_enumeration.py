@@ -0,0 +1,265 @@
+from EfficientSurfaceCodeSim.circuit_builder import *
+from itertools import combinations, product
+
+
+@dataclass
+class FaultLocations:
+    """
+    The dice of one ErrorMechanism, in the same order as DeterministicInsGenerator numbers them,
+    with every way the dice can come up ("branches") and the syndrome signature of each branch.
+    """
+    mechanism_name: str
+    qubits: List[Tuple[int, ...]]                # qubits covered by each dice
+    injection_indices: List[int]                 # the fault happens right after this instruction of the erasure circuit
+    flag_measurement_indices: Optional[np.ndarray]  # erasure flag of each dice in a measurement sample, None if not heralded
+    branch_paulis: List[List[str]]               # per dice, the Pauli strings it can apply
+    branch_probabilities: np.ndarray             # (num_dice, max_branches), zero padded
+    signatures: Optional[np.ndarray] = None      # (num_dice, max_branches, num_detector_bytes) bit packed detector flips
+    observable_flips: Optional[np.ndarray] = None  # (num_dice, max_branches) bool
+    fault_columns: Optional[np.ndarray] = None   # (num_dice, max_branches) column of each branch in the FlipSimulator batch, -1 for padding
+
+    def __post_init__(self):
+        self.num_dice = len(self.qubits)
+        self.is_heralded = self.flag_measurement_indices is not None
+
+
+def get_dice_branches(mechanism: ErrorMechanism, dice_index: int) -> List[Tuple[str, float]]:
+    '''
+    What a positive dice of this mechanism does, as (Pauli string on the dice's qubits, probability).
+    Heralded dice follow the posterior probabilities given a herald, other dice follow the mechanism's MQEs
+        restricted to the dice's qubits and conditioned on not being the identity.
+    '''
+    if mechanism.is_erasure:
+        p_x, p_y, p_z = mechanism.posterior_generator.conditional_probabilities[dice_index][:3]
+        branches = [('I', 1 - p_x - p_y - p_z), ('X', p_x), ('Y', p_y), ('Z', p_z)]
+    else:
+        num_qubit_per_dice = mechanism.deterministic_generator.num_qubit_per_dice
+        rows = range(dice_index * num_qubit_per_dice, (dice_index + 1) * num_qubit_per_dice)
+        marginal = {}
+        for mqe in mechanism.normal_generator.list_of_MQE:
+            paulis = ''.join(mqe.list_of_SQE[r].type for r in rows)
+            marginal[paulis] = marginal.get(paulis, 0) + mqe.p
+        marginal.pop('I' * num_qubit_per_dice, None)
+        total = sum(marginal.values())
+        branches = [(paulis, p / total) for paulis, p in marginal.items()]
+    return [(paulis, p) for paulis, p in branches if p > 0]
+
+
+def gen_fault_locations(builder: easure_circ_builder) -> List[FaultLocations]:
+    '''
+    Rebuild the erasure circuit with a noise hook that writes down every dice the 'deterministic' mode would roll,
+        then compute the signature of every branch of every dice in one FlipSimulator batch.
+    The hooked circuit is built on a copy of builder (and of its error models, which hold the ancilla counter),
+        so the caller's erasure circuit, and everything already compiled from it, is left as it was.
+    '''
+    if getattr(builder, 'erasure_circuit', None) is None:
+        builder.gen_erasure_conversion_circuit()
+    builder = copy.copy(builder)
+    for name, value in list(vars(builder).items()):
+        if isinstance(value, GateErrorModel):
+            setattr(builder, name, copy.deepcopy(value))
+    records: Dict[str, Dict[str, list]] = {}
+    mechanisms: Dict[str, ErrorMechanism] = {}
+
+    def record_dice(circuit, error_model, qubits):
+        for mechanism in error_model.list_of_mechanisms:
+            first_ancilla = mechanism.next_ancilla_qubit_index_in_list[0] if mechanism.is_erasure else None
+            for args in mechanism.get_instruction(qubits=qubits, mode='erasure'):
+                circuit.append(*args)
+            generator = mechanism.deterministic_generator
+            record = records.setdefault(mechanism.name, {'qubits': [], 'injection_indices': [], 'ancillas': [], 'dice_index': []})
+            mechanisms[mechanism.name] = mechanism
+            data_qubits_array = np.array(qubits).reshape(-1, mechanism.num_qubits).T
+            for j in range(data_qubits_array.shape[1]):
+                for i in range(generator.num_dice):
+                    record['qubits'].append(tuple(int(q) for q in data_qubits_array[i*generator.num_qubit_per_dice:(i+1)*generator.num_qubit_per_dice, j]))
+                    record['injection_indices'].append(len(circuit) - 1)
+                    record['dice_index'].append(i)
+                    if mechanism.is_erasure:
+                        herald_locations = list(mechanism.erasure_generator.herald_locations)
+                        assert generator.num_qubit_per_dice == 1, "heralded dice must cover a single qubit"
+                        record['ancillas'].append(first_ancilla + j * len(herald_locations) + herald_locations.index(i))
+
+    builder.gen_erasure_conversion_circuit(noise_hook=record_dice)
+    first_ancilla_qubit_index = 2*(builder.distance+1)**2
+    num_flags = builder.next_ancilla_qubit_index_in_list[0] - first_ancilla_qubit_index
+    first_flag_measurement_index = builder.erasure_circuit.num_measurements - num_flags
+
+    list_of_locations = []
+    faults_after_instruction = {}
+    num_faults = 0
+    for name, record in records.items():
+        branches = [get_dice_branches(mechanisms[name], i) for i in record['dice_index']]
+        max_branches = max(len(b) for b in branches)
+        probabilities = np.zeros((len(branches), max_branches))
+        for k, b in enumerate(branches):
+            probabilities[k, :len(b)] = [p for _, p in b]
+        flags = None
+        if mechanisms[name].is_erasure:
+            flags = first_flag_measurement_index + np.array(record['ancillas'], dtype=int) - first_ancilla_qubit_index
+        locations = FaultLocations(mechanism_name=name,
+                                   qubits=record['qubits'],
+                                   injection_indices=record['injection_indices'],
+                                   flag_measurement_indices=flags,
+                                   branch_paulis=[[paulis for paulis, _ in b] for b in branches],
+                                   branch_probabilities=probabilities)
+        locations.fault_columns = -np.ones((locations.num_dice, max_branches), dtype=int)
+        for k in range(locations.num_dice):
+            for b, paulis in enumerate(locations.branch_paulis[k]):
+                locations.fault_columns[k, b] = num_faults
+                faults_after_instruction.setdefault(locations.injection_indices[k], []).append((num_faults, paulis, locations.qubits[k]))
+                num_faults += 1
+        list_of_locations.append(locations)
+
+    detector_flips, observable_flips = simulate_fault_signatures(builder.erasure_circuit, faults_after_instruction, num_faults)
+    packed = np.packbits(detector_flips, axis=1, bitorder='little')
+    observable_flips = observable_flips[:, 0] if observable_flips.shape[1] > 0 else np.zeros(num_faults, dtype=bool)
+    for locations in list_of_locations:
+        valid = locations.fault_columns >= 0
+        locations.signatures = np.zeros(locations.fault_columns.shape + (packed.shape[1],), dtype=np.uint8)
+        locations.signatures[valid] = packed[locations.fault_columns[valid]]
+        locations.observable_flips = np.zeros(locations.fault_columns.shape, dtype=bool)
+        locations.observable_flips[valid] = observable_flips[locations.fault_columns[valid]]
+    return list_of_locations
+
+
+def _combine_within_mechanism(locations: FaultLocations, dice_combos: np.ndarray):
+    '''
+    All (dice combination, branch combination) pairs of one mechanism: XOR-ed signatures, observable flips and probabilities.
+    '''
+    num_chosen = dice_combos.shape[1]
+    num_branches = locations.branch_probabilities.shape[1]
+    branch_combos = list(product(range(num_branches), repeat=num_chosen))
+    branch_combos = np.array(branch_combos, dtype=int).reshape(len(branch_combos), num_chosen)
+    num_bytes = locations.signatures.shape[2]
+    signatures = np.zeros((len(dice_combos), len(branch_combos), num_bytes), dtype=np.uint8)
+    observables = np.zeros((len(dice_combos), len(branch_combos)), dtype=bool)
+    probabilities = np.ones((len(dice_combos), len(branch_combos)))
+    for t in range(num_chosen):
+        dice = dice_combos[:, t][:, None]
+        branch = branch_combos[:, t][None, :]
+        signatures ^= locations.signatures[dice, branch]
+        observables ^= locations.observable_flips[dice, branch]
+        probabilities *= locations.branch_probabilities[dice, branch]
+    return signatures, observables, probabilities
+
+
+@dataclass
+class EnumerationResult:
+    mechanism_names: List[str]
+    num_dice: Dict[str, int]
+    failure_probabilities: Dict[Tuple[int, ...], float]  # counts per mechanism -> P(logical failure | that many positive dice)
+    num_decoded_patterns: int
+
+    def logical_error_rate(self, dice_probabilities: Dict[str, float]) -> float:
+        '''
+        Leading-order logical error rate, the sum over the enumerated strata weighted like the importance sampling strata.
+        '''
+        total = 0
+        for counts, failure_probability in self.failure_probabilities.items():
+            weight = 1
+            for name, n in zip(self.mechanism_names, counts):
+                p, N = dice_probabilities[name], self.num_dice[name]
+                weight *= math.comb(N, n) * p**n * (1 - p)**(N - n)
+            total += weight * failure_probability
+        return total
+
+
+@dataclass
+class FaultEnumerator:
+    """
+    Exhaustive enumeration of every combination of at most max_weight positive dice (the same dice that
+    ImportanceSamplingDecodeJob draws at random with generate_bool_array), and every branch of each dice.
+    Signatures are XOR-ed bit-packed rows; shots with the same erasure flags are decoded together
+    with one posterior matching and Matching.decode_batch, after removing duplicate syndromes.
+    """
+    builder: easure_circ_builder
+    curve: str = 'S'
+    # flag measurement indices -> matching, defaults to the posterior matching decode_by_generate_new_circ uses
+    get_matching: Optional[Callable[[np.ndarray], pymatching.Matching]] = None
+
+    def __post_init__(self):
+        if getattr(self.builder, 'helper', None) is None:
+            self.builder.generate_helper()
+        self.list_of_locations = gen_fault_locations(self.builder)
+        self.mechanism_names = [locations.mechanism_name for locations in self.list_of_locations]
+        if self.get_matching is None:
+            def get_posterior_matching(flag_measurement_indices):
+                single_measurement_sample = np.zeros(self.builder.erasure_circuit.num_measurements, dtype=bool)
+                single_measurement_sample[flag_measurement_indices] = True
+                return self.builder.gen_posterior_matching(single_measurement_sample, self.curve)
+            self.get_matching = get_posterior_matching
+
+    def failure_probability(self, counts: Tuple[int, ...], max_patterns_per_batch: int = 2**20):
+        '''
+        Exact P(logical failure | counts[i] positive dice of mechanism i), averaged over which dice and how they come up.
+        '''
+        heralded, unheralded = [], []
+        for locations, n in zip(self.list_of_locations, counts):
+            combos = list(combinations(range(locations.num_dice), n))
+            combos = np.array(combos, dtype=int).reshape(len(combos), n)
+            (heralded if locations.is_heralded else unheralded).append((locations, combos))
+
+        # Fold the unheralded mechanisms into one list of (signature, observable, probability) rows
+        num_bytes = self.list_of_locations[0].signatures.shape[2]
+        rest_signatures = np.zeros((1, num_bytes), dtype=np.uint8)
+        rest_observables = np.zeros(1, dtype=bool)
+        rest_probabilities = np.ones(1)
+        for locations, combos in unheralded:
+            s, o, p = _combine_within_mechanism(locations, combos)
+            rest_signatures = (rest_signatures[:, None, :] ^ s.reshape(1, -1, num_bytes)).reshape(-1, num_bytes)
+            rest_observables = (rest_observables[:, None] ^ o.reshape(1, -1)).reshape(-1)
+            rest_probabilities = (rest_probabilities[:, None] * p.reshape(1, -1)).reshape(-1)
+        keep = rest_probabilities > 0
+        rest_signatures, rest_observables, rest_probabilities = rest_signatures[keep], rest_observables[keep], rest_probabilities[keep]
+
+        # The heralded dice decide the matching graph, loop over their combinations
+        heralded_combined = [_combine_within_mechanism(locations, combos) for locations, combos in heralded]
+        num_flag_sets = int(np.prod([len(combos) for _, combos in heralded])) if heralded else 1
+        failure_mass = 0.0
+        num_decoded = 0
+        for flag_set in product(*[range(len(combos)) for _, combos in heralded]):
+            flag_measurement_indices = np.concatenate([locations.flag_measurement_indices[combos[k]]
+                                                       for k, (locations, combos) in zip(flag_set, heralded)]) if heralded else np.zeros(0, dtype=int)
+            signatures = np.zeros((1, num_bytes), dtype=np.uint8)
+            observables = np.zeros(1, dtype=bool)
+            probabilities = np.ones(1)
+            for k, (s, o, p) in zip(flag_set, heralded_combined):
+                signatures = (signatures[:, None, :] ^ s[k][None, :, :]).reshape(-1, num_bytes)
+                observables = (observables[:, None] ^ o[k][None, :]).reshape(-1)
+                probabilities = (probabilities[:, None] * p[k][None, :]).reshape(-1)
+            keep = probabilities > 0
+            signatures, observables, probabilities = signatures[keep], observables[keep], probabilities[keep]
+
+            matching = self.get_matching(flag_measurement_indices)
+            chunk = max(max_patterns_per_batch // len(signatures), 1)
+            for start in range(0, len(rest_signatures), chunk):
+                patterns = (signatures[:, None, :] ^ rest_signatures[None, start:start+chunk, :]).reshape(-1, num_bytes)
+                actual = (observables[:, None] ^ rest_observables[None, start:start+chunk]).reshape(-1)
+                weights = (probabilities[:, None] * rest_probabilities[None, start:start+chunk]).reshape(-1)
+                unique_patterns, inverse = np.unique(patterns, axis=0, return_inverse=True)
+                predicted = matching.decode_batch(unique_patterns, bit_packed_shots=True)[:, 0].astype(bool)
+                num_decoded += len(unique_patterns)
+                failure_mass += weights[predicted[inverse.reshape(-1)] != actual].sum()
+
+        num_dice_combos = num_flag_sets * int(np.prod([len(combos) for _, combos in unheralded])) if unheralded else num_flag_sets
+        return failure_mass / num_dice_combos, num_decoded
+
+    def enumerate(self, max_weight: int, print_progress=False) -> EnumerationResult:
+        failure_probabilities = {}
+        num_decoded_patterns = 0
+        for counts in product(range(max_weight + 1), repeat=len(self.list_of_locations)):
+            if sum(counts) > max_weight:
+                continue
+            if sum(counts) == 0:
+                failure_probabilities[counts] = 0.0
+                continue
+            t = time.time()
+            failure_probabilities[counts], num_decoded = self.failure_probability(counts)
+            num_decoded_patterns += num_decoded
+            if print_progress:
+                print(f'{dict(zip(self.mechanism_names, counts))}: P(fail) = {failure_probabilities[counts]:.6g}, {num_decoded} patterns decoded in {time.time()-t:.1f}s')
+        return EnumerationResult(mechanism_names=self.mechanism_names,
+                                 num_dice={locations.mechanism_name: locations.num_dice for locations in self.list_of_locations},
+                                 failure_probabilities=failure_probabilities,
+                                 num_decoded_patterns=num_decoded_patterns)
@@ -1,5 +1,6 @@
 from EfficientSurfaceCodeSim.circuit_builder import *
 from EfficientSurfaceCodeSim.error_model import *
+from EfficientSurfaceCodeSim.prediction_cache import *
 
 import time
 
@@ -25,6 +26,7 @@ class ImportanceSamplingDecodeJob:
     num_e_flipped: int
     num_p_flipped: int
 
+    dedup: bool = True  # decode every distinct (syndrome, erasure flags) pattern once, see PredictionCache
 
     def sample_and_print_result(self,print_progress = False):
         if print_progress:
@@ -38,19 +40,13 @@ class ImportanceSamplingDecodeJob:
                                       measurement_error=0
                                       )
         builder.generate_helper()
-        builder.gen_dummy_circuit()
+        census = builder.gen_fault_census()
 
         non_trivial_gate_error_models = [attr_value for attr_name, attr_value in vars(builder).items() if isinstance(attr_value, GateErrorModel) and not  attr_value.trivial]
         assert len(non_trivial_gate_error_models) == 1
 
-        tot_e = non_trivial_gate_error_models[0].name_to_mechanism['2q erasure'].dummy_generator.num_qubit_called
-        tot_p = non_trivial_gate_error_models[0].name_to_mechanism['2q depo'].dummy_generator.num_qubit_called
-
-        num_qubit_per_dice_e = non_trivial_gate_error_models[0].name_to_mechanism['2q erasure'].deterministic_generator.num_qubit_per_dice
-        num_qubit_per_dice_p = non_trivial_gate_error_models[0].name_to_mechanism['2q depo'].deterministic_generator.num_qubit_per_dice
-
-        num_dice_e = int(tot_e/num_qubit_per_dice_e)
-        num_dice_p = int(tot_p/num_qubit_per_dice_p)
+        num_dice_e = census.get('2q erasure').num_dice
+        num_dice_p = census.get('2q depo').num_dice
 
         builder.gen_erasure_conversion_circuit()
         erasure_circ_next_ancilla_qubit_index = builder.next_ancilla_qubit_index_in_list[0]
@@ -58,6 +54,10 @@ class ImportanceSamplingDecodeJob:
 
         num_shots = 0
         num_errors = 0
+        # Every shot comes from its own deterministic circuit, sample them all first then decode the distinct ones
+        all_meas_samples = []
+        all_det_samples = []
+        all_actual_obs = []
 
         for i in range(self.shots):
             e_dice_sample = generate_bool_array(num_dice_e, self.num_e_flipped)
@@ -79,11 +79,24 @@ class ImportanceSamplingDecodeJob:
             meas_samples = sampler.sample(shots=1)
             det_samples, actual_obs_chunk = converter.convert(measurements=meas_samples,
                                                                     separate_observables=True)
-            
-            predicted  = builder.decode_by_generate_new_circ(det_samples[0],'S',meas_samples[0])
-            num_errors += actual_obs_chunk[0][0] != predicted
+            all_meas_samples.append(meas_samples[0])
+            all_det_samples.append(det_samples[0])
+            all_actual_obs.append(actual_obs_chunk[0][0])
             num_shots += 1
 
+        meas_samples = np.array(all_meas_samples).reshape(num_shots, -1)
+        det_samples = np.array(all_det_samples).reshape(num_shots, -1)
+        actual_obs = np.array(all_actual_obs, dtype=bool)
+        decode_one = lambda i: builder.decode_by_generate_new_circ(det_samples[i],'S',meas_samples[i])
+        dedup_stats = None
+        if self.dedup:
+            cache = PredictionCache()
+            predictions = cache.decode_chunk(det_samples, meas_samples[:, builder.get_erasure_flag_indices()], decode_one)
+            dedup_stats = cache.get_stats()
+        else:
+            predictions = np.array([decode_one(i) for i in range(num_shots)], dtype=bool)
+        num_errors = np.sum(actual_obs != predictions)
+
         # type cast in case some of them are numpy types which are not JSON serializable
         result = {
             'job_id': str(self.job_id),
@@ -99,6 +112,8 @@ class ImportanceSamplingDecodeJob:
             'num_shots': int(num_shots),
             'num_errors': int(num_errors),
         }
+        if dedup_stats is not None:
+            result['dedup'] = dedup_stats
 
         return result
 
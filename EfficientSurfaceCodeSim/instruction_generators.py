@@ -189,6 +189,8 @@ class ErasureInsGenerator(InsGeneratorStepwiseProbs, InsGeneratorPosteriorProbs)
         If during a 2-qubit gate, the two qubits are independently erased, then we apply two pairs of PAULI_CHANNEL_2.
         But if the 2-qubit gate is described by some correlated erasure error, as in PHYSICAL REVIEW X 13, 041013 (2023), 
             then the mechanism involving more than 2 qubits need to be modeled by CORRELATED_ERROR, and CORRELATED_ERROR are not vectorizable.
+            A CORRELATED_ERROR chain is needed per gate, but the chain itself (stepwise probabilities, Paulis, which data qubit or ancilla each target is)
+            is built once in __post_init__, and the chains of all the gates of a layer are emitted as one stim.Circuit.
 
         instruction_name and instruction_arg can be used to describe one PAULI_CHANNEL_2 that is applied to one (pair (with broadcasting)) of qubits
             or two PAULI_CHANNEL_2 that is separatly applied to a pair of qubits
@@ -199,12 +201,28 @@ class ErasureInsGenerator(InsGeneratorStepwiseProbs, InsGeneratorPosteriorProbs)
     generator_type: str = 'Dummy generator'
     def __post_init__(self):
         InsGenerator.__post_init__(self)
+        InsGeneratorPosteriorProbs.__post_init__(self) # Both paths need the herald locations to assign the ancillas
         if self.instruction_name == None or self.instruction_arg == None:
             self.vectorizable = False
             InsGeneratorStepwiseProbs.__post_init__(self)
+            self.correlated_chain = []
+            prob_left = 1
+            for mqe in self.list_of_MQE:
+                paulis, rows = [], []  # rows index into the data qubits array stacked on top of the padded ancillas array
+                for i, sqe in enumerate(mqe.list_of_SQE):
+                    if sqe.type != 'I':
+                        paulis.append(sqe.type)
+                        rows.append(i)
+                    if sqe.heralded:
+                        paulis.append('X')
+                        rows.append(self.num_qubits + i)
+                if len(paulis) == 0:
+                    continue # The events that do nothing don't need a link in the chain, the others' stepwise probabilities just don't count them
+                stepwise_p = max(min(mqe.p / prob_left, 1), 0) if prob_left > 0 else 0
+                prob_left -= mqe.p
+                self.correlated_chain.append((stepwise_p, ' '.join(f'{P}%d' for P in paulis), np.array(rows, dtype=int)))
         else:
             self.vectorizable = True
-            InsGeneratorPosteriorProbs.__post_init__(self)
             if isinstance(self.instruction_name,List):
                 assert len(self.instruction_name) == len(self.instruction_arg)
             else:
@@ -232,23 +250,15 @@ class ErasureInsGenerator(InsGeneratorStepwiseProbs, InsGeneratorPosteriorProbs)
                     list_of_args.append([self.instruction_name[i], interposed_array, self.instruction_arg[i]])
             return list_of_args
         else:
-            ancillas = ancillas.T.flatten()
-            ancilla_idx = 0
-            list_of_args_gathered = []
-            for sets_of_qubits in chunked(iterable=qubits, chunk_size = self.num_qubits):
-                list_of_args = []
-                for mqe, stepwise_p in zip(self.list_of_MQE,self.stepwise_probabilities):
-                    targets = []
-                    for sqe,circuit_qubit_idx in zip(mqe.list_of_SQE, sets_of_qubits):
-                        if sqe.type != 'I':
-                            targets.append(Etype_to_stim_target_fun[sqe.type](circuit_qubit_idx))
-                        if sqe.heralded:# If it heralded, then the corresponding ancilla must have been assigned on this qubit for this Gate_error_model 
-                            targets.append(Etype_to_stim_target_fun['X'](ancillas[ancilla_idx]))
-                            ancilla_idx += 1
-                    list_of_args.append(["ELSE_CORRELATED_ERROR",targets,stepwise_p])
-                list_of_args[0][0] = "CORRELATED_ERROR" # The first instruction should be CORRELATED_ERROR in stim
-                list_of_args_gathered.extend(list_of_args)
-            return list_of_args_gathered   
+            # One chain per gate, every link broadcast over the gates of the layer at once.
+            #   A heralded location always flips the same ancilla (padded_ancillas[i, gate]), whichever MQE heralds it.
+            stacked = np.concatenate([data_qubits_array, padded_ancillas])
+            lines_per_link = []
+            for k, (stepwise_p, targets_format, rows) in enumerate(self.correlated_chain):
+                line_format = f"{'ELSE_CORRELATED_ERROR' if k > 0 else 'CORRELATED_ERROR'}({float(stepwise_p)!r}) {targets_format}"
+                lines_per_link.append([line_format % tuple(targets) for targets in stacked[rows].T.tolist()])
+            text = '\n'.join('\n'.join(chain) for chain in zip(*lines_per_link))
+            return [[stim.Circuit(text)]] # stim.Circuit.append takes a whole circuit too
 
 @dataclass
 class PosteriorInsGenerator(InsGeneratorPosteriorProbs):
@@ -1,7 +1,12 @@
 from EfficientSurfaceCodeSim.circuit_builder import *
 from EfficientSurfaceCodeSim.error_model import *
+from EfficientSurfaceCodeSim.worker_pool import *
+from EfficientSurfaceCodeSim.prediction_cache import *
+from EfficientSurfaceCodeSim.circuit_template import *
+from EfficientSurfaceCodeSim.shot_records import *
 
 import time
+import hashlib
 
 @dataclass
 class MCSampleDecodeJob:
@@ -12,41 +17,225 @@ class MCSampleDecodeJob:
     p_p: float
     shots: int
     biased_erasure: bool = True
+    decoder: str = 'auto'  # see builder.get_decoder, 'auto' uses the peeling decoder for pure erasure noise
+    dedup: bool = True  # decode every distinct (syndrome, erasure flags) pattern once, see PredictionCache
+    max_prediction_cache_size: int = 100000
+    sparse: bool = False  # keep the shots bit-packed and as fired detector / raised flag lists end to end, see SparseShots
+    seed: Optional[int] = None  # stim sampler seed, None draws a fresh one
+    checkpoint_path: Optional[str] = None  # if given, sample and decode in chunks and checkpoint to this file so a preempted job resumes
+    checkpoint_interval: float = 60  # seconds between checkpoints
+    checkpoint_chunk_shots: int = 10000
+    shot_record_path: Optional[str] = None  # if given, save per-shot ShotRecords there (.npz) for reweight_shot_records, not with checkpoint_path
 
-    def sample_and_print_result(self,print_progress = False):
-        if print_progress:
-            from IPython.display import clear_output
+    def get_builder(self):
+        # Jobs of a p_e/p_p sweep at the same distance share one structural build through the template cache
+        template = get_circuit_template(distance=self.d,
+                                        rounds=self.d,
+                                        mechanism_names=get_2q_mechanism_names(p_e=self.p_e, biased=self.biased_erasure),
+                                        measurement_error=0)
+        return template.get_builder(p_p=self.p_p, p_e=self.p_e)
+
+    def sample(self, artifacts: Optional[CompiledArtifacts] = None):
+        '''
+        artifacts: pre-compiled artifacts of this circuit_id (see worker_pool.py), if None everything is built here.
+        Returns the builder, the measurement samples, the detector samples and the actual observables.
+        '''
+        if artifacts is None:
+            builder, reference_sample, converter = self.get_builder(), None, None
+        else:
+            builder, reference_sample, converter = artifacts.builder, artifacts.reference_sample, artifacts.converter
+        meas_samples, det_samples, actual_obs_chunk = self.sample_shots(builder, self.shots, self.seed, reference_sample, converter)
+        return builder, meas_samples, det_samples, actual_obs_chunk
 
-        after_cz_error_model = get_2q_error_model(p_e=self.p_e,
-                                                  p_p=self.p_p,
-                                                  biased=self.biased_erasure)
-        builder = easure_circ_builder(rounds = self.d,
-                                      distance= self.d,
-                                      after_cz_error_model=after_cz_error_model,
-                                      measurement_error=0
-                                      )
-        builder.generate_helper()
-        builder.gen_erasure_conversion_circuit()
-
-        sampler = builder.erasure_circuit.compile_sampler() #expensive step, 16s for d13, 4s for d11, 0.7s for d9
-        meas_samples = sampler.sample(shots=self.shots)
-        converter = builder.erasure_circuit.compile_m2d_converter() #expensive step, 16s for d13, 4s for d11, 0.7s for d9
+    def sample_shots(self, builder, shots, seed = None, reference_sample = None, converter = None):
+        '''
+        Draw shots from builder.erasure_circuit, reference_sample and converter are compiled here when not given.
+        Returns the measurement samples, the detector samples and the actual observables.
+        '''
+        sampler = builder.erasure_circuit.compile_sampler(seed=seed, reference_sample=reference_sample) #expensive step, 16s for d13, 4s for d11, 0.7s for d9
+        if converter is None:
+            converter = builder.erasure_circuit.compile_m2d_converter() #expensive step, 16s for d13, 4s for d11, 0.7s for d9
+        meas_samples = sampler.sample(shots=shots)
         det_samples, actual_obs_chunk = converter.convert(measurements=meas_samples,
                                                                 separate_observables=True)
-        t1 = time.time()
-        # Decode
-        new_circ_num_errors = 0
-        # normal_circ_num_errors = 0
-        for i in range(self.shots):
-            predicted  = builder.decode_by_generate_new_circ(det_samples[i],'S',meas_samples[i])
-            new_circ_num_errors += actual_obs_chunk[i][0] != predicted
+        return meas_samples, det_samples, actual_obs_chunk
 
-            # predicted = builder.decode_without_changing_weights(det_samples[i],'S',meas_samples[i])
-            # normal_circ_num_errors += actual_obs_chunk[i][0] != predicted
+    def predict(self, builder, meas_samples, det_samples,
+                prediction_caches: Optional[Dict[str, PredictionCache]] = None, print_progress = False):
+        '''
+        Decode the shots with self.decoder.
+        prediction_caches: where the PredictionCache of the decoder is kept when self.dedup (e.g. artifacts.prediction_caches), None means a fresh cache.
+        Returns the decoder name, the predicted observable of every shot and the dedup statistics (None without dedup).
+        '''
+        if print_progress:
+            from IPython.display import clear_output
+        decoder_name = builder.resolve_decoder_name(self.decoder)
+        decode = builder.get_decoder(decoder_name)
+        decode_batch = builder.get_batch_decoder(decoder_name)
+        dedup_stats = None
+        if decode_batch is not None:
+            predictions = decode_batch(det_samples, 'S', meas_samples)
+        elif self.dedup:
+            if prediction_caches is None:
+                cache = PredictionCache(max_size=self.max_prediction_cache_size)
+            else:
+                cache = prediction_caches.setdefault(f'{decoder_name}_S', PredictionCache(max_size=self.max_prediction_cache_size))
+            counts_before = dict(cache.counts)
+            predictions = cache.decode_chunk(det_samples,
+                                             meas_samples[:, builder.get_erasure_flag_indices()],
+                                             lambda i: decode(det_samples[i],'S',meas_samples[i]))
+            dedup_stats = cache.get_stats(since=counts_before)
+        else:
+            predictions = np.zeros(len(det_samples), dtype=bool)
+            for i in range(len(det_samples)):
+                predictions[i] = decode(det_samples[i],'S',meas_samples[i])
 
-            if i%10 == 0 and print_progress:
-                clear_output(wait=True)
-                print(f'decoding finished {100*i/self.shots}%')
+                # predicted = builder.decode_without_changing_weights(det_samples[i],'S',meas_samples[i])
+                # normal_circ_num_errors += actual_obs_chunk[i][0] != predicted
+
+                if i%10 == 0 and print_progress:
+                    clear_output(wait=True)
+                    print(f'decoding finished {100*i/len(det_samples)}%')
+        return decoder_name, np.asarray(predictions, dtype=bool), dedup_stats
+
+    def sample_sparse(self, builder, shots, seed = None, reference_sample = None, converter = None) -> SparseShots:
+        # sample_shots with stim's bit-packed output, the measurement samples are dropped once their flags are read
+        return sample_sparse_shots(builder.erasure_circuit, len(builder.get_erasure_flag_indices()), shots, seed, reference_sample, converter)
+
+    def predict_sparse(self, builder, shots: SparseShots, prediction_caches: Optional[Dict[str, PredictionCache]] = None):
+        '''
+        predict() on SparseShots: the batch decoders take the packed syndromes, the others get the fired detectors and raised flags
+            of one shot (see builder.get_sparse_decoder), and no dense per shot row is built except where a decoder needs one.
+        '''
+        decoder_name = builder.resolve_decoder_name(self.decoder)
+        decode_batch = builder.get_packed_batch_decoder(decoder_name)
+        if decode_batch is not None:
+            return decoder_name, decode_batch(shots, 'S'), None
+        decode = builder.get_sparse_decoder(decoder_name)
+        decode_one = lambda i: decode(shots.get_fired_detectors(i), shots.det_packed[i], shots.get_raised_flags(i), 'S')
+        if not self.dedup:
+            predictions = np.zeros(len(shots), dtype=bool)
+            for i in np.flatnonzero(shots.get_num_fired_detectors()):
+                predictions[i] = decode_one(i)
+            return decoder_name, predictions, None
+        if prediction_caches is None:
+            cache = PredictionCache(max_size=self.max_prediction_cache_size)
+        else:
+            cache = prediction_caches.setdefault(f'{decoder_name}_S', PredictionCache(max_size=self.max_prediction_cache_size))
+        counts_before = dict(cache.counts)
+        predictions = cache.decode_packed_chunk(shots.det_packed, shots.flag_packed, decode_one)
+        return decoder_name, predictions, cache.get_stats(since=counts_before)
+
+    def count_errors(self, builder, meas_samples, det_samples, actual_obs_chunk,
+                     prediction_caches: Optional[Dict[str, PredictionCache]] = None, print_progress = False):
+        # predict() and count the wrong predictions, returns the decoder name, the number of errors and the dedup statistics
+        decoder_name, predictions, dedup_stats = self.predict(builder, meas_samples, det_samples, prediction_caches, print_progress)
+        return decoder_name, int(np.sum(actual_obs_chunk[:, 0] != predictions)), dedup_stats
+
+    def get_shot_records(self, builder, meas_samples, failed, decoder_name) -> ShotRecords:
+        return gen_shot_records_from_flags(builder, meas_samples, failed, decoder_name, self.p_e, self.p_p, self.biased_erasure)
+
+    def get_checkpoint_key(self, builder, seed: Optional[int] = None) -> str:
+        # A checkpoint is only resumed if it was written for the same circuit, sampling parameters and stim version,
+        #   otherwise the resampled chunks wouldn't be the ones that were decoded before.
+        # seed: the seed to key on, defaults to self.seed
+        seed = self.seed if seed is None else seed
+        source = '\n'.join([str(builder.erasure_circuit), stim.__version__, str(seed), str(self.shots),
+                            str(self.checkpoint_chunk_shots), builder.resolve_decoder_name(self.decoder)])
+        return hashlib.sha256(source.encode()).hexdigest()
+
+    def sample_and_decode_with_checkpoints(self, artifacts: Optional[CompiledArtifacts] = None, print_progress = False):
+        '''
+        Sample and decode self.shots shots in chunks of checkpoint_chunk_shots, chunk k drawn with a seed derived from (self.seed, k).
+        Every checkpoint_interval seconds the number of decoded chunks and errors go to checkpoint_path,
+            a restarted job skips the chunks it already decoded, so its final count equals an uninterrupted run.
+        Without a seed, a random one is drawn and stored in the checkpoint.
+        Returns the same as count_errors, the dedup statistics only cover the chunks decoded by this run.
+        '''
+        if artifacts is None:
+            builder = self.get_builder()
+            reference_sample = builder.erasure_circuit.reference_sample()
+            converter = builder.erasure_circuit.compile_m2d_converter()
+        else:
+            builder, reference_sample, converter = artifacts.builder, artifacts.reference_sample, artifacts.converter
+        prediction_caches = {} if artifacts is None else artifacts.prediction_caches
+
+        state = None
+        if os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path) as f:
+                state = json.load(f)
+            # Without a seed of our own, the checkpoint's seed is only adopted if the rest of the key matches under it
+            if state['key'] != self.get_checkpoint_key(builder, self.seed if self.seed is not None else state['seed']):
+                state = None  # stale checkpoint of another job
+            elif self.seed is None:
+                self.seed = state['seed']
+        if self.seed is None:
+            self.seed = int(np.random.SeedSequence().generate_state(1, dtype=np.uint64)[0] >> 1)
+        if state is None:
+            state = {'key': self.get_checkpoint_key(builder), 'seed': self.seed, 'chunks_done': 0, 'shots_done': 0, 'num_errors': 0}
+
+        def save():
+            with open(self.checkpoint_path + '.tmp', 'w') as f:
+                json.dump(state, f)
+            os.replace(self.checkpoint_path + '.tmp', self.checkpoint_path)
+
+        decoder_name, dedup_stats = builder.resolve_decoder_name(self.decoder), None
+        last_checkpoint = time.time()
+        num_chunks = -(-self.shots // self.checkpoint_chunk_shots)
+        for k in range(state['chunks_done'], num_chunks):
+            chunk_shots = min(self.checkpoint_chunk_shots, self.shots - k * self.checkpoint_chunk_shots)
+            chunk_seed = int(np.random.SeedSequence([self.seed, k]).generate_state(1, dtype=np.uint64)[0] >> 1)
+            if self.sparse:
+                shots = self.sample_sparse(builder, chunk_shots, chunk_seed, reference_sample, converter)
+                decoder_name, predictions, chunk_stats = self.predict_sparse(builder, shots, prediction_caches)
+                num_errors = int(np.sum(shots.get_actual_observables() != predictions))
+            else:
+                meas_samples, det_samples, actual_obs_chunk = self.sample_shots(builder, chunk_shots, chunk_seed, reference_sample, converter)
+                decoder_name, num_errors, chunk_stats = self.count_errors(builder, meas_samples, det_samples, actual_obs_chunk,
+                                                                          prediction_caches=prediction_caches)
+            state['num_errors'] += num_errors
+            if chunk_stats is not None:
+                dedup_stats = {key: (dedup_stats or {}).get(key, 0) + value for key, value in chunk_stats.items()}
+                dedup_stats['dedup_ratio'] = dedup_stats['shots'] / max(dedup_stats['decoded'], 1)
+            state['chunks_done'] = k + 1
+            state['shots_done'] += chunk_shots
+            if time.time() - last_checkpoint > self.checkpoint_interval:
+                save()
+                last_checkpoint = time.time()
+            if print_progress:
+                print(f'decoding finished {100*state["shots_done"]/self.shots}%')
+        save()  # the finished state, a rerun of a finished job returns right away
+        return decoder_name, state['num_errors'], dedup_stats
+
+    def sample_and_print_result(self,print_progress = False, artifacts: Optional[CompiledArtifacts] = None):
+        t0 = time.time()
+        t1 = t0
+        if self.checkpoint_path is not None:
+            decoder_name, num_errors, dedup_stats = self.sample_and_decode_with_checkpoints(artifacts, print_progress=print_progress)
+        elif self.sparse:
+            if artifacts is None:
+                builder, reference_sample, converter = self.get_builder(), None, None
+            else:
+                builder, reference_sample, converter = artifacts.builder, artifacts.reference_sample, artifacts.converter
+            shots = self.sample_sparse(builder, self.shots, self.seed, reference_sample, converter)
+            t1 = time.time()
+            decoder_name, predictions, dedup_stats = self.predict_sparse(builder, shots,
+                                                                         None if artifacts is None else artifacts.prediction_caches)
+            failed = shots.get_actual_observables() != predictions
+            num_errors = int(np.sum(failed))
+            if self.shot_record_path is not None:
+                gen_shot_records_from_sparse_flags(builder, shots, failed, decoder_name, self.p_e, self.p_p,
+                                                   self.biased_erasure).save(self.shot_record_path)
+        else:
+            builder, meas_samples, det_samples, actual_obs_chunk = self.sample(artifacts)
+            t1 = time.time()
+            decoder_name, predictions, dedup_stats = self.predict(builder, meas_samples, det_samples,
+                                                                  prediction_caches=None if artifacts is None else artifacts.prediction_caches,
+                                                                  print_progress=print_progress)
+            failed = actual_obs_chunk[:, 0] != predictions
+            num_errors = int(np.sum(failed))
+            if self.shot_record_path is not None:
+                self.get_shot_records(builder, meas_samples, failed, decoder_name).save(self.shot_record_path)
         t2 = time.time()
         if print_progress:
             print(f"{(t2-t1)/self.shots} per shot (d = {self.d})")
@@ -57,11 +246,69 @@ class MCSampleDecodeJob:
             'p_e':self.p_e,
             'p_p':self.p_p,
             'shots':self.shots,
-            'new_circ':int(new_circ_num_errors),
+            'decoder': decoder_name,
+            'num_errors': int(num_errors),  # the same key whatever the decoder, read this one
+            decoder_name: int(num_errors),  # and under the decoder name, as before 'num_errors'
+            'wall_time': time.time() - t0,  # sampling and decoding, without building the circuit when artifacts are given
         }
+        if dedup_stats is not None:
+            result['dedup'] = dedup_stats
+        if self.shot_record_path is not None and self.checkpoint_path is None:
+            result['shot_records'] = self.shot_record_path
 
         return result
 
+
+@dataclass
+class MCCompareDecodersJob(MCSampleDecodeJob):
+    """
+    Sample and convert once, then decode every shot with each (decoder name, curve) strategy,
+        e.g. the old 'no_change' / 'new_circ' x 'S' / 'L' comparisons without resampling per strategy.
+    """
+    strategies: List[Tuple[str, str]] = field(default_factory=lambda: [('new_circ', 'S'), ('new_circ', 'L'), ('union_find', 'S')])
+
+    def sample_and_print_result(self,print_progress = False, artifacts: Optional[CompiledArtifacts] = None):
+        builder, meas_samples, det_samples, actual_obs_chunk = self.sample(artifacts)
+        strategies = [(builder.resolve_decoder_name(name), curve) for name, curve in self.strategies]
+        keys = [f'{name}_{curve}' for name, curve in strategies]
+
+        t1 = time.time()
+        predictions = np.zeros((self.shots, len(strategies)), dtype=bool)
+        for i in range(self.shots):
+            predictions[i] = builder.decode_by_strategies(det_samples[i], meas_samples[i], strategies)
+            if i%100 == 0 and print_progress:
+                print(f'decoding finished {100*i/self.shots}%')
+        t2 = time.time()
+        if print_progress:
+            print(f"{(t2-t1)/self.shots} per shot for {len(strategies)} strategies (d = {self.d})")
+
+        failures = predictions != actual_obs_chunk[:, :1]
+        # Joint failure table: how many shots failed for exactly this subset of strategies, keyed by a '0'/'1' string over keys
+        patterns, counts = np.unique(failures, axis=0, return_counts=True)
+        joint_failures = {''.join('1' if f else '0' for f in pattern): int(count) for pattern, count in zip(patterns, counts)}
+        pairwise = {}
+        for a in range(len(keys)):
+            for b in range(a + 1, len(keys)):
+                pairwise[f'{keys[a]}|{keys[b]}'] = {
+                    'both_fail': int(np.sum(failures[:, a] & failures[:, b])),
+                    'only_first_fails': int(np.sum(failures[:, a] & ~failures[:, b])),
+                    'only_second_fails': int(np.sum(~failures[:, a] & failures[:, b])),
+                    'disagree': int(np.sum(predictions[:, a] != predictions[:, b])),
+                }
+        result = {
+            'job_id': self.job_id,
+            'circuit_id': self.circuit_id,
+            'd': self.d,
+            'p_e':self.p_e,
+            'p_p':self.p_p,
+            'shots':self.shots,
+            'strategies': keys,
+            'num_errors': {key: int(n) for key, n in zip(keys, failures.sum(axis=0))},
+            'joint_failures': joint_failures,
+            'pairwise': pairwise,
+        }
+        return result
+
 # I have another python file that loads the pickle and call the method of that class instance
 # # This function can be run over condor
 # def main():
@@ -0,0 +1,67 @@
+from EfficientSurfaceCodeSim.circuit_builder import *
+from collections import OrderedDict
+
+
+@dataclass
+class PredictionCache:
+    """
+    Triage stage in front of a per-shot decoder.
+    Shots without any detection event are answered immediately (nothing to correct),
+        the others are deduplicated on their bit-packed detector + erasure flag rows and each pattern is decoded once.
+    Predictions are kept in a bounded LRU cache, so reusing one cache for several chunks also skips the patterns of earlier chunks.
+    One cache must only ever see one circuit, one decoder and one curve.
+    """
+    max_size: int = 100000
+
+    def __post_init__(self):
+        self.predictions: OrderedDict = OrderedDict()
+        self.counts = {'shots': 0, 'trivial_shots': 0, 'unique_patterns': 0, 'cache_hits': 0, 'decoded': 0}
+
+    def decode_chunk(self, det_samples, flags, decode_one: Callable[[int], bool]) -> np.ndarray:
+        '''
+        det_samples: (shots, num_detectors) bool
+        flags: (shots, num_flags) bool erasure flags, the only part of a measurement sample the decoders look at
+        decode_one(i) decodes shot i of the chunk, it's called for one representative shot of every new pattern
+        Returns the predicted observable of every shot.
+        '''
+        # Packed like stim's bit_packed=True output, so that dense and packed chunks share the cache keys
+        return self.decode_packed_chunk(np.packbits(np.asarray(det_samples, dtype=bool), axis=1, bitorder='little'),
+                                        np.packbits(np.asarray(flags, dtype=bool), axis=1, bitorder='little'),
+                                        decode_one)
+
+    def decode_packed_chunk(self, det_packed, flag_packed, decode_one: Callable[[int], bool]) -> np.ndarray:
+        '''
+        decode_chunk on bit-packed rows (see SparseShots): det_packed (shots, ceil(num_detectors / 8)), flag_packed (shots, ceil(num_flags / 8))
+        '''
+        rows = np.concatenate([np.asarray(det_packed, dtype=np.uint8), np.asarray(flag_packed, dtype=np.uint8)], axis=1)
+        unique_rows, first, inverse = np.unique(rows, axis=0, return_index=True, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        trivial = ~np.asarray(det_packed)[first].any(axis=1)
+
+        unique_predictions = np.zeros(len(unique_rows), dtype=bool)
+        for k in np.flatnonzero(~trivial):
+            key = unique_rows[k].tobytes()
+            prediction = self.predictions.get(key)
+            if prediction is None:
+                prediction = bool(decode_one(first[k]))
+                self.counts['decoded'] += 1
+                self.predictions[key] = prediction
+                if len(self.predictions) > self.max_size:
+                    self.predictions.popitem(last=False)
+            else:
+                self.counts['cache_hits'] += 1
+                self.predictions.move_to_end(key)
+            unique_predictions[k] = prediction
+
+        self.counts['shots'] += len(rows)
+        self.counts['trivial_shots'] += int(np.sum(trivial[inverse]))
+        self.counts['unique_patterns'] += int(np.sum(~trivial))
+        return unique_predictions[inverse]
+
+    def get_stats(self, since: Optional[Dict[str, int]] = None) -> Dict[str, float]:
+        '''
+        since: a copy of self.counts taken earlier, to only report what happened after it (e.g. in one job).
+        '''
+        stats = {key: value - (since or {}).get(key, 0) for key, value in self.counts.items()}
+        stats['dedup_ratio'] = stats['shots'] / max(stats['decoded'], 1)
+        return stats
@@ -0,0 +1,256 @@
+from EfficientSurfaceCodeSim.circuit_template import *
+import hashlib
+
+
+def get_unscanned_noise_key(circuit: stim.Circuit) -> str:
+    # Fingerprint of the noise that scan_noise_channels left to stim, reweighting requires it to be the same at both points
+    noise = '\n'.join(str(instruction) for instruction in circuit
+                      if stim.gate_data(instruction.name).is_noisy_gate and any(instruction.gate_args_copy()))
+    return hashlib.sha256(noise.encode()).hexdigest()
+
+
+def get_noise_channel_scan(builder: easure_circ_builder, explicit_pauli_channels: bool = False):
+    # scan_noise_channels of the builder's erasure circuit, kept on the builder
+    scans = builder.__dict__.setdefault('noise_channel_scans', {})
+    if explicit_pauli_channels not in scans:
+        blocks, _, rest = scan_noise_channels(builder.erasure_circuit.flattened(), 2 * (builder.distance + 1) ** 2,
+                                              explicit_pauli_channels)
+        scans[explicit_pauli_channels] = (blocks, get_unscanned_noise_key(rest))
+    return scans[explicit_pauli_channels]
+
+
+@dataclass
+class ShotRecords:
+    """
+    Columnar per-shot metadata of an MC run, saved as .npz next to the results.
+    The noise channels are grouped in classes of identical outcome distributions (e.g. all the erasure channels, all the 2q depolarizing ones),
+        and every shot keeps its number of flagged (heralded) and unflagged non-trivial outcomes per class.
+    An unflagged count of -1 means it wasn't observed, the stim sampler only tells the flags apart.
+    """
+    d: int
+    rounds: int
+    p_e: float
+    p_p: float
+    biased_erasure: bool
+    decoder: str
+    explicit_pauli_channels: bool  # whether the Pauli channels are classes too, otherwise they are in unscanned_noise_key
+    unscanned_noise_key: str
+    failed: np.ndarray  # (shots,) bool
+    flagged_counts: np.ndarray  # (shots, num_classes)
+    unflagged_counts: np.ndarray  # (shots, num_classes)
+    block_classes: np.ndarray  # (num_blocks,) class of every NoiseChannelBlock
+    class_sizes: np.ndarray  # (num_classes,) number of locations
+    class_probabilities: np.ndarray  # (num_classes, 16) outcome probabilities of one location
+
+    @property
+    def shots(self) -> int:
+        return len(self.failed)
+
+    @property
+    def num_erasures(self) -> np.ndarray:
+        return self.flagged_counts.sum(axis=1)
+
+    @property
+    def num_pauli_faults(self) -> np.ndarray:
+        # -1 for the shots whose non-heralded faults weren't all observed
+        counts = self.unflagged_counts.sum(axis=1)
+        return np.where((self.unflagged_counts < 0).any(axis=1), -1, counts)
+
+    def save(self, path: str):
+        content = {key: np.asarray(value) for key, value in vars(self).items()}
+        with open(path + '.tmp', 'wb') as f:
+            np.savez_compressed(f, **content)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path: str) -> 'ShotRecords':
+        with np.load(path) as content:
+            values = {key: content[key] for key in content.files}
+        for key in ['d', 'rounds']:
+            values[key] = int(values[key])
+        for key in ['p_e', 'p_p']:
+            values[key] = float(values[key])
+        for key in ['biased_erasure', 'explicit_pauli_channels']:
+            values[key] = bool(values[key])
+        for key in ['decoder', 'unscanned_noise_key']:
+            values[key] = str(values[key])
+        return cls(**values)
+
+    @classmethod
+    def concatenate(cls, records: List['ShotRecords']) -> 'ShotRecords':
+        # Shots of several runs of the same point, e.g. the chunks of a campaign
+        first = records[0]
+        for other in records[1:]:
+            assert (other.d, other.p_e, other.p_p, other.unscanned_noise_key) == (first.d, first.p_e, first.p_p, first.unscanned_noise_key)
+            assert np.array_equal(other.block_classes, first.block_classes)
+        merged = copy.copy(first)
+        for key in ['failed', 'flagged_counts', 'unflagged_counts']:
+            setattr(merged, key, np.concatenate([getattr(r, key) for r in records]))
+        return merged
+
+
+def get_channel_classes(blocks: List[NoiseChannelBlock]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    Blocks with the same outcome distribution and heralding form one class.
+    Returns the class of every block, the number of locations of every class and the outcome probabilities of every class.
+    '''
+    keys: Dict[Tuple, int] = {}
+    block_classes, sizes, probabilities = [], [], []
+    for block in blocks:
+        key = (block.flag_columns is not None, tuple(block.probabilities))
+        if key not in keys:
+            keys[key] = len(keys)
+            sizes.append(0)
+            probabilities.append(block.probabilities)
+        block_classes.append(keys[key])
+        sizes[keys[key]] += len(block.locations)
+    return np.array(block_classes, dtype=int), np.array(sizes, dtype=int), np.array(probabilities).reshape(-1, 16)
+
+
+def gen_shot_records(builder: easure_circ_builder,
+                     failed: np.ndarray,
+                     block_flagged_counts: np.ndarray,
+                     block_unflagged_counts: Optional[np.ndarray],
+                     explicit_pauli_channels: bool,
+                     decoder: str,
+                     p_e: float,
+                     p_p: float,
+                     biased_erasure: bool = True) -> ShotRecords:
+    '''
+    p_e, p_p, biased_erasure: the noise point of builder (see MCSampleDecodeJob.get_builder), reweighting rebuilds its neighbors from them.
+    block_*_counts: (shots, num_blocks) non-trivial outcomes of every block of get_noise_channel_scan(builder, explicit_pauli_channels),
+        block_unflagged_counts None if they weren't observed.
+    '''
+    blocks, unscanned_noise_key = get_noise_channel_scan(builder, explicit_pauli_channels)
+    block_classes, class_sizes, class_probabilities = get_channel_classes(blocks)
+    one_hot = np.zeros((len(blocks), len(class_sizes)), dtype=np.int32)
+    one_hot[np.arange(len(blocks)), block_classes] = 1
+    flagged_counts = np.asarray(block_flagged_counts, dtype=np.int32) @ one_hot
+    if block_unflagged_counts is not None:
+        unflagged_counts = np.asarray(block_unflagged_counts, dtype=np.int32) @ one_hot
+    else:
+        # Known to be 0 for the classes that only have flagged outcomes, like the erasure channels of this repo
+        only_flagged = np.array([block.unflagged_error_probability == 0 for block in blocks]) @ one_hot == one_hot.sum(axis=0)
+        unflagged_counts = np.where(only_flagged, 0, -1) * np.ones((len(failed), 1), dtype=np.int32)
+    return ShotRecords(d=builder.distance, rounds=builder.rounds, p_e=p_e, p_p=p_p, biased_erasure=biased_erasure, decoder=decoder,
+                       explicit_pauli_channels=explicit_pauli_channels, unscanned_noise_key=unscanned_noise_key,
+                       failed=np.asarray(failed, dtype=bool), flagged_counts=flagged_counts,
+                       unflagged_counts=unflagged_counts.astype(np.int32), block_classes=block_classes,
+                       class_sizes=class_sizes, class_probabilities=class_probabilities)
+
+
+def gen_shot_records_from_flags(builder: easure_circ_builder, meas_samples: np.ndarray, failed: np.ndarray, decoder: str,
+                                p_e: float, p_p: float, biased_erasure: bool = True) -> ShotRecords:
+    # Records of shots sampled by stim: only the erasure flags are seen
+    blocks, _ = get_noise_channel_scan(builder)
+    flags = np.asarray(meas_samples)[:, builder.get_erasure_flag_indices()]
+    counts = np.stack([flags[:, block.flag_columns].sum(axis=1) for block in blocks], axis=1) if blocks \
+        else np.zeros((len(flags), 0), dtype=np.int32)
+    return gen_shot_records(builder, failed, counts, None, False, decoder, p_e, p_p, biased_erasure)
+
+
+def gen_shot_records_from_sparse_flags(builder: easure_circ_builder, shots: SparseShots, failed: np.ndarray, decoder: str,
+                                       p_e: float, p_p: float, biased_erasure: bool = True) -> ShotRecords:
+    # gen_shot_records_from_flags for SparseShots, the flags are counted from the raised flag columns
+    blocks, _ = get_noise_channel_scan(builder)
+    counts = shots.get_flag_counts([block.flag_columns for block in blocks])
+    return gen_shot_records(builder, failed, counts, None, False, decoder, p_e, p_p, biased_erasure)
+
+
+def _split_outcome_probabilities(probabilities: np.ndarray, heralded: bool):
+    # P(flag), P(unflagged non-trivial outcome), and the distributions of the outcomes given each case
+    flagged_outcomes = np.isin(np.arange(16) % 4, [1, 2]) if heralded else np.zeros(16, dtype=bool)
+    flagged = np.where(flagged_outcomes, probabilities, 0)
+    unflagged = np.where(flagged_outcomes, 0, probabilities)
+    unflagged[0] = 0
+
+    def normalize(p):
+        return p / p.sum() if p.sum() > 0 else p
+    return flagged.sum(), unflagged.sum(), normalize(flagged), normalize(unflagged)
+
+
+def _count_log_ratio(counts, new, old):
+    # counts * log(new / old), where a count of 0 contributes nothing whatever the probabilities
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = np.log(new) - np.log(old)
+    if counts is None:
+        return 0
+    return np.where(counts > 0, counts * ratio, 0)
+
+
+def get_log_likelihood_ratios(records: ShotRecords, builder: easure_circ_builder) -> np.ndarray:
+    '''
+    log P_new(shot) / P_old(shot) of every recorded shot, with P_new the noise of builder.
+    Only the probabilities of flagged / unflagged / trivial outcomes may change between the two points,
+        the Pauli distributions given those, and the noise left to stim, have to be the same.
+    '''
+    blocks, unscanned_noise_key = get_noise_channel_scan(builder, records.explicit_pauli_channels)
+    if len(blocks) != len(records.block_classes) or unscanned_noise_key != records.unscanned_noise_key:
+        raise ValueError('the circuits differ in more than the rates of the recorded channels'
+                         + ('' if records.explicit_pauli_channels else ', record the shots with explicit_pauli_channels to reweight p_p'))
+    log_w = np.zeros(records.shots)
+    for c in range(len(records.class_sizes)):
+        members = [block for block, block_class in zip(blocks, records.block_classes) if block_class == c]
+        new_probabilities = members[0].probabilities
+        if any(not np.allclose(block.probabilities, new_probabilities, rtol=1e-12, atol=0) for block in members):
+            raise ValueError(f'channel class {c} splits at the new point')
+        heralded = members[0].flag_columns is not None
+        h, u, flagged_given, unflagged_given = _split_outcome_probabilities(records.class_probabilities[c], heralded)
+        h2, u2, flagged_given2, unflagged_given2 = _split_outcome_probabilities(new_probabilities, heralded)
+        if not (np.allclose(flagged_given, flagged_given2) and np.allclose(unflagged_given, unflagged_given2)):
+            raise ValueError(f'the Pauli distribution of channel class {c} changes, only its rates can be reweighted')
+        f = records.flagged_counts[:, c]
+        n = records.unflagged_counts[:, c]
+        trivial, trivial2 = 1 - h - u, 1 - h2 - u2
+        if (n < 0).any():
+            if not np.isclose(u, u2, rtol=1e-12, atol=0):
+                raise ValueError(f'the unflagged faults of channel class {c} were not recorded, its non-heralded rate must stay the same')
+            # unflagged outcomes of either kind, the split between them has the same odds at both points
+            log_w += _count_log_ratio(f, h2, h) + _count_log_ratio(records.class_sizes[c] - f, 1 - h2, 1 - h)
+        else:
+            log_w += _count_log_ratio(f, h2, h) + _count_log_ratio(n, u2, u) \
+                + _count_log_ratio(records.class_sizes[c] - f - n, trivial2, trivial)
+    return log_w
+
+
+def reweight_shot_records(records: ShotRecords,
+                          p_e: float,
+                          p_p: float,
+                          builder: Optional[easure_circ_builder] = None,
+                          min_ess_fraction: float = 0.1) -> Dict[str, float]:
+    '''
+    Estimate the logical error rate at (p_e, p_p) from shots recorded at (records.p_e, records.p_p), by likelihood ratio weights.
+    logical_error_rate is the unbiased mean of w * failed, self_normalized_rate divides by the sum of the weights instead of the shots.
+    ess is the Kish effective sample size of the weights, failure_ess the same restricted to the failed shots
+        (how many independent failures the estimate is worth). The estimate is flagged unreliable below min_ess_fraction of the shots,
+        far from the recorded point a handful of shots carry all the weight.
+    builder: the builder at (p_e, p_p), by default built from the records' circuit template.
+    The failures stay those of the decoder set up for the recorded point, whose weights assume the recorded rates.
+    '''
+    if builder is None:
+        builder = get_circuit_template(distance=records.d,
+                                       rounds=records.rounds,
+                                       mechanism_names=get_2q_mechanism_names(p_e=p_e, biased=records.biased_erasure),
+                                       measurement_error=0).get_builder(p_p=p_p, p_e=p_e)
+    weights = np.exp(get_log_likelihood_ratios(records, builder))
+    weighted_failures = weights * records.failed
+    ess = weights.sum() ** 2 / max((weights ** 2).sum(), 1e-300)
+    failure_ess = weighted_failures.sum() ** 2 / max((weighted_failures ** 2).sum(), 1e-300)
+    return {
+        'p_e': p_e,
+        'p_p': p_p,
+        'shots': records.shots,
+        'logical_error_rate': float(weighted_failures.mean()),
+        'std_error': float(weighted_failures.std(ddof=1) / np.sqrt(records.shots)) if records.shots > 1 else float('nan'),
+        'self_normalized_rate': float(weighted_failures.sum() / max(weights.sum(), 1e-300)),
+        'mean_weight': float(weights.mean()),  # 1 in expectation, far from it means the recorded shots don't cover the new point
+        'ess': float(ess),
+        'failure_ess': float(failure_ess),
+        'max_weight_fraction': float(weights.max() / max(weights.sum(), 1e-300)),
+        'reliable': bool(ess >= min_ess_fraction * records.shots),
+    }
+
+
+def reweight_to_sweep(records: ShotRecords, points: List[Tuple[float, float]], min_ess_fraction: float = 0.1) -> List[Dict[str, float]]:
+    # reweight_shot_records at every (p_e, p_p) of points, e.g. the neighbors of the recorded point in a sweep
+    return [reweight_shot_records(records, p_e, p_p, min_ess_fraction=min_ess_fraction) for p_e, p_p in points]
@@ -0,0 +1,123 @@
+import numpy as np
+import stim
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+
+def packed_to_sparse(packed: np.ndarray, count: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    CSR form of a (shots, bytes) little-endian bit-packed array, like stim's bit_packed=True output:
+        the indices of the set bits of shot i are indices[indptr[i]:indptr[i+1]], sorted.
+    Only the nonzero bytes are unpacked, so the cost follows the number of set bits rather than shots x bits.
+    count: the number of bits per shot, padding bits beyond it are dropped.
+    '''
+    packed = np.asarray(packed, dtype=np.uint8)
+    shots, columns = np.nonzero(packed)
+    bits = np.unpackbits(packed[shots, columns][:, None], axis=1, bitorder='little')
+    hits, offsets = np.nonzero(bits)
+    shots = shots[hits]
+    indices = columns[hits] * 8 + offsets
+    if count is not None:
+        keep = indices < count
+        shots, indices = shots[keep], indices[keep]
+    indptr = np.zeros(len(packed) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(shots, minlength=len(packed)), out=indptr[1:])
+    return indptr, indices
+
+
+def get_packed_bit_range(packed: np.ndarray, start: int, count: int) -> np.ndarray:
+    '''
+    Bits start..start+count of every row of a little-endian bit-packed array, packed again from bit 0 (e.g. the erasure flags,
+        the last measurements of a sample). Shifts whole byte columns, nothing is unpacked.
+    '''
+    packed = np.asarray(packed, dtype=np.uint8)
+    num_bytes = -(-count // 8)
+    first, shift = divmod(start, 8)
+    source = packed[:, first:first + num_bytes + 1]
+    if shift == 0:
+        out = source[:, :num_bytes].copy()
+    else:
+        following = np.zeros_like(source)
+        following[:, :-1] = source[:, 1:]
+        out = ((source >> shift) | (following << (8 - shift)))[:, :num_bytes]
+    if count % 8:
+        out[:, -1] &= (1 << (count % 8)) - 1
+    return out
+
+
+@dataclass
+class SparseShots:
+    """
+    A chunk of shots kept bit-packed (stim's little-endian layout, pymatching's bit_packed_shots input) and as sparse index lists,
+        so that decoding never has to materialize a dense (shots, num_detectors) or (shots, num_measurements) bool array.
+    det_packed: (shots, ceil(num_detectors / 8))
+    flag_packed: (shots, ceil(num_flags / 8)) the erasure flags only, in flag column order (see builder.get_erasure_flag_indices)
+    obs_packed: (shots, ceil(num_observables / 8))
+    The fired detectors of shot i are det_indices[det_indptr[i]:det_indptr[i+1]], its raised flag columns the same with flag_*.
+    """
+    det_packed: np.ndarray
+    flag_packed: np.ndarray
+    obs_packed: np.ndarray
+    num_detectors: int
+    num_flags: int
+
+    def __post_init__(self):
+        self.det_indptr, self.det_indices = packed_to_sparse(self.det_packed, self.num_detectors)
+        self.flag_indptr, self.flag_indices = packed_to_sparse(self.flag_packed, self.num_flags)
+
+    def __len__(self):
+        return len(self.det_packed)
+
+    def get_fired_detectors(self, i: int) -> np.ndarray:
+        return self.det_indices[self.det_indptr[i]:self.det_indptr[i + 1]]
+
+    def get_raised_flags(self, i: int) -> np.ndarray:
+        return self.flag_indices[self.flag_indptr[i]:self.flag_indptr[i + 1]]
+
+    def get_num_fired_detectors(self) -> np.ndarray:
+        return np.diff(self.det_indptr)
+
+    def get_actual_observables(self) -> np.ndarray:
+        # (shots,) observable 0, the only one the decoders predict
+        return (self.obs_packed[:, 0] & 1).astype(bool)
+
+    def get_flag_counts(self, column_groups) -> np.ndarray:
+        '''
+        (shots, len(column_groups)) number of raised flags of every shot among each group of flag columns
+            (e.g. the flag_columns of the noise channel blocks, see gen_shot_records_from_sparse_flags), a None group counts 0.
+        '''
+        group_of_column = np.full(self.num_flags, -1)
+        for g, columns in enumerate(column_groups):
+            if columns is not None:
+                group_of_column[columns] = g
+        shots = np.repeat(np.arange(len(self)), np.diff(self.flag_indptr))
+        groups = group_of_column[self.flag_indices]
+        keep = groups >= 0
+        counts = np.bincount(shots[keep] * len(column_groups) + groups[keep], minlength=len(self) * len(column_groups))
+        return counts.reshape(len(self), len(column_groups)).astype(np.int32)
+
+    def to_dense(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # The dense bool (det_samples, flags, actual_obs), for the decoders without a sparse version
+        det_samples = np.unpackbits(self.det_packed, axis=1, count=self.num_detectors, bitorder='little').astype(bool)
+        flags = np.unpackbits(self.flag_packed, axis=1, count=self.num_flags, bitorder='little').astype(bool)
+        return det_samples, flags, self.get_actual_observables()
+
+
+def sample_sparse_shots(erasure_circuit: stim.Circuit,
+                        num_flags: int,
+                        shots: int,
+                        seed: Optional[int] = None,
+                        reference_sample: Optional[np.ndarray] = None,
+                        converter: Optional[stim.CompiledMeasurementsToDetectionEventsConverter] = None) -> SparseShots:
+    '''
+    Sample erasure_circuit and convert to detection events with stim's bit-packed output end to end,
+        keeping only the last num_flags measurements (the erasure flags) of every measurement sample.
+    '''
+    sampler = erasure_circuit.compile_sampler(seed=seed, reference_sample=reference_sample)
+    if converter is None:
+        converter = erasure_circuit.compile_m2d_converter()
+    meas_packed = sampler.sample(shots=shots, bit_packed=True)
+    det_packed, obs_packed = converter.convert(measurements=meas_packed, separate_observables=True, bit_packed=True)
+    flag_packed = get_packed_bit_range(meas_packed, erasure_circuit.num_measurements - num_flags, num_flags)
+    return SparseShots(det_packed=det_packed, flag_packed=flag_packed, obs_packed=obs_packed,
+                       num_detectors=erasure_circuit.num_detectors, num_flags=num_flags)
@@ -0,0 +1,204 @@
+from EfficientSurfaceCodeSim.importance_sampling_job import *
+from EfficientSurfaceCodeSim.fault_enumeration import *
+
+
+def get_graphlike_distance(builder: easure_circ_builder) -> int:
+    # The fewest graphlike DEM errors of the erasure circuit that flip the observable without a detection event
+    dem = builder.erasure_circuit.detector_error_model(approximate_disjoint_errors=True, decompose_errors=True)
+    return len(dem.shortest_graphlike_error())
+
+
+def get_count_distribution(dice_probabilities: np.ndarray, max_count: int) -> np.ndarray:
+    '''
+    P(exactly n dice come up) for n = 0..max_count, the dice being independent with their own probabilities (Poisson binomial).
+    Dice with the same probability are folded in together as one binomial.
+    '''
+    distribution = np.zeros(max_count + 1)
+    distribution[0] = 1
+    probabilities, counts = np.unique(np.round(dice_probabilities, 15), return_counts=True)
+    for p, N in zip(probabilities, counts):
+        binomial = np.array([math.comb(int(N), n) * p**n * (1 - p)**(N - n) if n <= N else 0.0 for n in range(max_count + 1)])
+        distribution = np.convolve(distribution, binomial)[:max_count + 1]
+    return distribution
+
+
+@dataclass
+class StrataPruning:
+    """
+    Which (num_e_flipped, num_p_flipped) strata the decoder provably corrects.
+    Erasures are located, so matching corrects num_e_flipped + 2 num_p_flipped < distance, distance being the graphlike distance of the DEM.
+    Every candidate stratum small enough to enumerate is checked exactly with FaultEnumerator, the same posterior matching
+        as ImportanceSamplingDecodeJob. A stratum that fails lowers the bound to its weight, so nothing at or above it is pruned.
+    """
+    graphlike_distance: int
+    distance: int  # after the enumeration checks, strata of weight < distance are skipped
+    num_dice_e: int
+    num_dice_p: int
+    verified: Dict[Tuple[int, int], float] = field(default_factory=dict)  # (num_e_flipped, num_p_flipped) -> exact P(fail)
+    unverified: List[Tuple[int, int]] = field(default_factory=list)  # pruned by the bound only, too many combinations to enumerate
+
+    @staticmethod
+    def get_weight(num_e_flipped: int, num_p_flipped: int) -> int:
+        return num_e_flipped + 2 * num_p_flipped
+
+    def is_zero(self, num_e_flipped: int, num_p_flipped: int) -> bool:
+        if (num_e_flipped, num_p_flipped) in self.verified:
+            return self.verified[num_e_flipped, num_p_flipped] == 0
+        return self.get_weight(num_e_flipped, num_p_flipped) < self.distance
+
+
+def gen_strata_pruning(builder: easure_circ_builder,
+                       verify: bool = True,
+                       max_verified_flag_sets: int = 1000,
+                       max_verified_pauli_combinations: int = 10**5,
+                       print_progress: bool = False) -> StrataPruning:
+    '''
+    The StrataPruning of builder (a 2q erasure + 2q depo builder like the one ImportanceSamplingDecodeJob makes), kept on the builder.
+    A candidate stratum is enumerated when it has at most max_verified_flag_sets erasure dice combinations
+        (one posterior matching each) and max_verified_pauli_combinations depolarizing dice combinations.
+    '''
+    if 'strata_pruning' in builder.__dict__:
+        return builder.strata_pruning
+    if getattr(builder, 'helper', None) is None:
+        builder.generate_helper()
+    if getattr(builder, 'erasure_circuit', None) is None:
+        builder.gen_erasure_conversion_circuit()
+    census = builder.gen_fault_census()
+    graphlike_distance = get_graphlike_distance(builder)
+    pruning = StrataPruning(graphlike_distance=graphlike_distance, distance=graphlike_distance,
+                            num_dice_e=census.get('2q erasure').num_dice, num_dice_p=census.get('2q depo').num_dice)
+    candidates = sorted([(e, p) for p in range(graphlike_distance) for e in range(graphlike_distance)
+                         if 0 < pruning.get_weight(e, p) < graphlike_distance], key=lambda s: (pruning.get_weight(*s), s))
+    enumerator = None
+    for e, p in candidates:
+        if pruning.get_weight(e, p) >= pruning.distance:
+            break
+        if not verify or math.comb(pruning.num_dice_e, e) > max_verified_flag_sets \
+                or math.comb(pruning.num_dice_p, p) > max_verified_pauli_combinations:
+            pruning.unverified.append((e, p))
+            continue
+        if enumerator is None:
+            enumerator = FaultEnumerator(builder)
+        counts = tuple({'2q erasure': e, '2q depo': p}[name] for name in enumerator.mechanism_names)
+        t = time.time()
+        pruning.verified[e, p] = float(enumerator.failure_probability(counts)[0])
+        if print_progress:
+            print(f'num_e_flipped = {e}, num_p_flipped = {p}: P(fail) = {pruning.verified[e, p]:.3g} ({time.time()-t:.1f}s)')
+        if pruning.verified[e, p] > 0:
+            pruning.distance = pruning.get_weight(e, p)
+    # Candidates at or above a weight that turned out to fail are sampled after all
+    pruning.unverified = [s for s in pruning.unverified if pruning.get_weight(*s) < pruning.distance]
+    builder.strata_pruning = pruning
+    return pruning
+
+
+@dataclass
+class StratifiedImportanceSampling:
+    """
+    Importance sampling over every (num_e_flipped, num_p_flipped) stratum with num_e_flipped + num_p_flipped <= max_weight:
+        one ImportanceSamplingDecodeJob per stratum, the logical error rate being sum_s P(s) P(fail | s).
+    Strata that StrataPruning proves correctable are never sampled and count as P(fail | s) = 0,
+        their share of total_shots goes to the other strata (shots are split in proportion to P(s), at least min_shots each).
+    """
+    job_id: str
+    circuit_id: str
+    d: int
+    p_e: float
+    p_p: float
+    p_z_shift: float
+    p_m: float
+
+    total_shots: int
+    max_weight: int
+    min_shots: int = 100
+    prune: bool = True
+    verify_pruning: bool = True
+    dedup: bool = True
+
+    def get_builder(self) -> easure_circ_builder:
+        # The builder ImportanceSamplingDecodeJob makes for these parameters
+        if getattr(self, 'builder', None) is None:
+            self.builder = easure_circ_builder(rounds=self.d, distance=self.d,
+                                               after_cz_error_model=get_2q_error_model(p_e=self.p_e, p_p=self.p_p),
+                                               measurement_error=0)
+            self.builder.generate_helper()
+        return self.builder
+
+    def get_pruning(self, print_progress=False) -> Optional[StrataPruning]:
+        if not self.prune:
+            return None
+        return gen_strata_pruning(self.get_builder(), verify=self.verify_pruning, print_progress=print_progress)
+
+    def get_strata_probabilities(self) -> Dict[Tuple[int, int], float]:
+        census = self.get_builder().gen_fault_census()
+        distribution_e = get_count_distribution(census.get('2q erasure').dice_probabilities, self.max_weight)
+        distribution_p = get_count_distribution(census.get('2q depo').dice_probabilities, self.max_weight)
+        return {(e, p): float(distribution_e[e] * distribution_p[p])
+                for e in range(self.max_weight + 1) for p in range(self.max_weight + 1 - e)}
+
+    def allocate_shots(self, print_progress=False) -> Dict[Tuple[int, int], int]:
+        '''
+        Shots per stratum, 0 for the pruned ones.
+        '''
+        probabilities = self.get_strata_probabilities()
+        pruning = self.get_pruning(print_progress)
+        kept = [s for s in probabilities if s != (0, 0) and (pruning is None or not pruning.is_zero(*s))]
+        total = sum(probabilities[s] for s in kept)
+        shots = {s: 0 for s in probabilities}
+        budget = self.total_shots - self.min_shots * len(kept)
+        for s in kept:
+            shots[s] = self.min_shots + (int(budget * probabilities[s] / total) if budget > 0 and total > 0 else 0)
+        return shots
+
+    def gen_jobs(self, print_progress=False) -> List[ImportanceSamplingDecodeJob]:
+        return [ImportanceSamplingDecodeJob(job_id=f'{self.job_id}_e{e}_p{p}', circuit_id=self.circuit_id, d=self.d,
+                                            p_e=self.p_e, p_p=self.p_p, p_z_shift=self.p_z_shift, p_m=self.p_m,
+                                            shots=shots, num_e_flipped=e, num_p_flipped=p, dedup=self.dedup)
+                for (e, p), shots in self.allocate_shots(print_progress).items() if shots > 0]
+
+    def combine_results(self, results: List[Dict]) -> Dict:
+        '''
+        Combine the results of the jobs of gen_jobs (run anywhere) into the stratified estimate.
+        truncated_probability is P(more than max_weight dice), not sampled, so the estimate is a lower bound by up to that much.
+        '''
+        probabilities = self.get_strata_probabilities()
+        pruning = self.get_pruning()
+        strata = {}
+        for result in results:
+            s = (result['num_e_flipped'], result['num_p_flipped'])
+            shots, errors = strata.get(s, (0, 0))
+            strata[s] = (shots + result['shots'], errors + result['num_errors'])
+        rate, variance = 0.0, 0.0
+        for s, (shots, errors) in strata.items():
+            f = errors / shots
+            rate += probabilities[s] * f
+            variance += probabilities[s]**2 * f * (1 - f) / shots
+        pruned = [s for s in probabilities if s != (0, 0) and pruning is not None and pruning.is_zero(*s)]
+        return {
+            'job_id': str(self.job_id),
+            'circuit_id': str(self.circuit_id),
+            'd': int(self.d),
+            'p_e': float(self.p_e),
+            'p_p': float(self.p_p),
+            'max_weight': int(self.max_weight),
+            'logical_error_rate': float(rate),
+            'std_error': float(np.sqrt(variance)),
+            'shots': int(sum(shots for shots, _ in strata.values())),
+            'strata': {f'e{e}_p{p}': {'probability': probabilities[e, p], 'shots': int(shots), 'num_errors': int(errors)}
+                       for (e, p), (shots, errors) in sorted(strata.items())},
+            'pruned': [f'e{e}_p{p}' for e, p in pruned],
+            'pruned_probability': float(sum(probabilities[s] for s in pruned)),
+            'truncated_probability': float(max(1 - sum(probabilities.values()), 0)),
+            'graphlike_distance': None if pruning is None else int(pruning.graphlike_distance),
+            'pruning_distance': None if pruning is None else int(pruning.distance),
+            'unverified_pruned': [] if pruning is None else [f'e{e}_p{p}' for e, p in pruning.unverified],
+        }
+
+    def sample_and_print_result(self, print_progress=False):
+        results = []
+        for job in self.gen_jobs(print_progress):
+            results.append(job.sample_and_print_result())
+            if print_progress:
+                print(f"num_e_flipped = {job.num_e_flipped}, num_p_flipped = {job.num_p_flipped}: "
+                      f"{results[-1]['num_errors']} errors in {job.shots} shots")
+        return self.combine_results(results)
@@ -0,0 +1,179 @@
+from EfficientSurfaceCodeSim.mc_sampling_job import *
+from scipy.optimize import curve_fit, OptimizeWarning
+import warnings
+
+
+@dataclass
+class NoiseFamily:
+    """
+    A one-parameter family of noise points: p is the total two-qubit gate error rate,
+    a fixed fraction of which is erasure and the rest is depolarizing.
+    """
+    erasure_fraction: float
+    biased_erasure: bool = True
+
+    def get_p_e_p_p(self, p):
+        return p * self.erasure_fraction, p * (1 - self.erasure_fraction)
+
+
+def run_mc_point(d: int, p: float, shots: int, noise_family: NoiseFamily) -> int:
+    p_e, p_p = noise_family.get_p_e_p_p(p)
+    job = MCSampleDecodeJob(job_id='threshold', circuit_id=f'{d}_{p_e}_{p_p}', d=d, p_e=p_e, p_p=p_p,
+                            shots=shots, biased_erasure=noise_family.biased_erasure)
+    result = job.sample_and_print_result()
+    return result['num_errors']
+
+
+def finite_size_scaling_ansatz(X, p_th, nu, A, B, C):
+    # p_L = A + B x + C x^2 with x = (p - p_th) d^(1/nu), valid in a window around the threshold
+    p, d = X
+    x = (p - p_th) * d ** (1 / nu)
+    return A + B * x + C * x ** 2
+
+
+@dataclass
+class ThresholdEstimate:
+    p_th: float
+    ci_low: float
+    ci_high: float
+    nu: float
+    total_shots: int
+    num_points: int
+
+
+@dataclass
+class AdaptiveThresholdFinder:
+    """
+    Instead of a dense (d, p) grid, fit the finite-size scaling ansatz as data comes in and
+    spend each new batch of shots on the (d, p) points that shrink the variance of the fitted p_th the most,
+    using the Fisher information of the binomial counts under the current fit.
+    A batch is split into shot_quanta equal parts handed out one at a time, so the points of a batch get different shot counts.
+    When a fit fails the previous fit is kept and the next batch goes to the initial grid again, so no data is lost.
+    """
+    noise_family: NoiseFamily
+    distances: List[int]
+    p_min: float
+    p_max: float
+    shots_per_iteration: int = 20000
+    points_per_iteration: int = 4  # at most this many distinct points per batch
+    shot_quanta: int = 16
+    max_iterations: int = 20
+    target_relative_half_width: float = 0.02  # stop when the 95% CI half-width is this fraction of p_th
+    num_initial_p: int = 3
+    run_point: Callable[[int, float, int, NoiseFamily], int] = run_mc_point
+    shot_cost: Callable[[int], float] = lambda d: d ** 3  # relative cost of one shot at distance d
+
+    def __post_init__(self):
+        self.data: Dict[Tuple[int, float], List[int]] = {}  # (d, p) -> [num_errors, shots]
+        self.fit_params = None
+        self.fit_cov = None
+        self.fit_failures = 0
+
+    def add_result(self, d, p, num_errors, shots):
+        errors_and_shots = self.data.setdefault((d, p), [0, 0])
+        errors_and_shots[0] += int(num_errors)
+        errors_and_shots[1] += int(shots)
+
+    def _arrays(self):
+        keys = sorted(self.data)
+        p = np.array([k[1] for k in keys])
+        d = np.array([k[0] for k in keys], dtype=float)
+        errors = np.array([self.data[k][0] for k in keys], dtype=float)
+        shots = np.array([self.data[k][1] for k in keys], dtype=float)
+        # Add-one smoothing so that points with zero errors still get a finite uncertainty
+        rate = (errors + 1) / (shots + 2)
+        sigma = np.sqrt(rate * (1 - rate) / shots)
+        return p, d, errors / shots, sigma
+
+    def fit(self) -> bool:
+        '''
+        Refit the ansatz to all the data. Returns False if curve_fit fails or can't estimate the covariance,
+            fit_params and fit_cov then stay at the previous fit (None before the first successful one).
+        '''
+        p, d, rate, sigma = self._arrays()
+        if self.fit_params is None:
+            p0 = [(self.p_min + self.p_max) / 2, 1.0, np.mean(rate), np.ptp(rate) / (self.p_max - self.p_min), 0]
+        else:
+            p0 = self.fit_params
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', OptimizeWarning)
+                params, cov = curve_fit(finite_size_scaling_ansatz, (p, d), rate, p0=p0, sigma=sigma,
+                                        absolute_sigma=True, maxfev=20000)
+        except (RuntimeError, ValueError):
+            params, cov = None, None
+        if params is None or not np.all(np.isfinite(cov)):
+            self.fit_failures += 1
+            return False
+        self.fit_params, self.fit_cov = params, cov
+        return True
+
+    def get_estimate(self) -> ThresholdEstimate:
+        if self.fit_params is None:
+            return ThresholdEstimate(p_th=np.nan, ci_low=np.nan, ci_high=np.nan, nu=np.nan,
+                                     total_shots=int(sum(v[1] for v in self.data.values())), num_points=len(self.data))
+        p_th, nu = self.fit_params[0], self.fit_params[1]
+        half_width = 1.96 * np.sqrt(self.fit_cov[0, 0])
+        return ThresholdEstimate(p_th=float(p_th), ci_low=float(p_th - half_width), ci_high=float(p_th + half_width),
+                                 nu=float(nu),
+                                 total_shots=int(sum(v[1] for v in self.data.values())),
+                                 num_points=len(self.data))
+
+    def get_initial_points(self, shots_per_iteration: Optional[int] = None) -> List[Tuple[int, float, int]]:
+        # The coarse grid, num_initial_p values of p at every distance
+        shots = max((shots_per_iteration or self.shots_per_iteration) // (self.num_initial_p * len(self.distances)), 1)
+        return [(d, float(p), shots) for d in self.distances for p in np.linspace(self.p_min, self.p_max, self.num_initial_p)]
+
+    def propose_points(self) -> List[Tuple[int, float, int]]:
+        '''
+        Greedy design: hand out the shots_per_iteration shots one quantum at a time, each to the candidate (d, p) whose information,
+            per unit cost, lowers Var(p_th) the most. A point can get several quanta, and at most points_per_iteration points get any.
+        '''
+        p_th, sigma_p_th = self.fit_params[0], np.sqrt(self.fit_cov[0, 0])
+        spread = max(3 * sigma_p_th, 0.02 * abs(p_th))
+        candidate_p = np.clip(np.linspace(p_th - spread, p_th + spread, 9), self.p_min, self.p_max)
+        shots_per_point = max(self.shots_per_iteration // self.shot_quanta, 1)  # one quantum
+        precision = np.linalg.pinv(self.fit_cov)
+        eps = 1e-6 * max(abs(p_th), 1e-6)
+
+        def information(d, p):
+            # gradient of the model w.r.t. the fit parameters, by central differences
+            grad = np.zeros(len(self.fit_params))
+            for k in range(len(self.fit_params)):
+                step = np.zeros(len(self.fit_params))
+                step[k] = eps if k == 0 else 1e-6
+                grad[k] = (finite_size_scaling_ansatz((p, d), *(self.fit_params + step))
+                           - finite_size_scaling_ansatz((p, d), *(self.fit_params - step))) / (2 * step[k])
+            rate = np.clip(finite_size_scaling_ansatz((p, d), *self.fit_params), 1e-4, 1 - 1e-4)
+            return shots_per_point * np.outer(grad, grad) / (rate * (1 - rate))
+
+        chosen: Dict[Tuple[int, float], int] = {}
+        for _ in range(self.shot_quanta):
+            best, best_score = None, -np.inf
+            current_variance = np.linalg.pinv(precision)[0, 0]
+            candidates = list(chosen) if len(chosen) >= self.points_per_iteration else \
+                [(d, float(p)) for d in self.distances for p in candidate_p]
+            for d, p in candidates:
+                new_variance = np.linalg.pinv(precision + information(d, p))[0, 0]
+                score = (current_variance - new_variance) / self.shot_cost(d)
+                if score > best_score:
+                    best, best_score = (d, p), score
+            precision = precision + information(*best)
+            chosen[best] = chosen.get(best, 0) + shots_per_point
+        return [(d, p, shots) for (d, p), shots in chosen.items()]
+
+    def run(self, print_progress=False) -> ThresholdEstimate:
+        for d, p, shots in self.get_initial_points():
+            self.add_result(d, p, self.run_point(d, p, shots, self.noise_family), shots)
+        fitted = self.fit()
+        for iteration in range(self.max_iterations):
+            estimate = self.get_estimate()
+            if print_progress:
+                print(f'iteration {iteration}: p_th = {estimate.p_th:.5f} [{estimate.ci_low:.5f}, {estimate.ci_high:.5f}], '
+                      f'{estimate.total_shots} shots' + ('' if fitted else ', fit failed, resampling the initial grid'))
+            if fitted and (estimate.ci_high - estimate.ci_low) / 2 < self.target_relative_half_width * abs(estimate.p_th):
+                break
+            for d, p, shots in (self.propose_points() if fitted else self.get_initial_points()):
+                self.add_result(d, p, self.run_point(d, p, shots, self.noise_family), shots)
+            fitted = self.fit()
+        return self.get_estimate()
@@ -1,7 +1,126 @@
-import matplotlib.pyplot as plt
-from matplotlib.patches import Polygon
 import numpy as np
 
+# matplotlib is only imported by the draw functions, so the simulation modules never pay for it.
+
+X_STABILIZER_COLOR = (1, 1, 0.6)
+Z_STABILIZER_COLOR = (0.6, 1, 0.6)
+
+
+def _new_figure(num_panels, figsize, show):
+    # With show=False the figure isn't attached to pyplot, so it renders headless (no display, no GUI backend)
+    if show:
+        import matplotlib.pyplot as plt
+        fig, axs = plt.subplots(1, num_panels, figsize=figsize, squeeze=False)
+    else:
+        from matplotlib.figure import Figure
+        fig = Figure(figsize=figsize)
+        axs = fig.subplots(1, num_panels, squeeze=False)
+    return fig, axs[0]
+
+
+def _finish_figure(fig, save_path, show):
+    fig.tight_layout()
+    if save_path is not None:
+        fig.savefig(save_path, transparent=True)  # the format follows the extension: .pdf, .svg, .png...
+    if show:
+        import matplotlib.pyplot as plt
+        plt.show()
+
+
+def _stabilizer_polygons(measurement_qubits, q2p, bulk, boundary_triangle):
+    # A square around every stabilizer in the bulk, a triangle pointing inwards on the boundary
+    polygons = []
+    for q in measurement_qubits:
+        x, y = q2p[q].real, q2p[q].imag
+        if bulk(x, y):
+            polygons.append([(x - 1, y - 1), (x + 1, y - 1), (x + 1, y + 1), (x - 1, y + 1)])
+        else:
+            polygons.append(boundary_triangle(x, y))
+    return polygons
+
+
+def draw_layout(ax, x_measurement_qubits, measurement_qubits, data_qubits, q2p, labels=True):
+    '''
+    The checkerboard of X (yellow) and Z (green) stabilizers, one PolyCollection per type, and optionally the qubit indices.
+    '''
+    from matplotlib.collections import PolyCollection
+    x_set = set(x_measurement_qubits)
+    z_measurement_qubits = [q for q in measurement_qubits if q not in x_set]
+    top = max(q2p[q].imag for q in measurement_qubits)
+    bottom = min(q2p[q].imag for q in measurement_qubits)
+    right = max(q2p[q].real for q in measurement_qubits)
+    left = min(q2p[q].real for q in measurement_qubits)
+
+    x_polygons = _stabilizer_polygons(
+        x_measurement_qubits, q2p, lambda x, y: y != top and y != bottom,
+        lambda x, y: [(x - 1, y - 1), (x + 1, y - 1), (x, y)] if y == top else [(x - 1, y + 1), (x + 1, y + 1), (x, y)])
+    z_polygons = _stabilizer_polygons(
+        z_measurement_qubits, q2p, lambda x, y: x != right and x != left,
+        lambda x, y: [(x + 1, y + 1), (x + 1, y - 1), (x, y)] if x == left else [(x - 1, y - 1), (x - 1, y + 1), (x, y)])
+    ax.add_collection(PolyCollection(x_polygons, facecolors=[X_STABILIZER_COLOR], edgecolors='none', alpha=0.5))
+    ax.add_collection(PolyCollection(z_polygons, facecolors=[Z_STABILIZER_COLOR], edgecolors='none', alpha=0.5))
+
+    ax.set_aspect('equal', adjustable='box')
+    ax.set_xlim(left, right)
+    ax.set_ylim(bottom, top)
+    for spine in ax.spines.values():
+        spine.set_visible(False)
+    ax.set_xticks([])
+    ax.set_yticks([])
+
+    if labels:
+        for q in list(measurement_qubits) + list(data_qubits):
+            ax.text(q2p[q].real, q2p[q].imag, str(q), fontsize=12, ha='left', va='center', color='blue')
+
+
+def _pairs(targets, q2p):
+    # [control0, target0, control1, target1...] -> (n, 2) complex positions
+    positions = np.array([q2p[q] for q in targets], dtype=complex).reshape(-1, 2)
+    return positions[:, 0], positions[:, 1]
+
+
+def _circles(ax, centers, radius, facecolor, edgecolor, linewidth=1):
+    # Circles with a radius in data units, all in one artist
+    from matplotlib.collections import EllipseCollection
+    offsets = np.stack([centers.real, centers.imag], axis=1)
+    return EllipseCollection(widths=2 * radius, heights=2 * radius, angles=0, units='xy', offsets=offsets, offset_transform=ax.transData,
+                             facecolors=facecolor, edgecolors=edgecolor, linewidths=linewidth)
+
+
+def draw_two_qubit_gates(ax, one_fourth_cycle, q2p, native_cx, native_cz):
+    '''
+    One layer of CX / CZ gates as one LineCollection for the wires and ⊕ symbols plus one EllipseCollection per kind of dot.
+    '''
+    from matplotlib.collections import LineCollection
+    from matplotlib.colors import to_rgba
+    cnot_circle_color = 'black' if native_cx else 'red'
+    cz_target_dot_color = 'black' if native_cz else 'red'
+    segments, colors = [], []
+
+    if one_fourth_cycle['CX']:
+        controls, targets = _pairs(one_fourth_cycle['CX'], q2p)
+        direction = (targets - controls) / np.abs(targets - controls)
+        perpendicular = direction * 1j
+        ends = [(controls, targets, 'black'),
+                (targets, targets + 0.2 * direction, cnot_circle_color),
+                (targets, targets + 0.2 * perpendicular, cnot_circle_color),
+                (targets, targets - 0.2 * perpendicular, cnot_circle_color)]
+        for start, end, color in ends:
+            segments.append(np.stack([np.stack([start.real, start.imag], axis=1), np.stack([end.real, end.imag], axis=1)], axis=1))
+            colors.extend([to_rgba(color)] * len(start))
+        ax.add_collection(_circles(ax, targets, 0.2, 'none', cnot_circle_color))
+
+    if one_fourth_cycle['CZ']:
+        controls, targets = _pairs(one_fourth_cycle['CZ'], q2p)
+        segments.append(np.stack([np.stack([controls.real, controls.imag], axis=1),
+                                  np.stack([targets.real, targets.imag], axis=1)], axis=1))
+        colors.extend([to_rgba('black')] * len(controls))
+        ax.add_collection(_circles(ax, targets, 0.05, cz_target_dot_color, cz_target_dot_color, 2))
+        ax.add_collection(_circles(ax, controls, 0.05, 'black', 'black', 2))
+
+    if segments:
+        ax.add_collection(LineCollection(np.concatenate(segments), colors=colors, linewidths=1))
+
 
 def visualize(meas_q_with_before_and_after_round_H,
               x_measurement_qubits,
@@ -9,140 +128,129 @@ def visualize(meas_q_with_before_and_after_round_H,
               data_qubits,
               q2p,
               two_q_gate_targets,
-              native_cx, 
-              native_cz):
-
-    z_measurement_qubits = [q for q in measurement_qubits if q not in x_measurement_qubits]
-
-    top = max([q2p[q].imag for q in measurement_qubits])
-    bottom = min([q2p[q].imag for q in measurement_qubits])
-    right = max([q2p[q].real for q in measurement_qubits])
-    left = min([q2p[q].real for q in measurement_qubits])
-
-    fig, axs = plt.subplots(1, 6, figsize=(6*len(two_q_gate_targets), 8))
-
-    ##########################################
-    # Draw the checkerboard
-    ##########################################
-    for i in range(6):
-        ax = axs[i]
-        ax.set_aspect('equal', adjustable='box')
-        ax.set_xlim(left, right)
-        ax.set_ylim(bottom, top)
-        ax.spines['left'].set_visible(False)
-        ax.spines['right'].set_visible(False)
-        ax.spines['top'].set_visible(False)
-        ax.spines['bottom'].set_visible(False)
-        ax.set_xticks([])
-        ax.set_yticks([])
-
-        for meas_q in x_measurement_qubits:
-            coord = q2p[meas_q]
-            if coord.imag != top and coord.imag != bottom:
-                ax.fill([coord.real-1, coord.real + 1, coord.real + 1, coord.real - 1],
-                        [coord.imag-1, coord.imag-1, coord.imag+1, coord.imag+1],
-                        color=(1, 1, 0.6), alpha=0.5)
-            elif coord.imag == top:
-                triangle = Polygon([[coord.real-1,coord.imag-1],[coord.real + 1,coord.imag-1],[coord.real,coord.imag]], closed=True, facecolor=(1, 1, 0.6), alpha=0.5)
-                ax.add_patch(triangle)
-            elif coord.imag == bottom:
-                triangle = Polygon([[coord.real-1,coord.imag+1],[coord.real + 1,coord.imag+1],[coord.real,coord.imag]], closed=True, facecolor=(1, 1, 0.6), alpha=0.5)
-                ax.add_patch(triangle)
-
-        for meas_q in z_measurement_qubits:
-            coord = q2p[meas_q]
-            if coord.real != right and coord.real != left:
-                ax.fill([coord.real-1, coord.real + 1, coord.real + 1, coord.real - 1],
-                        [coord.imag-1, coord.imag-1, coord.imag+1, coord.imag+1],
-                       color = (0.6, 1, 0.6), alpha=0.5)
-            elif coord.real == left:
-                triangle = Polygon([[coord.real+1,coord.imag+1],[coord.real + 1,coord.imag-1],[coord.real,coord.imag]], closed=True, facecolor=(0.6, 1, 0.6), alpha=0.5)
-                ax.add_patch(triangle)
-            elif coord.real == right:
-                triangle = Polygon([[coord.real-1,coord.imag-1],[coord.real - 1,coord.imag+1],[coord.real,coord.imag]], closed=True, facecolor=(0.6, 1, 0.6), alpha=0.5)
-                ax.add_patch(triangle)
-
-        for meas_q in measurement_qubits:
-            coord = q2p[meas_q]
-            ax.text(coord.real, coord.imag, str(meas_q), fontsize=12, ha='left', va='center',color = 'blue')
-        for data_q in data_qubits:
-            coord = q2p[data_q]
-            ax.text(coord.real, coord.imag, str(data_q), fontsize=12, ha='left', va='center',color = 'blue')
-
-    ##########################################
-    # The first and last plot (Hadamards)
-    ##########################################
-    for i in [0,5]:
-        ax = axs[i]
-        for meas_q in meas_q_with_before_and_after_round_H:
-            coord = q2p[meas_q]
-            ax.text(coord.real, coord.imag, 'H', fontsize=20, ha='center', va='center')
-
-    ##########################################
-    # The middle four plots (CNOTs)
-    ##########################################
-    cnot_circle_color = 'black' if native_cx else 'red'
-    cz_target_dot_color = 'black' if native_cz else 'red'
+              native_cx,
+              native_cz,
+              labels=None,
+              save_path='circ.pdf',
+              show=True,
+              figsize=None):
+    '''
+    One panel for the Hadamards before the round, one per layer of 2q gates, one for the Hadamards after the round.
+    labels: draw the qubit indices, by default only for layouts small enough to read them (d <= 7).
+    save_path: None to skip saving. show=False draws on a figure detached from pyplot, for headless export.
+    Returns the figure and its axes.
+    '''
+    num_panels = 2 + len(two_q_gate_targets)
+    if labels is None:
+        labels = len(data_qubits) <= 49
+    fig, axs = _new_figure(num_panels, figsize or (4 * num_panels, 4.5), show)
+    for ax in axs:
+        draw_layout(ax, x_measurement_qubits, measurement_qubits, data_qubits, q2p, labels)
+
+    # The first and last panels (Hadamards)
+    hadamard_positions = np.array([q2p[q] for q in meas_q_with_before_and_after_round_H or []], dtype=complex)
+    for ax in [axs[0], axs[-1]]:
+        ax.scatter(hadamard_positions.real, hadamard_positions.imag, marker='$H$', s=150, color='black', clip_on=False)
+
+    # The middle panels (2q gates)
     if not native_cx or not native_cz:
         print("Red color on 2q gate target qubit means it's sandwiched by Hadamards")
-    for idx, one_fourth_cycle in enumerate(two_q_gate_targets):
-        ax = axs[idx+1]
-        if one_fourth_cycle['CX'] != []:
-            cnots = []
-            for i in range(0, len(one_fourth_cycle['CX']), 2):
-                sublist = one_fourth_cycle['CX'][i:i + 2]
-                cnots.append(sublist)
-
-            for cnot in cnots:
-
-                x1 = q2p[cnot[0]].real
-                x2 = q2p[cnot[1]].real
-                y1 = q2p[cnot[0]].imag
-                y2 = q2p[cnot[1]].imag
-                ax.plot([x1, x2], [y1, y2], linewidth=1, color='black')
-                dx, dy = x2 - x1, y2 - y1
-                length = np.sqrt(dx ** 2 + dy ** 2)
-                dx /= length
-                dy /= length
-                extended_x2 = x2 + 0.2 * dx
-                extended_y2 = y2 + 0.2 * dy
-                ax.plot([x2, extended_x2], [y2, extended_y2], linewidth=1, color=cnot_circle_color)
-
-                # Calculate perpendicular vectors
-                perp_dx = -dy
-                perp_dy = dx
-
-                # Calculate extended coordinates for perpendicular segments
-                extended_perp_x1 = x2 + 0.2 * perp_dx
-                extended_perp_y1 = y2 + 0.2 * perp_dy
-                extended_perp_x2 = x2 - 0.2 * perp_dx
-                extended_perp_y2 = y2 - 0.2 * perp_dy
-
-                # Plot CNOT
-                # Plot perpendicular segments
-                ax.plot([x2, extended_perp_x1], [y2, extended_perp_y1], linewidth=1, color=cnot_circle_color)
-                ax.plot([x2, extended_perp_x2], [y2, extended_perp_y2], linewidth=1, color=cnot_circle_color)
-
-                # Plot circle around (x2, y2)
-                ax.add_patch(plt.Circle((x2, y2), 0.2, linewidth=1, fill=False, color=cnot_circle_color))
-
-        if one_fourth_cycle['CZ'] != []:
-            czs = []
-            for i in range(0, len(one_fourth_cycle['CZ']), 2):
-                sublist = one_fourth_cycle['CZ'][i:i + 2]
-                czs.append(sublist)
-
-            for cz in czs:
-                x1 = q2p[cz[0]].real
-                x2 = q2p[cz[1]].real
-                y1 = q2p[cz[0]].imag
-                y2 = q2p[cz[1]].imag
-                ax.plot([x1, x2], [y1, y2], linewidth=1, color='black')
-
-                ax.add_patch(plt.Circle((x2, y2), 0.05, linewidth=2, fill=True,color=cz_target_dot_color))
-                ax.add_patch(plt.Circle((x1, y1), 0.05, linewidth=2, fill=True,color='black'))
-
-    plt.tight_layout()
-    plt.savefig('circ.pdf', transparent=True)
-    plt.show()
-    return fig, axs
\ No newline at end of file
+    for ax, one_fourth_cycle in zip(axs[1:-1], two_q_gate_targets):
+        draw_two_qubit_gates(ax, one_fourth_cycle, q2p, native_cx, native_cz)
+
+    _finish_figure(fig, save_path, show)
+    return fig, axs
+
+
+def visualize_helper(helper, **kwargs):
+    # visualize() of a rotated_surface_code_circuit_helper (e.g. builder.helper), kwargs go to visualize()
+    return visualize(helper.meas_q_with_before_and_after_round_H, helper.x_measurement_qubits, helper.measurement_qubits,
+                     helper.data_qubits, helper.q2p, helper.two_q_gate_targets, helper.native_cx, helper.native_cz, **kwargs)
+
+
+def _detector_rounds_by_tick(circuit):
+    # (tick at which each round's first detector is declared, its time coordinate), to place a TICK in a round
+    ticks, rounds = [], []
+    tick = 0
+    seen = set()
+    for instruction in circuit.flattened():
+        if instruction.name == 'TICK':
+            tick += 1
+        elif instruction.name == 'DETECTOR':
+            t = instruction.gate_args_copy()[2]
+            if t not in seen:
+                seen.add(t)
+                ticks.append(tick)
+                rounds.append(t)
+    return np.array(ticks), np.array(rounds)
+
+
+def visualize_shot(builder,
+                   single_detector_sample,
+                   single_measurement_sample,
+                   curve='S',
+                   matching=None,
+                   labels=None,
+                   save_path=None,
+                   show=True,
+                   figsize=(8, 7),
+                   cmap='viridis'):
+    '''
+    Overlay one decoded shot on the layout, all rounds projected on the plane and colored by round:
+        erased data qubits (squares), detection events (dots), and the edges the decoder matched (lines, a ring for the boundary).
+    matching: the pymatching.Matching that decodes the shot, by default the posterior matching of 'new_circ'.
+    Returns the figure and its axes.
+    '''
+    from matplotlib.collections import LineCollection
+    from matplotlib import colormaps
+    from matplotlib.colors import Normalize
+    helper = builder.helper
+    circuit = builder.erasure_circuit
+    det = np.asarray(single_detector_sample, dtype=bool)
+    coordinates = circuit.get_detector_coordinates()
+    positions = np.array([complex(coordinates[k][0], coordinates[k][1]) for k in range(circuit.num_detectors)])
+    detector_rounds = np.array([coordinates[k][2] for k in range(circuit.num_detectors)])
+    norm = Normalize(vmin=detector_rounds.min(), vmax=max(detector_rounds.max(), detector_rounds.min() + 1))
+    colormap = colormaps[cmap]
+
+    if labels is None:
+        labels = len(helper.data_qubits) <= 49
+    fig, axs = _new_figure(1, figsize, show)
+    ax = axs[0]
+    draw_layout(ax, helper.x_measurement_qubits, helper.measurement_qubits, helper.data_qubits, helper.q2p, labels)
+    ax.set_xlim(ax.get_xlim()[0] - 1, ax.get_xlim()[1] + 1)
+    ax.set_ylim(ax.get_ylim()[0] - 1, ax.get_ylim()[1] + 1)
+
+    # Erasure sites
+    if getattr(builder, 'erasure_site_table', None) is None:
+        builder.gen_erasure_site_table()
+    table = builder.erasure_site_table
+    flagged = table.get_flags(single_measurement_sample).astype(bool)
+    round_ticks, round_coordinates = _detector_rounds_by_tick(circuit)
+    site_rounds = round_coordinates[np.minimum(np.searchsorted(round_ticks, table.ticks[flagged]), len(round_ticks) - 1)]
+    site_positions = np.array([helper.q2p[q] for q in table.data_qubits[flagged]], dtype=complex)
+    ax.scatter(site_positions.real, site_positions.imag, marker='s', s=120, facecolors='none',
+               edgecolors=colormap(norm(site_rounds)), linewidths=2, label='erasure')
+
+    # Matched edges
+    if matching is None:
+        matching = builder.gen_posterior_matching(single_measurement_sample, curve)
+    edges = np.asarray(matching.decode_to_edges_array(det)).reshape(-1, 2)
+    inner = edges[(edges >= 0).all(axis=1)]
+    to_boundary = edges[(edges < 0).any(axis=1)].max(axis=1)
+    segments = np.stack([np.stack([positions[inner[:, 0]].real, positions[inner[:, 0]].imag], axis=1),
+                         np.stack([positions[inner[:, 1]].real, positions[inner[:, 1]].imag], axis=1)], axis=1)
+    ax.add_collection(LineCollection(segments.reshape(-1, 2, 2), colors=colormap(norm(detector_rounds[inner[:, 0]])) if len(inner) else 'black',
+                                     linewidths=2))
+    ax.scatter(positions[to_boundary].real, positions[to_boundary].imag, s=260, facecolors='none',
+               edgecolors=colormap(norm(detector_rounds[to_boundary])), linewidths=1.5, label='matched to boundary')
+
+    # Detection events
+    fired = np.flatnonzero(det)
+    points = ax.scatter(positions[fired].real, positions[fired].imag, s=60, c=detector_rounds[fired], cmap=colormap, norm=norm,
+                        edgecolors='black', zorder=3, label='detection event')
+    fig.colorbar(points, ax=ax, label='round')
+    ax.legend(loc='upper center', bbox_to_anchor=(0.5, 0), ncol=3, fontsize=8)
+
+    _finish_figure(fig, save_path, show)
+    return fig, ax
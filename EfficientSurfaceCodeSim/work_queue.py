@@ -0,0 +1,245 @@
+from EfficientSurfaceCodeSim.mc_sampling_job import *
+from EfficientSurfaceCodeSim.worker_daemon import *
+import socket
+import socketserver
+import threading
+
+
+# Wire format: one JSON object per line in each direction, one request per connection.
+#   {'op': 'lease', 'worker': id}                          -> {'unit': unit dict or None, 'finished': bool}
+#   {'op': 'heartbeat', 'worker': id, 'unit_id': id, 'shots_done': n}    -> {'ok': bool, 'shots': current size of the unit}
+#   {'op': 'report', 'unit_id': id, 'shots': n, 'errors': k, 'result': {...}} -> {'ok': bool}
+#   {'op': 'status'}                                       -> coordinator.get_status()
+
+
+@dataclass
+class WorkUnit:
+    unit_id: str
+    circuit_id: str
+    spec: Dict[str, Any]  # MCSampleDecodeJob kwargs other than job_id/circuit_id/shots
+    start: int  # shot range [start, start + shots) of the campaign, the chunk seeds are derived from it when spec has a seed
+    shots: int
+    chunk_shots: int  # the worker heartbeats before every chunk of this many shots
+
+    # lease state
+    worker: Optional[str] = None
+    lease_expiry: float = 0
+    shots_done: int = 0
+
+    def to_dict(self):
+        return {'unit_id': self.unit_id, 'circuit_id': self.circuit_id, 'spec': self.spec,
+                'start': self.start, 'shots': self.shots, 'chunk_shots': self.chunk_shots}
+
+
+@dataclass
+class WorkQueueCoordinator:
+    """
+    Pull-based replacement for handing fixed chunk folders to HTCondor: workers lease shot ranges, heartbeat, and report counts.
+    A lease that isn't renewed within lease_time seconds goes back to the queue.
+    When the queue runs dry, a worker asking for work gets the far end of the biggest leased unit instead of idling,
+        the unit's owner learns its new size at its next heartbeat.
+    """
+    lease_time: float = 60
+    min_unit_shots: int = 1000  # never split below this
+
+    def __post_init__(self):
+        self.lock = threading.Lock()
+        self.pending: List[WorkUnit] = []
+        self.leased: Dict[str, WorkUnit] = {}
+        self.completed: Dict[str, Dict] = {}
+        self.totals: Dict[str, Dict[str, int]] = {}  # circuit_id -> {'shots', 'errors'}
+        self.counts = {'leases': 0, 'expired': 0, 'splits': 0, 'duplicate_reports': 0}
+        self.server = None
+        self.next_unit_index = 0
+
+    def _new_unit_id(self, circuit_id):
+        self.next_unit_index += 1
+        return f'{circuit_id}_u{self.next_unit_index}'
+
+    def add_campaign(self, spec: Dict[str, Any], circuit_id: str, total_shots: int, unit_shots: int, chunk_shots: Optional[int] = None):
+        '''
+        Queue total_shots shots of the job described by spec (MCSampleDecodeJob kwargs) in units of unit_shots.
+        A seed in spec seeds the whole campaign, every chunk draws its shots with a seed derived from (seed, first shot of the chunk).
+        '''
+        chunk_shots = chunk_shots or min(unit_shots, self.min_unit_shots)
+        with self.lock:
+            self.totals.setdefault(circuit_id, {'shots': 0, 'errors': 0})
+            for start in range(0, total_shots, unit_shots):
+                self.pending.append(WorkUnit(unit_id=self._new_unit_id(circuit_id), circuit_id=circuit_id, spec=dict(spec),
+                                             start=start, shots=min(unit_shots, total_shots - start), chunk_shots=chunk_shots))
+
+    def _requeue_expired_leases(self, now):
+        for unit_id, unit in list(self.leased.items()):
+            if unit.lease_expiry < now:
+                del self.leased[unit_id]
+                unit.worker, unit.shots_done = None, 0
+                self.pending.append(unit)
+                self.counts['expired'] += 1
+
+    def _split_leased_unit(self) -> Optional[WorkUnit]:
+        # The owner may be in the middle of a chunk, so the cut is one chunk past what it reported
+        def remaining(unit):
+            return unit.shots - (unit.shots_done + unit.chunk_shots)
+        candidates = [unit for unit in self.leased.values() if remaining(unit) >= 2 * self.min_unit_shots]
+        if not candidates:
+            return None
+        unit = max(candidates, key=remaining)
+        tail = remaining(unit) // 2
+        unit.shots -= tail
+        self.counts['splits'] += 1
+        return WorkUnit(unit_id=self._new_unit_id(unit.circuit_id), circuit_id=unit.circuit_id, spec=unit.spec,
+                        start=unit.start + unit.shots, shots=tail, chunk_shots=unit.chunk_shots)
+
+    def lease(self, worker: str) -> Optional[WorkUnit]:
+        with self.lock:
+            now = time.time()
+            self._requeue_expired_leases(now)
+            unit = self.pending.pop(0) if self.pending else self._split_leased_unit()
+            if unit is None:
+                return None
+            unit.worker, unit.lease_expiry, unit.shots_done = worker, now + self.lease_time, 0
+            self.leased[unit.unit_id] = unit
+            self.counts['leases'] += 1
+            return unit
+
+    def heartbeat(self, worker: str, unit_id: str, shots_done: int) -> Dict:
+        with self.lock:
+            unit = self.leased.get(unit_id)
+            if unit is None or unit.worker != worker:  # expired and handed to someone else, or already reported
+                return {'ok': False, 'shots': 0}
+            unit.lease_expiry = time.time() + self.lease_time
+            unit.shots_done = shots_done
+            return {'ok': True, 'shots': unit.shots}
+
+    def report(self, unit_id: str, shots: int, errors: int, result: Optional[Dict] = None) -> bool:
+        with self.lock:
+            if unit_id in self.completed:
+                self.counts['duplicate_reports'] += 1
+                return False
+            unit = self.leased.pop(unit_id, None)
+            if unit is None:
+                # A late report of an expired lease still counts, as long as nobody else finished the unit first
+                unit = next((u for u in self.pending if u.unit_id == unit_id), None)
+                if unit is None:
+                    return False
+                self.pending.remove(unit)
+            if shots != unit.shots:
+                # The worker missed a split, give it back to the queue rather than count shots twice
+                unit.worker, unit.shots_done = None, 0
+                self.pending.append(unit)
+                return False
+            self.completed[unit_id] = {'circuit_id': unit.circuit_id, 'start': unit.start, 'shots': shots,
+                                       'errors': errors, 'result': result}
+            self.totals[unit.circuit_id]['shots'] += shots
+            self.totals[unit.circuit_id]['errors'] += errors
+            return True
+
+    def is_finished(self) -> bool:
+        with self.lock:
+            return not self.pending and not self.leased
+
+    def get_status(self) -> Dict:
+        with self.lock:
+            return {'pending': len(self.pending), 'leased': len(self.leased), 'completed': len(self.completed),
+                    'totals': copy.deepcopy(self.totals), **self.counts}
+
+    def handle(self, request: Dict) -> Dict:
+        op = request.get('op')
+        if op == 'lease':
+            unit = self.lease(request['worker'])
+            return {'unit': None if unit is None else unit.to_dict(), 'finished': unit is None and self.is_finished()}
+        if op == 'heartbeat':
+            return self.heartbeat(request['worker'], request['unit_id'], request['shots_done'])
+        if op == 'report':
+            return {'ok': self.report(request['unit_id'], request['shots'], request['errors'], request.get('result'))}
+        if op == 'status':
+            return self.get_status()
+        return {'error': f'unknown op {op}'}
+
+    def serve(self, host: str = '127.0.0.1', port: int = 0) -> Tuple[str, int]:
+        '''
+        Start serving in a background thread, port 0 picks a free port. Returns the address the workers should connect to.
+        '''
+        coordinator = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                request = json.loads(self.rfile.readline())
+                self.wfile.write((json.dumps(coordinator.handle(request), default=json_default) + '\n').encode())
+
+        self.server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server.server_address
+
+    def wait(self, poll_interval: float = 0.5, timeout: Optional[float] = None) -> bool:
+        t0 = time.time()
+        while not self.is_finished():
+            if timeout is not None and time.time() - t0 > timeout:
+                return False
+            time.sleep(poll_interval)
+        return True
+
+    def shutdown(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+def send_request(address: Tuple[str, int], request: Dict, timeout: float = 30) -> Dict:
+    with socket.create_connection(tuple(address), timeout=timeout) as connection:
+        connection.sendall((json.dumps(request, default=json_default) + '\n').encode())
+        return json.loads(connection.makefile('r').readline())
+
+
+def run_queue_worker(address: Tuple[str, int],
+                     worker_id: Optional[str] = None,
+                     max_cached_circuits: int = 4,
+                     poll_interval: float = 1.0) -> Dict[str, int]:
+    '''
+    Lease units from the coordinator at address until it says the campaign is finished.
+    Every chunk of a unit is an MCSampleDecodeJob run on the warm artifacts of its circuit_id (see ArtifactCache).
+    '''
+    worker_id = worker_id or f'{socket.gethostname()}_{os.getpid()}'
+    cache = ArtifactCache(max_size=max_cached_circuits)
+    stats = {'units': 0, 'shots': 0, 'abandoned': 0}
+    while True:
+        reply = send_request(address, {'op': 'lease', 'worker': worker_id})
+        unit = reply['unit']
+        if unit is None:
+            if reply['finished']:
+                return stats
+            time.sleep(poll_interval)
+            continue
+        shots_done, errors, result = 0, 0, None
+        while True:
+            beat = send_request(address, {'op': 'heartbeat', 'worker': worker_id, 'unit_id': unit['unit_id'], 'shots_done': shots_done})
+            if not beat['ok'] or shots_done >= beat['shots']:
+                break
+            spec = dict(unit['spec'])
+            if spec.get('seed') is not None:
+                # Every chunk of the campaign gets its own seed from where it starts, a shared seed would redraw the same shots
+                spec['seed'] = int(np.random.SeedSequence([spec['seed'], unit['start'] + shots_done]).generate_state(1, dtype=np.uint64)[0] >> 1)
+            job = MCSampleDecodeJob(job_id=unit['unit_id'], circuit_id=unit['circuit_id'],
+                                    shots=min(unit['chunk_shots'], beat['shots'] - shots_done), **spec)
+            result = run_job_with_cache(job, cache)
+            shots_done += job.shots
+            errors += int(result['num_errors'])
+        if not beat['ok']:
+            stats['abandoned'] += 1
+            continue
+        send_request(address, {'op': 'report', 'unit_id': unit['unit_id'], 'shots': shots_done, 'errors': errors,
+                               'result': {'decoder': None if result is None else result['decoder']}})
+        stats['units'] += 1
+        stats['shots'] += shots_done
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Lease shot ranges from a work queue coordinator and decode them.')
+    parser.add_argument('host')
+    parser.add_argument('port', type=int)
+    parser.add_argument('--max_cached_circuits', type=int, default=4)
+    args = parser.parse_args()
+    print(run_queue_worker((args.host, args.port), max_cached_circuits=args.max_cached_circuits))
@@ -0,0 +1,152 @@
+from EfficientSurfaceCodeSim.worker_pool import *
+from collections import OrderedDict
+import traceback
+import glob
+
+
+@dataclass
+class ArtifactCache:
+    """
+    Bounded LRU cache of CompiledArtifacts keyed by circuit_id.
+    A daemon that gets many jobs of the same circuit_id in a row only builds the circuit, reference sample,
+        m2d converter, static graph and erasure site table once; the prediction caches in the artifacts carry over too.
+    """
+    max_size: int = 4
+
+    def __post_init__(self):
+        self.artifacts: OrderedDict = OrderedDict()
+        self.counts = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get(self, job) -> CompiledArtifacts:
+        artifacts = self.artifacts.get(job.circuit_id)
+        if artifacts is not None:
+            self.counts['hits'] += 1
+            self.artifacts.move_to_end(job.circuit_id)
+            return artifacts
+        self.counts['misses'] += 1
+        artifacts = compile_artifacts(job.get_builder())
+        self.artifacts[job.circuit_id] = artifacts
+        if len(self.artifacts) > self.max_size:
+            self.artifacts.popitem(last=False)
+            self.counts['evictions'] += 1
+        return artifacts
+
+
+def json_default(value):
+    # numpy scalars and arrays in the results
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return str(value)
+
+
+def _write_json_atomically(path: str, content: Dict):
+    # Whoever collects the results never sees a half-written file
+    with open(path + '.tmp', 'w') as f:
+        json.dump(content, f, default=json_default)
+    os.replace(path + '.tmp', path)
+
+
+def run_job_with_cache(job, cache: ArtifactCache) -> Dict:
+    '''
+    Jobs that can attach to pre-compiled artifacts (get_builder() + sample_and_print_result(artifacts=...)) use the cache,
+        the others (e.g. importance sampling jobs) are run as they are.
+    '''
+    if hasattr(job, 'get_builder') and hasattr(job, 'circuit_id'):
+        return job.sample_and_print_result(artifacts=cache.get(job))
+    return job.sample_and_print_result()
+
+
+def submit_job(job, job_dir: str, name: Optional[str] = None) -> str:
+    '''
+    Drop a job into job_dir for run_worker_daemon: pickled to {name}.pkl.tmp first and renamed to {name}.pkl,
+        so a daemon never claims a half-written pickle. Jobs written any other way must follow the same convention.
+    name defaults to the job_id. Returns the path of the pickle.
+    '''
+    name = name or str(job.job_id)
+    path = os.path.join(job_dir, f'{name}.pkl')
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(job, f)
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def claim_next_job(job_dir: str) -> Optional[str]:
+    '''
+    Rename the oldest job pickle in job_dir to *.pkl.running and return the new path.
+    The rename is atomic, so several daemons can watch the same directory without running a job twice,
+        a pickle that another daemon claims between the listing and the rename is skipped.
+    Only complete pickles may be named *.pkl, write them with submit_job (or write elsewhere and rename).
+    '''
+    paths = []
+    for path in glob.glob(os.path.join(job_dir, '*.pkl')):
+        try:
+            paths.append((os.path.getmtime(path), path))
+        except OSError:  # claimed by another daemon since the glob
+            continue
+    for _, path in sorted(paths):
+        claimed = path + '.running'
+        try:
+            os.rename(path, claimed)
+        except OSError:  # another daemon got it first
+            continue
+        return claimed
+    return None
+
+
+def run_worker_daemon(job_dir: str,
+                      result_dir: Optional[str] = None,
+                      max_cached_circuits: int = 4,
+                      poll_interval: float = 1.0,
+                      max_idle_time: Optional[float] = None,
+                      max_jobs: Optional[int] = None) -> Dict[str, int]:
+    '''
+    Long-lived worker: run the pickled jobs dropped into job_dir one after another and write {job_id}.json into result_dir.
+    Jobs must appear in job_dir atomically (see submit_job), any file named *.pkl is taken to be a complete pickle.
+    A finished job's pickle is deleted, a failed one is renamed to *.pkl.failed next to a {job_id}.error.json with the traceback.
+    The daemon stops when a file named STOP shows up in job_dir, after max_idle_time seconds without jobs, or after max_jobs jobs.
+    Returns how many jobs were run / failed and the artifact cache statistics.
+    '''
+    result_dir = result_dir or job_dir
+    os.makedirs(result_dir, exist_ok=True)
+    cache = ArtifactCache(max_size=max_cached_circuits)
+    stats = {'jobs': 0, 'failed': 0}
+    last_job_time = time.time()
+    while not os.path.exists(os.path.join(job_dir, 'STOP')):
+        if max_jobs is not None and stats['jobs'] + stats['failed'] >= max_jobs:
+            break
+        claimed = claim_next_job(job_dir)
+        if claimed is None:
+            if max_idle_time is not None and time.time() - last_job_time > max_idle_time:
+                break
+            time.sleep(poll_interval)
+            continue
+        name = os.path.basename(claimed)[:-len('.pkl.running')]
+        try:
+            with open(claimed, 'rb') as f:
+                job = pickle.load(f)
+            name = str(getattr(job, 'job_id', name))
+            t0 = time.time()
+            result = run_job_with_cache(job, cache)
+            result.setdefault('wall_time', time.time() - t0)
+            _write_json_atomically(os.path.join(result_dir, f'{name}.json'), result)
+            os.remove(claimed)
+            stats['jobs'] += 1
+        except Exception:
+            _write_json_atomically(os.path.join(result_dir, f'{name}.error.json'), {'job_id': name, 'traceback': traceback.format_exc()})
+            os.replace(claimed, claimed[:-len('.running')] + '.failed')
+            stats['failed'] += 1
+        last_job_time = time.time()
+    stats.update(cache.counts)
+    return stats
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Run the pickled jobs dropped into a directory, keeping compiled circuits warm between jobs.')
+    parser.add_argument('job_dir')
+    parser.add_argument('result_dir', nargs='?', default=None)
+    parser.add_argument('--max_cached_circuits', type=int, default=4)
+    parser.add_argument('--poll_interval', type=float, default=1.0)
+    parser.add_argument('--max_idle_time', type=float, default=None)
+    args = parser.parse_args()
+    print(run_worker_daemon(args.job_dir, args.result_dir, args.max_cached_circuits, args.poll_interval, args.max_idle_time))
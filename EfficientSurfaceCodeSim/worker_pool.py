@@ -0,0 +1,81 @@
+from EfficientSurfaceCodeSim.circuit_builder import *
+from EfficientSurfaceCodeSim.prediction_cache import *
+import gc
+import multiprocessing
+
+
+@dataclass
+class CompiledArtifacts:
+    """
+    Everything about one circuit_id that doesn't change from shot to shot or from worker to worker.
+    Built once in a parent process, the forked workers only read it through copy-on-write pages.
+    """
+    builder: easure_circ_builder
+    reference_sample: np.ndarray
+    converter: stim.CompiledMeasurementsToDetectionEventsConverter
+    static_graph: StaticMatchingGraph
+    erasure_site_table: ErasureSiteTable
+    # decoder and curve -> PredictionCache, filled by the jobs so later jobs of this circuit_id reuse the predictions
+    prediction_caches: Dict[str, PredictionCache] = field(default_factory=dict)
+
+    def compile_sampler(self, seed=None) -> stim.CompiledMeasurementSampler:
+        # The reference sample is the expensive part of compile_sampler(), and it's shared.
+        # The prng is not, every worker must compile its own sampler or the forked workers would draw identical shots.
+        return self.builder.erasure_circuit.compile_sampler(seed=seed, reference_sample=self.reference_sample)
+
+
+def compile_artifacts(builder: easure_circ_builder) -> CompiledArtifacts:
+    if getattr(builder, 'helper', None) is None:
+        builder.generate_helper()
+    if getattr(builder, 'erasure_circuit', None) is None:
+        builder.gen_erasure_conversion_circuit()
+    builder.gen_static_graph()
+    builder.gen_erasure_site_table()
+    artifacts = CompiledArtifacts(builder=builder,
+                                  reference_sample=builder.erasure_circuit.reference_sample(),
+                                  converter=builder.erasure_circuit.compile_m2d_converter(),
+                                  static_graph=builder.static_graph,
+                                  erasure_site_table=builder.erasure_site_table)
+    for obj in [artifacts, artifacts.static_graph, artifacts.erasure_site_table]:
+        for value in vars(obj).values():
+            if isinstance(value, np.ndarray):
+                value.flags.writeable = False
+    return artifacts
+
+
+# Filled in the parent before forking, the workers look their artifacts up by circuit_id.
+_shared_artifacts: Dict[str, CompiledArtifacts] = {}
+
+
+def share_artifacts(circuit_id: str, artifacts: CompiledArtifacts):
+    _shared_artifacts[circuit_id] = artifacts
+
+
+def get_shared_artifacts(circuit_id: str) -> Optional[CompiledArtifacts]:
+    return _shared_artifacts.get(circuit_id)
+
+
+def _run_job_with_shared_artifacts(job):
+    return job.sample_and_print_result(artifacts=_shared_artifacts[job.circuit_id])
+
+
+def run_jobs_in_forked_pool(jobs: List, num_workers: int) -> List[Dict]:
+    '''
+    Worker-pool mode for several decode processes on one node.
+    The jobs only need a circuit_id, a get_builder() method and a sample_and_print_result(artifacts=...) method.
+    The helper, erasure circuit, reference sample, m2d converter, static graph and erasure site table are built
+        once per circuit_id here, then the workers are forked and attach to them instead of rebuilding.
+    '''
+    for job in jobs:
+        if job.circuit_id not in _shared_artifacts:
+            share_artifacts(job.circuit_id, compile_artifacts(job.get_builder()))
+    # Move everything allocated so far out of the reach of the garbage collector,
+    #   otherwise the first collection in every worker touches (and copies) all of the shared pages.
+    gc.collect()
+    gc.freeze()
+    try:
+        with multiprocessing.get_context('fork').Pool(num_workers) as pool:
+            results = pool.map(_run_job_with_shared_artifacts, jobs, chunksize=1)
+    finally:
+        gc.unfreeze()
+    return results
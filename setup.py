@@ -9,6 +9,7 @@ REQUIREMENTS = [
     "numpy",
     "stim",
     "pymatching",
+    "scipy",
 ]
 EXTRA_REQUIREMENTS = [
 